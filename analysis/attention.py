@@ -0,0 +1,279 @@
+"""
+Who looks at whom in multi-person recordings, from the OpenFace output of FaceLandmarkVidMulti.
+
+For every face, OpenFace gives the gaze direction of both eyes (`gaze_0_*`, `gaze_1_*`, unit vectors in camera
+coordinates) and the head position (`pose_Tx`, `pose_Ty`, `pose_Tz`, in millimeters from the camera). The rows of
+every `face_id` are scattered into (frames x faces) arrays, and the gaze ray of every face is compared with the
+direction of every other head for all the frames at once:
+
+- `gaze_distances`: (frames, faces, faces) angular distance in degrees between the gaze ray of face i (starting at
+  its head) and the head of face j, taken as a sphere of HEAD_RADIUS millimeters, so 0 when the ray hits the head.
+  The diagonal and the pairs where one of the faces is not tracked are NaN.
+- `attention_targets`: the head each face looks at in every frame (the closest one within `threshold` degrees),
+  or -1. The per-frame attention matrices are the one-hot encoding of it.
+- `look_durations`: time every face spent looking at every other face, number of glances and mutual gaze time.
+
+Usage:
+    python attention.py -openface <openface.csv> [-threshold 10] [-out <attention.npz>] [-durations <durations.csv>]
+    python attention.py -session <session.npz> ...
+"""
+
+import argparse
+import numpy as np
+
+GAZE_COLUMNS = ['gaze_0_x', 'gaze_0_y', 'gaze_0_z', 'gaze_1_x', 'gaze_1_y', 'gaze_1_z']
+HEAD_COLUMNS = ['pose_Tx', 'pose_Ty', 'pose_Tz']
+HEAD_RADIUS = 100.0  # millimeters
+
+
+def face_arrays(streams):
+    """
+    Scatter the OpenFace streams of every face into (frames x faces) arrays
+
+    Parameters
+    ----------
+    streams : dict
+        face_id -> Stream, as returned by session_store.read_openface (or the `openface/<face_id>` streams of a
+        SessionStore)
+
+    Returns
+    -------
+    frames : np.ndarray, shape (T,)
+        Frame indices, from the first to the last frame of any face
+    face_ids : np.ndarray, shape (F,)
+    gaze : np.ndarray, shape (T, F, 3)
+        Mean gaze direction of both eyes, normalized
+    head : np.ndarray, shape (T, F, 3)
+        Head position in millimeters
+    valid : np.ndarray of bool, shape (T, F)
+        OpenFace tracked the face (success) and gave a gaze direction
+
+    """
+    if not streams:
+        raise ValueError("The OpenFace output has no face")
+    face_ids = np.array(sorted(streams), dtype=int)
+    missing = [c for c in GAZE_COLUMNS + HEAD_COLUMNS if c not in streams[face_ids[0]].columns]
+    if missing:
+        raise ValueError(f"The OpenFace output has no {', '.join(missing)} column: run it with -gaze -pose")
+    first = min(stream.frames[0] for stream in streams.values())
+    last = max(stream.frames[-1] for stream in streams.values())
+    frames = np.arange(first, last + 1)
+
+    gaze = np.zeros((len(frames), len(face_ids), 3))
+    head = np.zeros((len(frames), len(face_ids), 3))
+    valid = np.zeros((len(frames), len(face_ids)), dtype=bool)
+    for k, face_id in enumerate(face_ids):
+        stream = streams[face_id]
+        rows = stream.frames - first
+        eyes = stream.values[:, stream.column_index(GAZE_COLUMNS)].reshape(-1, 2, 3).mean(axis=1)
+        gaze[rows, k] = eyes
+        head[rows, k] = stream.values[:, stream.column_index(HEAD_COLUMNS)]
+        valid[rows, k] = stream.valid
+    norm = np.linalg.norm(gaze, axis=-1)
+    valid &= norm > 0
+    gaze /= np.where(norm > 0, norm, 1.0)[..., None]
+    return frames, face_ids, gaze, head, valid
+
+
+def gaze_distances(gaze, head, valid, head_radius=HEAD_RADIUS):
+    """
+    Angular distance between the gaze ray of every face and the head of every other face
+
+    Parameters
+    ----------
+    gaze : np.ndarray, shape (T, F, 3)
+        Unit gaze directions
+    head : np.ndarray, shape (T, F, 3)
+        Head positions, origin of the gaze rays and centers of the targets
+    valid : np.ndarray of bool, shape (T, F)
+    head_radius : float, optional
+        Radius of a head in the units of `head`. The default is HEAD_RADIUS.
+
+    Returns
+    -------
+    distances : np.ndarray, shape (T, F, F)
+        Degrees from the gaze ray of face i (axis 1) to the head of face j (axis 2), 0 if the ray hits the head.
+        NaN on the diagonal, for invalid faces and for heads behind the looker.
+
+    """
+    offsets = head[:, None, :, :] - head[:, :, None, :]
+    dist = np.linalg.norm(offsets, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos = np.einsum('tik,tijk->tij', gaze, offsets) / dist
+        angles = np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+        radius = np.degrees(np.arctan2(head_radius, dist))
+    distances = np.maximum(angles - radius, 0.0)
+    pairs = valid[:, :, None] & valid[:, None, :] & (dist > 0) & (cos > 0)
+    pairs[:, np.arange(gaze.shape[1]), np.arange(gaze.shape[1])] = False
+    return np.where(pairs, distances, np.nan)
+
+
+def attention_targets(distances, threshold=10.0):
+    """
+    Head looked at by every face in every frame
+
+    Parameters
+    ----------
+    distances : np.ndarray, shape (T, F, F)
+        See `gaze_distances`
+    threshold : float, optional
+        Maximum angular distance in degrees. The default is 10 (about the accuracy of the OpenFace gaze).
+
+    Returns
+    -------
+    targets : np.ndarray of int8, shape (T, F)
+        Index of the closest head within the threshold, -1 for none
+
+    """
+    filled = np.where(np.isnan(distances), np.inf, distances)
+    nearest = np.argmin(filled, axis=2) if distances.shape[2] else np.zeros(distances.shape[:2], dtype=int)
+    hit = np.take_along_axis(filled, nearest[..., None], axis=2)[..., 0] <= threshold
+    return np.where(hit, nearest, -1).astype(np.int8)
+
+
+def attention_matrices(targets, num_faces):
+    """One-hot (T, F, F) attention matrices of `attention_targets`: [t, i, j] is True when i looks at j"""
+    return targets[..., None] == np.arange(num_faces)
+
+
+def look_durations(targets, fps):
+    """
+    Aggregate the attention targets of a session
+
+    Parameters
+    ----------
+    targets : np.ndarray of int, shape (T, F)
+    fps : float
+
+    Returns
+    -------
+    seconds : np.ndarray, shape (F, F)
+        Time face i spent looking at face j
+    glances : np.ndarray of int, shape (F, F)
+        Number of separate looks of face i at face j
+    mutual : np.ndarray, shape (F, F)
+        Time faces i and j looked at each other (symmetric)
+
+    """
+    num_faces = targets.shape[1]
+    looker = np.broadcast_to(np.arange(num_faces), targets.shape)
+    looking = targets >= 0
+    pair = looker * num_faces + targets
+    seconds = np.bincount(pair[looking], minlength=num_faces ** 2).reshape(num_faces, num_faces) / fps
+
+    # A glance starts where the target differs from the one of the previous frame
+    starts = looking.copy()
+    starts[1:] &= targets[1:] != targets[:-1]
+    glances = np.bincount(pair[starts], minlength=num_faces ** 2).reshape(num_faces, num_faces)
+
+    back = np.take_along_axis(targets, np.maximum(targets, 0).astype(int), axis=1) == looker
+    mutual_pairs = pair[looking & back]
+    mutual = np.bincount(mutual_pairs, minlength=num_faces ** 2).reshape(num_faces, num_faces) / fps
+    return seconds, glances, mutual
+
+
+class Attention:
+    """Per-frame gaze distances and attention targets of the faces of one recording"""
+
+    def __init__(self, frames, face_ids, distances, targets, valid, fps, threshold):
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.face_ids = np.asarray(face_ids, dtype=int)
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.targets = np.asarray(targets, dtype=np.int8)
+        self.valid = np.asarray(valid, dtype=bool)
+        self.fps = float(fps)
+        self.threshold = float(threshold)
+
+    @classmethod
+    def from_streams(cls, streams, fps, threshold=10.0, head_radius=HEAD_RADIUS):
+        """Compute the attention of the OpenFace streams of one recording (face_id -> Stream)"""
+        frames, face_ids, gaze, head, valid = face_arrays(streams)
+        distances = gaze_distances(gaze, head, valid, head_radius)
+        return cls(frames, face_ids, distances, attention_targets(distances, threshold), valid, fps, threshold)
+
+    @property
+    def timestamps(self):
+        return self.frames / self.fps
+
+    def matrices(self):
+        """(T, F, F) attention matrices: [t, i, j] is True when face i looks at face j in frame t"""
+        return attention_matrices(self.targets, len(self.face_ids))
+
+    def durations(self):
+        """
+        Look-at durations, one row per ordered pair of faces
+
+        Returns
+        -------
+        rows : list of tuple
+            (looker face_id, target face_id, seconds, share of the frames where the looker is tracked,
+            glances, mutual gaze seconds)
+
+        """
+        seconds, glances, mutual = look_durations(self.targets, self.fps)
+        tracked = self.valid.sum(axis=0) / self.fps
+        rows = []
+        for i, looker in enumerate(self.face_ids):
+            for j, target in enumerate(self.face_ids):
+                if i != j:
+                    share = seconds[i, j] / tracked[i] if tracked[i] else 0.0
+                    rows.append((int(looker), int(target), seconds[i, j], share, int(glances[i, j]), mutual[i, j]))
+        return rows
+
+    def save(self, path):
+        """Save the per-frame distances, targets and validity to a `.npz` file"""
+        np.savez_compressed(path, frames=self.frames, face_ids=self.face_ids, distances=self.distances,
+                            targets=self.targets, valid=self.valid, fps=np.array(self.fps),
+                            threshold=np.array(self.threshold))
+
+    @classmethod
+    def load(cls, path):
+        """Load an attention file saved with `save`"""
+        with np.load(path) as data:
+            return cls(data['frames'], data['face_ids'], data['distances'], data['targets'], data['valid'],
+                       float(data['fps']), float(data['threshold']))
+
+
+if __name__ == "__main__":
+    import time
+    from session_store import SessionStore
+
+    parser = argparse.ArgumentParser(description="Compute who looks at whom from the OpenFace output.")
+    parser.add_argument('-openface', help="OpenFace CSV of FaceLandmarkVidMulti (or its .npz encoding)")
+    parser.add_argument('-session', help="Session .npz built with session_store.py, instead of -openface")
+    parser.add_argument('-threshold', type=float, default=10.0, help="Maximum gaze to head distance in degrees")
+    parser.add_argument('-head_radius', type=float, default=HEAD_RADIUS, help="Head radius in millimeters")
+    parser.add_argument('-out', help="Output .npz file with the per-frame distances and targets")
+    parser.add_argument('-durations', help="Output CSV file with the look-at durations")
+    args = parser.parse_args()
+
+    if args.session:
+        store = SessionStore.load(args.session)
+    elif args.openface:
+        store = SessionStore()
+        store.add_openface(args.openface)
+    else:
+        parser.error("one of -openface and -session is required")
+    streams = {int(name.split('/')[1]): stream for name, stream in store.streams.items()
+               if name.startswith('openface/')}
+
+    start = time.perf_counter()
+    try:
+        attention = Attention.from_streams(streams, store.fps, args.threshold, args.head_radius)
+    except ValueError as error:
+        parser.error(str(error))
+    elapsed = time.perf_counter() - start
+    print(f"{len(attention.frames)} frames, {len(attention.face_ids)} faces in {elapsed:.2f} s")
+
+    rows = attention.durations()
+    print("looker target seconds share glances mutual")
+    for looker, target, seconds, share, glances, mutual in rows:
+        print(f"{looker:>6} {target:>6} {seconds:7.1f} {share:5.0%} {glances:7d} {mutual:6.1f}")
+    if args.out:
+        attention.save(args.out)
+        print(f"Saved attention to {args.out}")
+    if args.durations:
+        # No rows (header only) with a single face
+        np.savetxt(args.durations, np.array(rows, dtype=float).reshape(-1, 6), delimiter=',',
+                   fmt=['%d', '%d', '%.3f', '%.4f', '%d', '%.3f'], header='looker,target,seconds,share,glances,mutual_seconds', comments='')
+        print(f"Saved durations to {args.durations}")
@@ -0,0 +1,362 @@
+"""
+Event index over the head pose and body pose streams of a corpus of sessions.
+
+Finding when someone turned their head left used to mean running head_pose_estimation.py again and reading its
+'Head left' log messages, or scanning whole CSV files. The index is built once: every stream is thresholded into
+events and every event is stored as a run-length segment (start, end) of consecutive frames where it holds.
+All the segments of the corpus are kept in flat arrays sorted by event and start time, so a query is a binary
+search for the event block followed by vectorized masks, which takes milliseconds for millions of segments.
+
+Events (see RULES):
+- `head_left`, `head_right`, `head_up`, `head_down`: OpenFace `pose_Ry`/`pose_Rx` beyond ±0.35 rad (20 degrees),
+  or `yaw`/`pitch` of the headpose CSV beyond ±20 degrees, as in head_directions of head_pose_estimation.py
+- `face_lost`, `body_lost`: frames where OpenFace or MediaPipe found nobody. FaceLandmarkVidMulti writes no row for
+  a face it lost, so the streams are first laid on every frame of the session: a missing frame is a lost one.
+- `body_motion`: mean speed of the body landmarks above 0.5 frame widths per second
+
+Sources are the stream names of the session store (`openface/<face_id>`, `bodypose/<person>`) and
+`headpose/<face>` for the headpose CSV, where `<face>` is the detection order in the frame.
+
+Usage:
+    python event_index.py -sessions <a_session.npz> [...] [-headpose <a_headpose.csv> ...] -out <events.npz>
+    python event_index.py -index <events.npz> -event head_left [-source openface/2] [-min_duration 2]
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from session_store import SessionStore, Stream
+
+# (event, source kind, column, comparison, threshold). Column None uses the validity of the samples.
+RULES = [
+    ('head_left', 'openface', 'pose_Ry', '<', -0.35),
+    ('head_right', 'openface', 'pose_Ry', '>', 0.35),
+    ('head_up', 'openface', 'pose_Rx', '<', -0.35),
+    ('head_down', 'openface', 'pose_Rx', '>', 0.35),
+    ('face_lost', 'openface', None, '!', None),
+    ('head_left', 'headpose', 'yaw', '<=', -20),
+    ('head_right', 'headpose', 'yaw', '>=', 20),
+    ('head_up', 'headpose', 'pitch', '<=', -20),
+    ('head_down', 'headpose', 'pitch', '>=', 20),
+    ('body_lost', 'bodypose', None, '!', None),
+    ('body_motion', 'bodypose', 'motion', '>', 0.5),
+]
+
+COMPARISONS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+
+
+def body_motion(stream, fps):
+    """Mean speed of the x, y landmarks between consecutive valid frames, NaN elsewhere"""
+    xy = stream.values.reshape(len(stream.values), -1, 3)[:, :, :2]
+    speed = np.full(len(xy), np.nan)
+    if len(xy) < 2:
+        return speed
+    step = np.linalg.norm(np.diff(xy, axis=0), axis=2).mean(axis=1)
+    consecutive = stream.valid[1:] & stream.valid[:-1] & (np.diff(stream.frames) == 1)
+    speed[1:] = np.where(consecutive, step * fps, np.nan)
+    return speed
+
+
+def on_frames(stream, frames, fps):
+    """
+    Lay a stream on a range of frames, the frames it has no sample for being invalid
+
+    Parameters
+    ----------
+    stream : Stream
+    frames : np.ndarray of int
+        Consecutive frame indices covering the frames of the stream
+    fps : float
+        Frame rate, for the timestamps of the frames before or after the stream
+
+    Returns
+    -------
+    stream : Stream
+
+    """
+    values = np.full((len(frames), len(stream.columns)), np.nan)
+    valid = np.zeros(len(frames), dtype=bool)
+    pos = stream.frames - frames[0]
+    values[pos] = stream.values
+    valid[pos] = stream.valid
+    timestamps = np.interp(frames, stream.frames, stream.timestamps)
+    before, after = frames < stream.frames[0], frames > stream.frames[-1]
+    timestamps[before] = stream.timestamps[0] + (frames[before] - stream.frames[0]) / fps
+    timestamps[after] = stream.timestamps[-1] + (frames[after] - stream.frames[-1]) / fps
+    return Stream(frames, timestamps, values, valid, stream.columns)
+
+
+def read_headpose(csv_path, fps):
+    """
+    Read the headpose CSV of head_pose_estimation.py as one stream per face index
+
+    Returns
+    -------
+    streams : dict
+        face -> Stream of the pitch and yaw columns, on every frame of the CSV (frames where that face was not
+        detected are invalid)
+
+    """
+    data = pd.read_csv(csv_path)
+    streams = {}
+    if 'pitch' not in data.columns:
+        raise ValueError(f"{csv_path} has no pitch and yaw columns: run head_pose_estimation.py again")
+    if data.empty:
+        return streams
+    frames = np.arange(data['frame'].min(), data['frame'].max() + 1)
+    for face, rows in data.groupby('face'):
+        values = np.full((len(frames), 2), np.nan)
+        valid = np.zeros(len(frames), dtype=bool)
+        pos = rows['frame'].to_numpy() - frames[0]
+        values[pos] = rows[['pitch', 'yaw']].to_numpy(dtype=float)
+        valid[pos] = True
+        streams[int(face)] = Stream(frames, frames / fps, values, valid, ['pitch', 'yaw'])
+    return streams
+
+
+def runs(mask, merge_gap=0):
+    """
+    Run-length segments of a boolean mask
+
+    Parameters
+    ----------
+    mask : np.ndarray of bool, shape (T,)
+    merge_gap : int, optional
+        Runs separated by at most this many frames are joined. The default is 0.
+
+    Returns
+    -------
+    starts, ends : np.ndarray of int
+        First and one-past-last index of every run
+
+    """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if merge_gap > 0 and len(starts) > 1:
+        keep = np.concatenate(([True], starts[1:] - ends[:-1] > merge_gap))
+        starts = starts[keep]
+        ends = ends[np.concatenate((keep[1:], [True]))]
+    return starts, ends
+
+
+def stream_events(name, stream, fps, merge_gap=0):
+    """
+    Threshold one stream with the RULES of its kind
+
+    Returns
+    -------
+    events : list of tuple
+        (event, start times, end times), end times being one frame after the last frame of every segment
+
+    """
+    kind = name.split('/')[0]
+    events = []
+    for event, rule_kind, column, comparison, threshold in RULES:
+        if rule_kind != kind:
+            continue
+        if column is None:
+            mask = ~stream.valid
+        else:
+            values = body_motion(stream, fps) if column == 'motion' else stream.values[:, stream.columns.index(column)]
+            with np.errstate(invalid='ignore'):
+                mask = stream.valid & COMPARISONS[comparison](values, threshold)
+        # Frames missing from the stream break the runs
+        gaps = np.flatnonzero(np.diff(stream.frames) != 1) + 1
+        starts, ends = [], []
+        for lo, hi in zip(np.concatenate(([0], gaps)), np.concatenate((gaps, [len(mask)]))):
+            s, e = runs(mask[lo:hi], merge_gap)
+            starts.append(s + lo)
+            ends.append(e + lo)
+        starts, ends = np.concatenate(starts), np.concatenate(ends)
+        events.append((event, stream.timestamps[starts], stream.timestamps[ends - 1] + 1.0 / fps))
+    return events
+
+
+class EventIndex:
+    """Run-length event segments of a corpus, sorted by event and start time"""
+
+    FIELDS = ('session', 'source', 'event', 'start', 'end')
+
+    def __init__(self):
+        self.sessions, self.sources, self.events = [], [], []
+        self.session = np.zeros(0, dtype=np.int32)
+        self.source = np.zeros(0, dtype=np.int32)
+        self.event = np.zeros(0, dtype=np.int32)
+        self.start = np.zeros(0)
+        self.end = np.zeros(0)
+        self._pending = []
+
+    @staticmethod
+    def _id(names, name):
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+
+    def add_stream(self, session, name, stream, fps, merge_gap=0, frames=None):
+        """
+        Add the events of one stream of a session
+
+        Parameters
+        ----------
+        frames : np.ndarray of int, optional
+            Frames of the session, the ones missing from the stream count as lost. The default is None (from the
+            first to the last frame of the stream).
+
+        """
+        if not len(stream.frames):
+            return
+        if frames is None:
+            frames = np.arange(stream.frames[0], stream.frames[-1] + 1)
+        stream = on_frames(stream, frames, fps)
+        session_id = self._id(self.sessions, session)
+        source_id = self._id(self.sources, name)
+        for event, starts, ends in stream_events(name, stream, fps, merge_gap):
+            n = len(starts)
+            self._pending.append((np.full(n, session_id, dtype=np.int32), np.full(n, source_id, dtype=np.int32),
+                                  np.full(n, self._id(self.events, event), dtype=np.int32), starts, ends))
+
+    def add_session(self, session, store, merge_gap=0):
+        """Add every stream of a SessionStore, on the frames of all the streams of the same kind"""
+        ranges = {}
+        for name, stream in store.streams.items():
+            if len(stream.frames):
+                lo, hi = ranges.get(name.split('/')[0], (stream.frames[0], stream.frames[-1]))
+                ranges[name.split('/')[0]] = (min(lo, stream.frames[0]), max(hi, stream.frames[-1]))
+        for name, stream in store.streams.items():
+            lo, hi = ranges.get(name.split('/')[0], (0, -1))
+            self.add_stream(session, name, stream, store.fps, merge_gap, np.arange(lo, hi + 1))
+
+    def add_headpose(self, session, csv_path, fps, merge_gap=0):
+        """Add the faces of a headpose CSV as `headpose/<face>`"""
+        for face, stream in read_headpose(csv_path, fps).items():
+            self.add_stream(session, f"headpose/{face}", stream, fps, merge_gap)
+
+    def finalize(self):
+        """Merge the added segments into the sorted arrays. Called by `query` and `save` when needed."""
+        if not self._pending:
+            return
+        columns = list(zip(*self._pending))
+        self._pending = []
+        arrays = [np.concatenate((getattr(self, field), *column)) for field, column in zip(self.FIELDS, columns)]
+        order = np.lexsort((arrays[3], arrays[2]))
+        for field, array in zip(self.FIELDS, arrays):
+            setattr(self, field, array[order])
+
+    def save(self, path):
+        """Save the index to an `.npz` file"""
+        self.finalize()
+        np.savez_compressed(path, sessions=np.array(self.sessions, dtype=str), sources=np.array(self.sources, dtype=str),
+                            events=np.array(self.events, dtype=str),
+                            **{field: getattr(self, field) for field in self.FIELDS})
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with `save`"""
+        index = cls()
+        with np.load(path) as data:
+            for names in ('sessions', 'sources', 'events'):
+                setattr(index, names, [str(n) for n in data[names]])
+            for field in cls.FIELDS:
+                setattr(index, field, data[field])
+        return index
+
+    def query(self, event, source=None, session=None, min_duration=0.0, t0=None, t1=None):
+        """
+        Find the segments of an event
+
+        Parameters
+        ----------
+        event : string
+            Event name, e.g. 'head_left'
+        source : string, optional
+            Stream name, e.g. 'openface/2'. The default is every source.
+        session : string, optional
+            Session name. The default is every session.
+        min_duration : float, optional
+            Minimum duration of the segments in seconds. The default is 0.
+        t0, t1 : float, optional
+            Only the segments overlapping [t0, t1] (in seconds). The default is any time.
+
+        Returns
+        -------
+        segments : pd.DataFrame
+            session, source, start, end and duration of the matching segments, sorted by start time
+
+        """
+        self.finalize()
+        columns = ['session', 'source', 'start', 'end', 'duration']
+        if event not in self.events:
+            return pd.DataFrame(columns=columns)
+        event_id = self.events.index(event)
+        lo, hi = np.searchsorted(self.event, [event_id, event_id + 1])
+        if t1 is not None:
+            # Segments are sorted by start time within the event
+            hi = lo + np.searchsorted(self.start[lo:hi], t1)
+
+        start, end = self.start[lo:hi], self.end[lo:hi]
+        keep = end - start >= min_duration
+        if t0 is not None:
+            keep &= end > t0
+        if source is not None:
+            keep &= self.source[lo:hi] == (self.sources.index(source) if source in self.sources else -1)
+        if session is not None:
+            keep &= self.session[lo:hi] == (self.sessions.index(session) if session in self.sessions else -1)
+        idx = np.flatnonzero(keep) + lo
+        return pd.DataFrame({'session': np.array(self.sessions, dtype=object)[self.session[idx]],
+                             'source': np.array(self.sources, dtype=object)[self.source[idx]],
+                             'start': self.start[idx], 'end': self.end[idx],
+                             'duration': self.end[idx] - self.start[idx]}, columns=columns)
+
+
+def session_name(path, suffix):
+    """Session name from a file name, e.g. 'video' for 'video_session.npz' or 'video_headpose.csv'"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem[:-len(suffix)] if stem.endswith(suffix) else stem
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the event index of a corpus of sessions.")
+    parser.add_argument('-sessions', nargs='*', default=[], help="Session .npz files (see session_store.py)")
+    parser.add_argument('-headpose', nargs='*', default=[], help="Headpose CSV files of head_pose_estimation.py")
+    parser.add_argument('-fps', type=float, default=None, help="Frame rate of the headpose CSV files without session")
+    parser.add_argument('-merge_gap', type=int, default=0, help="Join segments separated by at most this many frames")
+    parser.add_argument('-out', help="Index .npz file to build")
+    parser.add_argument('-index', help="Index .npz file to query")
+    parser.add_argument('-event', help="Event to query")
+    parser.add_argument('-source', help="Source to query, e.g. openface/2")
+    parser.add_argument('-session', help="Session to query")
+    parser.add_argument('-min_duration', type=float, default=0.0, help="Minimum duration in seconds")
+    args = parser.parse_args()
+
+    if args.out:
+        index = EventIndex()
+        fps = {}
+        for path in args.sessions:
+            name = session_name(path, '_session')
+            store = SessionStore.load(path)
+            fps[name] = store.fps
+            index.add_session(name, store, args.merge_gap)
+        for path in args.headpose:
+            name = session_name(path, '_headpose')
+            if fps.get(name, args.fps) is None:
+                parser.error(f"Unknown frame rate for {path}: add its session or pass -fps")
+            try:
+                index.add_headpose(name, path, fps.get(name, args.fps), args.merge_gap)
+            except ValueError as error:
+                parser.error(str(error))
+        index.save(args.out)
+        print(f"Indexed {len(index.start)} segments of {len(index.events)} events from {len(index.sessions)} sessions "
+              f"to {args.out}")
+    elif args.index and args.event:
+        index = EventIndex.load(args.index)
+        start = time.perf_counter()
+        segments = index.query(args.event, args.source, args.session, args.min_duration)
+        elapsed = time.perf_counter() - start
+        print(segments.to_string(index=False))
+        print(f"{len(segments)} segments in {elapsed * 1000:.2f} ms")
+    else:
+        parser.error("Use -out to build an index or -index with -event to query one")
@@ -0,0 +1,291 @@
+"""
+Sliding-window feature extraction for action recognition from the bodypose landmarks and the head pose angles.
+
+Per-frame features are computed with vectorized NumPy over the whole session:
+- speed of every landmark (normalized image units per second, from x and y),
+- joint angles in degrees (elbows, shoulders, hips and knees),
+- distances between the torso centers of every pair of people,
+- the head pose angles themselves (e.g. OpenFace `pose_Rx`, `pose_Ry`, `pose_Rz` or `pitch`/`yaw`/`roll` of the
+  headpose CSV).
+
+Window features are the mean and the standard deviation of every per-frame feature over windows of `window`
+frames taken every `step` frames. In batch mode they come from cumulative sums, so a whole session is processed
+in one pass without a Python loop over windows. `FeatureEngine.update` gives the same features for live use,
+updating running sums in O(1) per new frame.
+
+Missing samples (MediaPipe rows that are all zeros, or NaN in the head angles) are ignored in the window
+statistics instead of being counted as zeros.
+
+Usage:
+    python features.py -session <session.npz> -window 30 -step 5 -out <features.csv>
+"""
+
+import argparse
+import numpy as np
+
+# (a, b, c) landmark triplets: the angle is measured at b
+JOINTS = {
+    'left_elbow': (11, 13, 15),
+    'right_elbow': (12, 14, 16),
+    'left_shoulder': (13, 11, 23),
+    'right_shoulder': (14, 12, 24),
+    'left_hip': (11, 23, 25),
+    'right_hip': (12, 24, 26),
+    'left_knee': (23, 25, 27),
+    'right_knee': (24, 26, 28),
+}
+TORSO = [11, 12, 23, 24]  # shoulders and hips
+NUM_LANDMARKS = 33
+
+
+def as_landmarks(data):
+    """Reshape (T, 99) bodypose rows into (T, 33, 3), with frames without detection (all zeros) set to NaN"""
+    lm = np.asarray(data, dtype=float).reshape(len(data), NUM_LANDMARKS, 3).copy()
+    lm[~np.any(lm != 0, axis=(1, 2))] = np.nan
+    return lm
+
+
+def joint_angles(lm):
+    """
+    Angles of the joints in JOINTS
+
+    Parameters
+    ----------
+    lm : np.ndarray, shape (T, 33, 3)
+        Landmarks
+
+    Returns
+    -------
+    angles : np.ndarray, shape (T, len(JOINTS))
+        Angles in degrees, computed in the image plane (x, y)
+
+    """
+    a, b, c = (np.array(idx) for idx in zip(*JOINTS.values()))
+    v1 = lm[:, a, :2] - lm[:, b, :2]
+    v2 = lm[:, c, :2] - lm[:, b, :2]
+    cross = v1[..., 0] * v2[..., 1] - v1[..., 1] * v2[..., 0]
+    dot = np.sum(v1 * v2, axis=-1)
+    return np.degrees(np.abs(np.arctan2(cross, dot)))
+
+
+def frame_features(landmarks, head=None, fps=30.0):
+    """
+    Compute the per-frame features of a session
+
+    Parameters
+    ----------
+    landmarks : dict
+        Person ID -> (T, 99) bodypose rows
+    head : dict, optional
+        Angle name -> (T,) head pose angles. The default is None.
+    fps : float, optional
+        Frame rate, used for the speeds. The default is 30.
+
+    Returns
+    -------
+    values : np.ndarray, shape (T, F)
+        Per-frame features. The speeds of the first frame are NaN.
+    names : list of string
+        Names of the F features
+
+    """
+    columns = []
+    names = []
+    centers = {}
+    for pid, data in landmarks.items():
+        lm = as_landmarks(data)
+        speed = np.full(lm.shape[:2], np.nan)
+        speed[1:] = np.linalg.norm(np.diff(lm[..., :2], axis=0), axis=-1) * fps
+        columns += [speed, joint_angles(lm)]
+        names += [f"p{pid}_speed_{j}" for j in range(NUM_LANDMARKS)]
+        names += [f"p{pid}_{joint}" for joint in JOINTS]
+        centers[pid] = lm[:, TORSO, :2].mean(axis=1)
+
+    pids = list(centers)
+    for i, a in enumerate(pids):
+        for b in pids[i + 1:]:
+            columns.append(np.linalg.norm(centers[a] - centers[b], axis=-1)[:, None])
+            names.append(f"dist_p{a}_p{b}")
+
+    for name, angle in (head or {}).items():
+        columns.append(np.asarray(angle, dtype=float)[:, None])
+        names.append(f"head_{name}")
+
+    return np.hstack(columns), names
+
+
+def window_features(values, window, step=1):
+    """
+    Mean and standard deviation of per-frame features over sliding windows
+
+    Parameters
+    ----------
+    values : np.ndarray, shape (T, F)
+        Per-frame features, NaN where missing
+    window : int
+        Window length in frames
+    step : int, optional
+        Stride between windows in frames. The default is 1.
+
+    Returns
+    -------
+    ends : np.ndarray, shape (N,)
+        Index of the last frame of every window
+    features : np.ndarray, shape (N, 2F)
+        Means followed by standard deviations. NaN for features without valid samples in the window.
+
+    """
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0.0)
+    zeros = np.zeros((1, values.shape[1]))
+    s1 = np.concatenate((zeros, np.cumsum(x, axis=0)))
+    s2 = np.concatenate((zeros, np.cumsum(x * x, axis=0)))
+    n = np.concatenate((zeros, np.cumsum(valid, axis=0)))
+
+    ends = np.arange(window - 1, len(values), step)
+    hi, lo = ends + 1, ends + 1 - window
+    return ends, window_stats(s1[hi] - s1[lo], s2[hi] - s2[lo], n[hi] - n[lo])
+
+
+def window_stats(s1, s2, n):
+    """Means followed by standard deviations from the sums, sums of squares and counts of the samples"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, s1 / n, np.nan)
+        var = np.where(n > 0, s2 / n - mean * mean, np.nan)
+    return np.hstack((mean, np.sqrt(np.clip(var, 0, None))))
+
+
+def feature_names(names):
+    """Names of the window features built from the names of the per-frame features"""
+    return [f"{name}_mean" for name in names] + [f"{name}_std" for name in names]
+
+
+class FeatureEngine:
+    """Window features over live pose streams, updated in O(1) per new frame"""
+
+    def __init__(self, window=30, fps=30.0):
+        """
+        Parameters
+        ----------
+        window : int, optional
+            Window length in frames. The default is 30.
+        fps : float, optional
+            Frame rate of the streams. The default is 30.
+
+        """
+        self.window = window
+        self.fps = fps
+        self.names = None
+        self.previous = None
+        self.buffer = None
+        self.pos = 0
+
+    def reset(self):
+        self.names = None
+        self.previous = None
+        self.buffer = None
+        self.pos = 0
+
+    def update(self, landmarks, head=None):
+        """
+        Add one frame and get the features of the window ending at it
+
+        Parameters
+        ----------
+        landmarks : dict
+            Person ID -> (99,) bodypose row of the new frame. The set of people must not change between calls.
+        head : dict, optional
+            Angle name -> head pose angle of the new frame. The default is None.
+
+        Returns
+        -------
+        features : np.ndarray, shape (2F,)
+            Same features as one row of `window_features` for a window ending at this frame
+
+        """
+        frame = ({pid: np.asarray(row, dtype=float).reshape(1, -1) for pid, row in landmarks.items()},
+                 {name: np.array([angle], dtype=float) for name, angle in (head or {}).items()})
+        if self.previous is None:
+            pair = frame
+        else:
+            # Features of the new frame only need the previous frame (for the speeds)
+            pair = ({pid: np.vstack((self.previous[0][pid], row)) for pid, row in frame[0].items()},
+                    {name: np.concatenate((self.previous[1][name], angle)) for name, angle in frame[1].items()})
+        values, names = frame_features(pair[0], pair[1], self.fps)
+        self.previous = frame
+        current = values[-1]
+
+        if self.buffer is None:
+            self.names = names
+            self.buffer = np.full((self.window, len(current)), np.nan)
+            self.s1 = np.zeros(len(current))
+            self.s2 = np.zeros(len(current))
+            self.n = np.zeros(len(current))
+
+        # Remove the sample that leaves the window and add the new one
+        old = self.buffer[self.pos]
+        old_valid = ~np.isnan(old)
+        self.s1 -= np.where(old_valid, old, 0.0)
+        self.s2 -= np.where(old_valid, old * old, 0.0)
+        self.n -= old_valid
+        new_valid = ~np.isnan(current)
+        self.s1 += np.where(new_valid, current, 0.0)
+        self.s2 += np.where(new_valid, current * current, 0.0)
+        self.n += new_valid
+        self.buffer[self.pos] = current
+        self.pos = (self.pos + 1) % self.window
+
+        return window_stats(self.s1, self.s2, self.n)
+
+    def batch(self, landmarks, head=None, step=1):
+        """
+        Window features of a whole session in one pass
+
+        Parameters
+        ----------
+        landmarks : dict
+            Person ID -> (T, 99) bodypose rows
+        head : dict, optional
+            Angle name -> (T,) head pose angles. The default is None.
+        step : int, optional
+            Stride between windows in frames. The default is 1.
+
+        Returns
+        -------
+        ends : np.ndarray, shape (N,)
+            Index of the last frame of every window
+        features : np.ndarray, shape (N, 2F)
+        names : list of string
+
+        """
+        values, names = frame_features(landmarks, head, self.fps)
+        ends, features = window_features(values, self.window, step)
+        return ends, features, feature_names(names)
+
+
+if __name__ == "__main__":
+    from session_store import SessionStore
+
+    parser = argparse.ArgumentParser(description="Compute sliding-window features of a session.")
+    parser.add_argument('-session', required=True, help="Session .npz built with session_store.py")
+    parser.add_argument('-window', type=int, default=30, help="Window length in frames")
+    parser.add_argument('-step', type=int, default=5, help="Stride between windows in frames")
+    parser.add_argument('-out', required=True, help="Output CSV file")
+    args = parser.parse_args()
+
+    store = SessionStore.load(args.session)
+    bodypose = [s for s in store.streams if s.startswith('bodypose/')]
+    openface = [s for s in store.streams if s.startswith('openface/')]
+    head_columns = ['pose_Rx', 'pose_Ry', 'pose_Rz']
+    view = store.aligned(sources=bodypose + openface,
+                         columns={s: head_columns for s in openface})
+
+    # Frames without detection are NaN in the aligned view, bodypose expects zeros for them
+    landmarks = {s.split('/')[1]: np.nan_to_num(view[s][0]) for s in bodypose}
+    head = {f"f{s.split('/')[1]}_{c}": view[s][0][:, k] for s in openface for k, c in enumerate(head_columns)}
+
+    engine = FeatureEngine(args.window, store.fps)
+    ends, features, names = engine.batch(landmarks, head, args.step)
+    table = np.column_stack((view['timestamp'][ends], features))
+    np.savetxt(args.out, table, delimiter=',', header=','.join(['timestamp'] + names), comments='')
+    print(f"Saved {len(ends)} windows with {len(names)} features to {args.out}")
@@ -0,0 +1,274 @@
+"""
+Compact archival format for (frames x channels) pose arrays, such as the MediaPipe `__bodypose.csv` files and the
+OpenFace CSV files.
+
+Those CSV files store float64 text for values that only need about 1e-4 precision in normalized coordinates.
+The codec stores them as:
+- fixed-point integers per channel, `round(x / step)` with `step = 2 * max_error`, so every decoded value is
+  within `max_error` of the original. Channels whose values all lie on a coarser decimal grid are stored
+  losslessly on that grid: integers (frame, face_id, success, ...) with a step of 1, and the OpenFace columns that
+  are written with 1 to 3 decimals with a step of 0.1 to 0.001. Equal values stay equal, so the repeated rows of
+  the bodypose CSV are still detected as repeated after decoding.
+- temporal deltas: the first frame of every chunk is stored as it is and the other frames as the difference with
+  the previous frame, in the smallest integer type that holds them, channel by channel and with the bytes of each
+  integer split into planes, which compresses much better than the raw values.
+- chunks of `chunk_frames` frames, each one a separate deflate-compressed member of an `.npz` file. NaN values are
+  kept with a bit mask per chunk.
+
+Decoding is a vectorized cumulative sum per chunk, and a range of frames only decompresses the chunks it overlaps.
+
+Usage:
+    python pose_codec.py -input <pose.csv> [-error 5e-5] [-chunk 1024] [-out <pose.npz>]
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+INT_TYPES = (np.int8, np.int16, np.int32, np.int64)
+MAX_DECIMALS = 6  # coarsest decimal grids tried for lossless channels
+
+
+def _smallest_int(values):
+    """Smallest signed integer type that holds every value"""
+    if values.size == 0:
+        return np.int8
+    low, high = values.min(), values.max()
+    for dtype in INT_TYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+def _shuffle(deltas):
+    """Channel-major byte planes of a (frames, channels) integer array"""
+    data = np.ascontiguousarray(deltas.T)
+    return data.view(np.uint8).reshape(-1, data.dtype.itemsize).T.copy()
+
+
+def _unshuffle(planes, dtype, n_frames, n_channels):
+    data = np.ascontiguousarray(planes.T).view(dtype).reshape(n_channels, n_frames)
+    return data.T
+
+
+def channel_steps(values, max_error):
+    """
+    Quantization step of every channel
+
+    Parameters
+    ----------
+    values : np.ndarray, shape (frames, channels)
+    max_error : float or array-like
+        Maximum absolute error per channel (a single value for all of them)
+
+    Returns
+    -------
+    steps : np.ndarray, shape (channels,)
+        2 * max_error, or the coarsest decimal step 10^-d (d <= MAX_DECIMALS) with every value of the channel on
+        its grid, if it is not finer
+
+    """
+    max_error = np.broadcast_to(np.asarray(max_error, dtype=float), (values.shape[1],))
+    steps = 2.0 * max_error
+    finite = np.where(np.isfinite(values), values, 0.0)
+    undecided = np.ones(values.shape[1], dtype=bool)
+    for decimals in range(MAX_DECIMALS + 1):
+        grid = 10.0 ** -decimals
+        scaled = finite / grid
+        on_grid = undecided & np.all(np.abs(scaled - np.round(scaled)) < 1e-6, axis=0) & (grid >= steps)
+        steps = np.where(on_grid, grid, steps)
+        undecided &= ~on_grid
+    return steps
+
+
+def encode(values, max_error=5e-5, chunk_frames=1024, columns=None):
+    """
+    Encode a pose array
+
+    Parameters
+    ----------
+    values : array-like, shape (frames, channels)
+        Pose values. NaN values are kept, infinite values are not supported.
+    max_error : float or array-like, optional
+        Maximum absolute error per channel. The default is 5e-5.
+    chunk_frames : int, optional
+        Frames per compressed chunk, the unit of range reads. The default is 1024.
+    columns : list of string, optional
+        Column names stored with the data. The default is none.
+
+    Returns
+    -------
+    arrays : dict
+        Arrays to store with np.savez_compressed (see `save`)
+
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    n_frames, n_channels = values.shape
+    if np.any(np.isinf(values)):
+        raise ValueError("Infinite values cannot be encoded")
+    steps = channel_steps(values, max_error)
+
+    nan = np.isnan(values)
+    q = np.round(np.where(nan, 0.0, values) / steps)
+    if n_frames and np.abs(q).max() >= 2**62:
+        raise ValueError("max_error is too small for the range of the values")
+    q = q.astype(np.int64)
+    if nan.any():
+        # NaN samples repeat the previous value, so they cost a zero delta
+        last = np.maximum.accumulate(np.where(~nan, np.arange(n_frames)[:, None], 0), axis=0)
+        q = np.take_along_axis(q, last, axis=0)
+
+    arrays = {'version': np.array(FORMAT_VERSION), 'shape': np.array(values.shape), 'steps': steps,
+              'chunk_frames': np.array(chunk_frames), 'columns': np.array(columns if columns is not None else [], dtype=str)}
+    for k, start in enumerate(range(0, n_frames, chunk_frames)):
+        chunk = q[start:start + chunk_frames]
+        deltas = np.diff(chunk, axis=0)
+        dtype = _smallest_int(deltas)
+        arrays[f'key{k}'] = chunk[0]
+        arrays[f'delta{k}'] = _shuffle(deltas.astype(dtype))
+        arrays[f'dtype{k}'] = np.array(np.dtype(dtype).str)
+        chunk_nan = nan[start:start + chunk_frames]
+        if chunk_nan.any():
+            arrays[f'nan{k}'] = np.packbits(chunk_nan)
+    return arrays
+
+
+def save(path, values, columns=None, max_error=5e-5, chunk_frames=1024):
+    """Encode a pose array and save it to an `.npz` file (see `encode` for the parameters)"""
+    np.savez_compressed(path, **encode(values, max_error, chunk_frames, columns))
+
+
+class PoseArchive:
+    """Encoded pose array opened for reading, decoding only the chunks that are read"""
+
+    def __init__(self, path):
+        self.data = np.load(path)
+        if int(self.data['version']) > FORMAT_VERSION:
+            raise ValueError(f"{path} was written by a newer version of the codec")
+        self.shape = tuple(int(v) for v in self.data['shape'])
+        self.steps = self.data['steps']
+        self.chunk_frames = int(self.data['chunk_frames'])
+        self.columns = [str(c) for c in self.data['columns']]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def _chunk(self, k):
+        n_frames = min(self.chunk_frames, self.shape[0] - k * self.chunk_frames)
+        n_channels = self.shape[1]
+        dtype = np.dtype(str(self.data[f'dtype{k}']))
+        deltas = _unshuffle(self.data[f'delta{k}'], dtype, n_frames - 1, n_channels)
+        q = np.empty((n_frames, n_channels), dtype=np.int64)
+        q[0] = self.data[f'key{k}']
+        np.cumsum(deltas, axis=0, dtype=np.int64, out=q[1:])
+        q[1:] += q[0]
+        values = q * self.steps
+        if f'nan{k}' in self.data.files:
+            nan = np.unpackbits(self.data[f'nan{k}'], count=n_frames * n_channels).reshape(n_frames, n_channels)
+            values[nan.astype(bool)] = np.nan
+        return values
+
+    def read(self, start=0, stop=None, columns=None):
+        """
+        Decode a range of frames
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            Frame range [start, stop). The default is every frame.
+        columns : list of string or int, optional
+            Columns to return, by name or index. The default is every column.
+
+        Returns
+        -------
+        values : np.ndarray, shape (stop - start, channels)
+
+        """
+        n_frames = self.shape[0]
+        stop = n_frames if stop is None else min(stop, n_frames)
+        start = max(0, start)
+        if columns is not None:
+            columns = [self.columns.index(c) if isinstance(c, str) else c for c in columns]
+        if stop <= start:
+            return np.zeros((0, self.shape[1] if columns is None else len(columns)))
+        first, last = start // self.chunk_frames, (stop - 1) // self.chunk_frames
+        values = np.concatenate([self._chunk(k) for k in range(first, last + 1)])
+        values = values[start - first * self.chunk_frames:stop - first * self.chunk_frames]
+        return values if columns is None else values[:, columns]
+
+
+def load(path, start=0, stop=None, columns=None):
+    """Decode an encoded pose file, or a range of it (see `PoseArchive.read`)"""
+    with PoseArchive(path) as archive:
+        return archive.read(start, stop, columns)
+
+
+def read_pose_csv(csv_path):
+    """
+    Read a pose CSV with or without a header row
+
+    Returns
+    -------
+    values : np.ndarray, shape (frames, channels)
+    columns : list of string or None
+        Column names from the header (stripped, as OpenFace pads them with spaces), None without header
+
+    """
+    with open(csv_path) as f:
+        first = f.readline().split(',')[0].strip()
+    try:
+        float(first)
+        header = None
+    except ValueError:
+        header = 0
+    data = pd.read_csv(csv_path, header=header, skipinitialspace=True)
+    columns = [str(c).strip() for c in data.columns] if header is not None else None
+    return data.to_numpy(dtype=float), columns
+
+
+def read_table(path):
+    """Read a pose CSV or an encoded pose file as a DataFrame (columns are numbered if they have no names)"""
+    if path.endswith('.npz'):
+        with PoseArchive(path) as archive:
+            return pd.DataFrame(archive.read(), columns=archive.columns or None)
+    values, columns = read_pose_csv(path)
+    return pd.DataFrame(values, columns=columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode a pose CSV into the compact archival format.")
+    parser.add_argument('-input', required=True, help="Bodypose or OpenFace CSV")
+    parser.add_argument('-error', type=float, default=5e-5, help="Maximum absolute error per value")
+    parser.add_argument('-chunk', type=int, default=1024, help="Frames per chunk")
+    parser.add_argument('-out', help="Encoded file. The default is the CSV path with .npz")
+    args = parser.parse_args()
+
+    out_path = args.out or os.path.splitext(args.input)[0] + '.npz'
+    start = time.perf_counter()
+    values, columns = read_pose_csv(args.input)
+    csv_time = time.perf_counter() - start
+    save(out_path, values, columns, args.error, args.chunk)
+
+    start = time.perf_counter()
+    decoded = load(out_path)
+    decode_time = time.perf_counter() - start
+    both = ~np.isnan(values)
+    error = np.abs(decoded[both] - values[both]).max() if both.any() else 0.0
+    csv_size, out_size = os.path.getsize(args.input), os.path.getsize(out_path)
+    print(f"{values.shape[0]} frames x {values.shape[1]} channels saved to {out_path}")
+    print(f"Size: {csv_size / 2**20:.2f} MB -> {out_size / 2**20:.2f} MB ({csv_size / out_size:.1f}x smaller)")
+    print(f"Read: CSV {csv_time * 1000:.0f} ms, decode {decode_time * 1000:.0f} ms")
+    print(f"Max error: {error:.2e}")
@@ -0,0 +1,271 @@
+"""
+Session store that joins the OpenFace and MediaPipe outputs of one recording on a common time axis.
+
+The OpenFace CSV has `frame` and `timestamp` columns, while the MediaPipe `__bodypose.csv` files only hold
+99 floats per row (one row per frame), with frames without detection either zeros or a copy of the previous
+detection. The store indexes every source by frame number and timestamp, keeps a validity mask per sample
+and caches everything in a single `.npz` file, so later queries do not parse the CSV files again.
+
+Aligned views for any time range are computed with vectorized NumPy (searchsorted for the nearest sample,
+or linear interpolation between the surrounding valid samples).
+
+Usage:
+    python session_store.py -openface <openface.csv> -bodypose <video__bodypose.csv> [...] -out <session.npz>
+"""
+
+import os
+import re
+import argparse
+import numpy as np
+import pandas as pd
+
+import pose_codec
+
+
+class Stream:
+    """Samples of one source (one face of OpenFace or one person of MediaPipe) indexed by frame and time"""
+
+    __slots__ = ('frames', 'timestamps', 'values', 'valid', 'columns')
+
+    def __init__(self, frames, timestamps, values, valid, columns):
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.valid = np.asarray(valid, dtype=bool)
+        self.columns = list(columns)
+
+    def column_index(self, columns):
+        """Indices of the given column names, or all columns if None"""
+        if columns is None:
+            return np.arange(len(self.columns))
+        return np.array([self.columns.index(c) for c in columns], dtype=int)
+
+
+def read_openface(csv_path):
+    """
+    Read an OpenFace CSV and split it into one stream per face_id
+
+    Parameters
+    ----------
+    csv_path : string
+        Path to the CSV written by FeatureExtraction or FaceLandmarkVidMulti, or to its `.npz` encoding
+        (see pose_codec.py)
+
+    Returns
+    -------
+    streams : dict
+        face_id -> Stream. OpenFace frames are 1-based, they are converted to 0-based frame indices.
+
+    """
+    data = pose_codec.read_table(csv_path) if csv_path.endswith('.npz') else pd.read_csv(csv_path, skipinitialspace=True)
+    data.columns = [c.strip() for c in data.columns]
+    if 'face_id' not in data.columns:
+        data['face_id'] = 0
+    columns = [c for c in data.columns if c not in ('frame', 'face_id', 'timestamp', 'success')]
+
+    streams = {}
+    for face_id, face in data.groupby('face_id'):
+        face = face.sort_values('frame')
+        streams[int(face_id)] = Stream(face['frame'].to_numpy() - 1,
+                                       face['timestamp'].to_numpy(),
+                                       face[columns].to_numpy(dtype=float),
+                                       face['success'].to_numpy() == 1,
+                                       columns)
+    return streams
+
+
+def bodypose_columns():
+    """Column names of the 99-column MediaPipe CSV"""
+    return [f"{axis}_{i}" for i in range(33) for axis in ('x', 'y', 'z')]
+
+
+def read_bodypose(csv_path, fps):
+    """
+    Read a MediaPipe bodypose CSV
+
+    Parameters
+    ----------
+    csv_path : string
+        Path to a `__bodypose.csv` file (one row per frame, 99 columns), or to its `.npz` encoding
+        (see pose_codec.py)
+    fps : float
+        Frame rate of the recording, used to build the timestamps
+
+    Returns
+    -------
+    stream : Stream
+        Rows that are all zeros (no detection yet) or an exact copy of the previous row (detection failure
+        filled with the previous detection) are marked as invalid.
+
+    """
+    if csv_path.endswith('.npz'):
+        values = pose_codec.load(csv_path)
+    else:
+        values = np.atleast_2d(np.loadtxt(csv_path, delimiter=','))
+    frames = np.arange(len(values))
+    repeated = np.zeros(len(values), dtype=bool)
+    repeated[1:] = np.all(values[1:] == values[:-1], axis=1)
+    valid = np.any(values != 0, axis=1) & ~repeated
+    return Stream(frames, frames / fps, values, valid, bodypose_columns())
+
+
+class SessionStore:
+    """All the pose streams of one recording"""
+
+    def __init__(self, fps=None):
+        self.fps = fps
+        self.streams = {}
+
+    def add_openface(self, csv_path, name='openface'):
+        """Add every face of an OpenFace CSV as `<name>/<face_id>`. The frame rate is taken from it if unknown."""
+        for face_id, stream in read_openface(csv_path).items():
+            self.streams[f"{name}/{face_id}"] = stream
+            if self.fps is None and len(stream.timestamps) > 1 and stream.timestamps[-1] > stream.timestamps[0]:
+                # Over the whole stream: the timestamps are rounded to the millisecond, so the steps between
+                # consecutive frames are not exact (1 / 0.042 s is 23.8 fps instead of 24)
+                self.fps = ((stream.frames[-1] - stream.frames[0])
+                            / (stream.timestamps[-1] - stream.timestamps[0]))
+
+    def add_bodypose(self, csv_path, name=None):
+        """Add a MediaPipe CSV, named `bodypose/<person>` after the `__bodypose_p<id>` suffix if present"""
+        if self.fps is None:
+            raise ValueError("The frame rate is unknown: add an OpenFace CSV first or pass fps")
+        if name is None:
+            stem = os.path.splitext(os.path.basename(csv_path))[0]
+            match = re.fullmatch(r'.*__bodypose(?:_p(\d+))?', stem)
+            person = match.group(1) if match and match.group(1) else '0'
+            name = f"bodypose/{person}"
+        self.streams[name] = read_bodypose(csv_path, self.fps)
+
+    def save(self, path):
+        """Save the session to a single `.npz` file"""
+        arrays = {'fps': np.array(self.fps), 'names': np.array(list(self.streams))}
+        for i, stream in enumerate(self.streams.values()):
+            for field in Stream.__slots__:
+                arrays[f"{i}/{field}"] = np.asarray(getattr(stream, field))
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Load a session saved with `save`"""
+        with np.load(path) as data:
+            store = cls(float(data['fps']))
+            for i, name in enumerate(data['names']):
+                store.streams[str(name)] = Stream(*(data[f"{i}/{field}"] for field in Stream.__slots__))
+        return store
+
+    def aligned(self, t0=None, t1=None, sources=None, columns=None, method='nearest', max_gap=None):
+        """
+        Get the samples of several sources on a common time axis
+
+        Parameters
+        ----------
+        t0, t1 : float, optional
+            Time range in seconds. The default is the whole session.
+        sources : list of string, optional
+            Stream names, e.g. ['openface/0', 'bodypose/0']. The default is all the streams.
+        columns : dict, optional
+            Stream name -> list of column names. The default is all the columns of every stream.
+        method : string, optional
+            'nearest' picks the closest valid sample, 'linear' interpolates between the surrounding valid
+            samples. The default is 'nearest'.
+        max_gap : float, optional
+            Samples farther than this from a valid sample (in seconds) are marked invalid. The default is
+            1.5 frames.
+
+        Returns
+        -------
+        view : dict
+            'timestamp' -> (T,) time axis on the frame grid, and for every source a tuple (values, valid)
+            with values of shape (T, C) and valid of shape (T,)
+
+        """
+        sources = list(self.streams) if sources is None else sources
+        if not sources:
+            raise ValueError("No sources to align: the session has no streams")
+        columns = columns or {}
+        max_gap = 1.5 / self.fps if max_gap is None else max_gap
+
+        t_min = min(self.streams[s].timestamps[0] for s in sources)
+        t_max = max(self.streams[s].timestamps[-1] for s in sources)
+        t0 = t_min if t0 is None else t0
+        t1 = t_max if t1 is None else t1
+        grid = np.arange(np.ceil(t0 * self.fps - 1e-6), np.floor(t1 * self.fps + 1e-6) + 1) / self.fps
+
+        view = {'timestamp': grid}
+        for name in sources:
+            stream = self.streams[name]
+            cols = stream.column_index(columns.get(name))
+            t = stream.timestamps[stream.valid]
+            v = stream.values[stream.valid][:, cols]
+            view[name] = resample(t, v, grid, method, max_gap)
+        return view
+
+
+def resample(t, v, grid, method='nearest', max_gap=np.inf):
+    """
+    Resample irregular samples onto a time grid
+
+    Parameters
+    ----------
+    t : np.ndarray, shape (N,)
+        Sorted timestamps of the valid samples
+    v : np.ndarray, shape (N, C)
+        Values of the valid samples
+    grid : np.ndarray, shape (T,)
+        Target timestamps
+    method : string, optional
+        'nearest' or 'linear'. The default is 'nearest'.
+    max_gap : float, optional
+        Maximum distance to a valid sample. The default is no limit.
+
+    Returns
+    -------
+    values : np.ndarray, shape (T, C)
+    valid : np.ndarray, shape (T,)
+
+    """
+    out = np.full((len(grid), v.shape[1]), np.nan)
+    if len(t) == 0:
+        return out, np.zeros(len(grid), dtype=bool)
+
+    right = np.clip(np.searchsorted(t, grid), 0, len(t) - 1)
+    left = np.clip(right - 1, 0, len(t) - 1)
+    d_left = np.abs(grid - t[left])
+    d_right = np.abs(t[right] - grid)
+
+    if method == 'nearest':
+        nearest = np.where(d_left <= d_right, left, right)
+        out = v[nearest]
+        valid = np.minimum(d_left, d_right) <= max_gap
+    elif method == 'linear':
+        span = t[right] - t[left]
+        w = np.where(span > 0, (grid - t[left]) / np.where(span > 0, span, 1), 0.0)
+        w = np.clip(w, 0, 1)[:, None]
+        out = v[left] * (1 - w) + v[right] * w
+        inside = (grid >= t[0]) & (grid <= t[-1])
+        valid = inside & (np.minimum(d_left, d_right) <= max_gap)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    out = np.where(valid[:, None], out, np.nan)
+    return out, valid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the OpenFace and MediaPipe outputs of one recording.")
+    parser.add_argument('-openface', nargs='*', default=[], help="OpenFace CSV files")
+    parser.add_argument('-bodypose', nargs='*', default=[], help="MediaPipe __bodypose CSV files")
+    parser.add_argument('-fps', type=float, default=None, help="Frame rate, if there is no OpenFace CSV")
+    parser.add_argument('-out', required=True, help="Output .npz file")
+    args = parser.parse_args()
+
+    store = SessionStore(args.fps)
+    for csv_path in args.openface:
+        store.add_openface(csv_path)
+    for csv_path in args.bodypose:
+        store.add_bodypose(csv_path)
+    store.save(args.out)
+    for name, stream in store.streams.items():
+        print(f"{name}: {len(stream.frames)} samples, {stream.valid.sum()} valid")
+    print(f"Saved session to {args.out}")
@@ -0,0 +1,193 @@
+"""
+Library API of the bodypose estimation, to run it in-process without going through the CSV files.
+
+`BodyposeEstimator` loads the MediaPipe models of a tier once (see model_tiers.py) and turns frames into compact
+records of a structured NumPy dtype (see `record_dtype`): frame index, timestamp, whether a pose was found and the
+landmarks as (landmarks, 3) arrays of x, y, z in normalized image coordinates. `stream` takes any iterable of BGR
+frames (None for frames that could not be decoded) and yields one record per frame, so results can be consumed
+while the video is still being read. estimate_bodypose.py calls `process` on every frame it reads and keeps the
+drawing, the CSV files and the checkpoints around it.
+
+Example:
+    from bodypose_estimator import BodyposeEstimator, video_frames
+
+    with BodyposeEstimator(tier='pose', model_complexity=0) as estimator:
+        for record in estimator.stream(video_frames('video.mp4'), fps=30):
+            if record['detected']:
+                nose = record['pose'][0]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.frame_buffers import FrameBuffers
+from utils.render_annotations import open_at
+from utils.seek_index import true_frame_count
+from model_tiers import TierModel, OUTPUTS
+
+
+def record_dtype(tier):
+    """Structured dtype of the per-frame records of a tier"""
+    fields = [('frame', np.int64), ('timestamp', np.float64), ('detected', np.bool_), ('pose', np.float64, (33, 3))]
+    if 'hands' in OUTPUTS[tier]:
+        fields += [('left_hand', np.float64, (21, 3)), ('right_hand', np.float64, (21, 3))]
+    if 'face' in OUTPUTS[tier]:
+        fields.append(('face', np.float64, (468, 3)))
+    return np.dtype(fields)
+
+
+def video_frames(video_path, start=0):
+    """
+    Frames of a video file for `stream`
+
+    Frames that cannot be decoded before the true frame count (see seek_index.py) are yielded as None, so the
+    frame indices stay aligned with the video (the convention of the bodypose CSV).
+    """
+    cap = open_at(video_path, start)
+    frame_count = true_frame_count(video_path)
+    idx = start
+    while True:
+        ret, image = cap.read()
+        if not ret:
+            if idx >= frame_count:
+                break
+            image = None
+        yield image
+        idx += 1
+    cap.release()
+
+
+class BodyposeEstimator:
+    """MediaPipe models of one tier, loaded once, producing per-frame records"""
+
+    def __init__(self, tier='holistic', model_complexity=1, min_detection_confidence=0.9, min_tracking_confidence=0.9):
+        """
+        Parameters
+        ----------
+        tier : string, optional
+            'pose', 'hands' or 'holistic' (see model_tiers.py). The default is 'holistic'.
+        model_complexity : int, optional
+            Complexity of the pose model (0, 1 or 2). The default is 1.
+        min_detection_confidence : float, optional
+            The default is 0.9.
+        min_tracking_confidence : float, optional
+            The default is 0.9.
+
+        """
+        self.tier = tier
+        self.dtype = record_dtype(tier)
+        self.model = TierModel(tier, model_complexity, min_detection_confidence, min_tracking_confidence)
+        self.buffers = FrameBuffers()
+        self.result = None  # TierResult of the last frame, for drawing
+        self.model_time = 0.0
+        self.frames = 0
+
+    @property
+    def tracking(self):
+        """Whether the models follow landmarks from the last frame (see utils/checkpoint.py)"""
+        return self.model.tracking
+
+    def process(self, image, index=0, fps=None, rgb=None):
+        """
+        Estimate the landmarks of one frame
+
+        Parameters
+        ----------
+        image : np.uint8 or None
+            BGR frame, or None if it could not be decoded (the record is then empty)
+        index : int, optional
+            Frame index. The default is 0.
+        fps : float, optional
+            Frame rate used for the timestamp. The default is None (NaN timestamps).
+        rgb : np.uint8, optional
+            RGB copy of the frame if it is already available. The default is None.
+
+        Returns
+        -------
+        record : np.ndarray
+            0-d array of dtype `self.dtype`
+
+        """
+        record = np.zeros((), dtype=self.dtype)
+        record['frame'] = index
+        record['timestamp'] = index / fps if fps else np.nan
+        self.result = None
+        if image is None and rgb is None:
+            return record
+
+        if rgb is None:
+            rgb = self.buffers.cvt_color(image, cv2.COLOR_BGR2RGB, 'rgb')
+            rgb.flags.writeable = False
+        start = time.perf_counter()
+        self.result = result = self.model.process(rgb)
+        self.model_time += time.perf_counter() - start
+        self.frames += 1
+
+        record['detected'] = result.pose is not None
+        for field, landmarks in (('pose', result.pose), ('left_hand', result.left_hand),
+                                 ('right_hand', result.right_hand), ('face', result.face)):
+            if landmarks is not None and field in self.dtype.names:
+                record[field] = [(l.x, l.y, l.z) for l in landmarks.landmark][:len(record[field])]
+        return record
+
+    def stream(self, frames, start=0, fps=None):
+        """
+        Estimate the landmarks of a sequence of frames
+
+        Parameters
+        ----------
+        frames : iterable
+            BGR frames, None for the frames that could not be decoded
+        start : int, optional
+            Index of the first frame. The default is 0.
+        fps : float, optional
+            Frame rate used for the timestamps. The default is None.
+
+        Yields
+        ------
+        record : np.ndarray
+            0-d record of every frame (see `process`). np.stack(list(records)) gives a structured array.
+
+        """
+        for index, image in enumerate(frames, start):
+            yield self.process(image, index, fps)
+
+    def report(self):
+        """Model time per frame of the tier"""
+        if not self.frames:
+            return f"Tier {self.tier}: no frames"
+        return (f"Tier {self.tier}: {self.frames} frames, {self.model_time / self.frames * 1000:.1f} ms/frame, "
+                f"{self.frames / self.model_time:.1f} fps")
+
+    def close(self):
+        self.model.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def csv_rows(record):
+    """
+    Rows of the CSV outputs of one record (see OUTPUTS in model_tiers.py)
+
+    Returns
+    -------
+    rows : dict
+        'bodypose' -> (99,) row or None if no pose was found (the CSV repeats the previous detection), and
+        'hands' -> (126,) and 'face' -> (1404,) rows for the tiers that compute them
+
+    """
+    names = record.dtype.names
+    rows = {'bodypose': record['pose'].ravel() if record['detected'] else None}
+    if 'left_hand' in names:
+        rows['hands'] = np.concatenate((record['left_hand'].ravel(), record['right_hand'].ravel()))
+    if 'face' in names:
+        rows['face'] = record['face'].ravel()
+    return rows
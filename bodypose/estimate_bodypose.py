@@ -1,11 +1,19 @@
 """
 This script processes a video file using MediaPipe's Holistic model to detect and draw landmarks for the body, hands, and face.
 It saves the processed video with the drawn landmarks and exports the landmark data to a CSV file.
+With -tier pose or -tier hands, only the pose model (and the hand model) run instead of Holistic (see model_tiers.py).
 The script can display the processed video during processing based on a command-line argument.
 You can specify the input video file through a command-line argument as well.
+With -persons N (N > 1), several people are tracked and each one gets its own CSV (see multiperson_bodypose.py).
+The multi-person mode only runs the pose tier, -tier hands or -tier holistic are rejected with it.
+With -checkpoint <seconds>, the progress is saved periodically and -resume on continues a killed run from the last
+checkpoint (see utils/checkpoint.py).
+The landmarks of every frame come from BodyposeEstimator.process (see bodypose_estimator.py), which can also be
+imported to get the landmarks in-process, without the CSV files.
 
 Usage:
-    python omni_holi01.py [-input <input_video_path>] [-display on]
+    python estimate_bodypose.py [-input <input_video_path>] [-output <output_folder>] [-display on] [-persons <max_persons>] [-budget <budget.json>] [-render off]
+                                [-checkpoint <seconds>] [-resume on] [-tier pose|hands|holistic] [-complexity 0|1|2]
 
 Last edited by Santiago Poveda Gutierrez 2024/07/12
 
@@ -13,133 +21,216 @@ Last edited by Santiago Poveda Gutierrez 2024/07/12
  
 import os
 import cv2
-import mediapipe as mp
 import numpy as np
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.thread_budget import apply_thread_budget
+from utils.frame_buffers import FrameBuffers, RowBuffer
+from utils.checkpoint import Checkpoint, VideoParts
+from utils.render_annotations import open_at
+from utils.seek_index import true_frame_count
+from model_tiers import OUTPUTS, draw_result
+from bodypose_estimator import BodyposeEstimator, csv_rows
+
 # Control variables
 resize = True
 scale_percent = 45  # percentage of original size
 default_input_video = '/home/groupwork/groupwork-tool/data/data_raw/videos/webcam/test_distance_webcam.avi'
 output_folder = '/home/groupwork/groupwork-tool/data/data_processed/videos/mediapipe/'
-display_video = False
-
-# Check command-line arguments for input video and display option
-input_video = default_input_video
-if len(sys.argv) > 1:
-    for i in range(1, len(sys.argv), 2):
-        if sys.argv[i] == '-input' and i + 1 < len(sys.argv):
-            input_video = sys.argv[i + 1]
-            print(f"Using input video: {input_video}")
-        elif sys.argv[i] == '-display' and i + 1 < len(sys.argv) and sys.argv[i + 1] == 'on':
-            display_video = True
-
-# Initialize MediaPipe and related objects
-mp_pose = mp.solutions.pose
-mp_drawing = mp.solutions.drawing_utils
-mp_holistic = mp.solutions.holistic
-data_land = np.zeros((0, 99))
-data_land2 = None
-
-# Load mp4 file
-cap = cv2.VideoCapture(input_video)  # load video file
-
-# Get the number of frames, FPS, width, and height of the video
-frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-fps = int(cap.get(cv2.CAP_PROP_FPS))
-width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-idx = 0
-
-# Prepare video writer for saving the processed video
-video_name, video_ext = os.path.basename(input_video).split('.')
-output_video_path = os.path.join(output_folder, video_name + "__bodypose." + video_ext)
-output_csv_path = os.path.join(output_folder, video_name + "__bodypose.csv")
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-out = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height))
-
-# Holistic Model and Frame Processing Loop
-with mp_holistic.Holistic(
-        min_detection_confidence=0.9,
-        min_tracking_confidence=0.9) as holistic:
-    while cap.isOpened():
-        success, image = cap.read()
-        if not success:
-            print(f'skipped: {idx=}')
-            # If the final frame, exit. Otherwise, treat as a detection failure (assign None)
-            if idx < frame_count:
-                idx += 1
-                if data_land2 is None:
-                    data_land = np.vstack((data_land, np.zeros(99)))
+
+
+def parse_args(argv):
+    """Options of the command line, with the defaults of the control variables"""
+    options = {'input_video': default_input_video, 'output_folder': output_folder, 'display_video': False,
+               'max_persons': 1,  # more than 1 switches to the multi-person mode
+               'budget_path': None,  # thread budget JSON, see utils/thread_budget.py
+               'render_video': True,  # with -render off, only the CSV is saved (render later with utils/render_annotations.py)
+               'checkpoint_every': None,  # seconds between checkpoints, None disables them
+               'resume': False,  # continue from the last checkpoint
+               'tier': None,  # 'pose', 'hands' or 'holistic' (the default), see model_tiers.py
+               'model_complexity': 1}  # pose model complexity (0, 1 or 2)
+    for i in range(1, len(argv), 2):
+        if argv[i] == '-input' and i + 1 < len(argv):
+            options['input_video'] = argv[i + 1]
+            print(f"Using input video: {argv[i + 1]}")
+        elif argv[i] == '-output' and i + 1 < len(argv):
+            options['output_folder'] = argv[i + 1]
+        elif argv[i] == '-display' and i + 1 < len(argv) and argv[i + 1] == 'on':
+            options['display_video'] = True
+        elif argv[i] == '-persons' and i + 1 < len(argv):
+            options['max_persons'] = int(argv[i + 1])
+        elif argv[i] == '-budget' and i + 1 < len(argv):
+            options['budget_path'] = argv[i + 1]
+        elif argv[i] == '-render' and i + 1 < len(argv) and argv[i + 1] == 'off':
+            options['render_video'] = False
+        elif argv[i] == '-checkpoint' and i + 1 < len(argv):
+            options['checkpoint_every'] = float(argv[i + 1])
+        elif argv[i] == '-resume' and i + 1 < len(argv) and argv[i + 1] == 'on':
+            options['resume'] = True
+        elif argv[i] == '-tier' and i + 1 < len(argv):
+            options['tier'] = argv[i + 1]
+        elif argv[i] == '-complexity' and i + 1 < len(argv):
+            options['model_complexity'] = int(argv[i + 1])
+    if options['max_persons'] > 1 and options['tier'] not in (None, 'pose'):
+        sys.exit(f"-tier {options['tier']} cannot be used with -persons {options['max_persons']}: "
+                 f"the multi-person mode only runs the pose tier")
+    return options
+
+
+def main(input_video=default_input_video, output_folder=output_folder, display_video=False, max_persons=1,
+         budget_path=None, render_video=True, checkpoint_every=None, resume=False, tier=None,
+         model_complexity=1):
+    """
+    Estimate the bodypose of a video and save the CSV files (and the annotated video)
+
+    The tier defaults to 'holistic' for one person. The multi-person mode (max_persons > 1) only runs the pose tier
+    and raises a ValueError for another one.
+    """
+    if max_persons > 1 and tier not in (None, 'pose'):
+        raise ValueError(f"The {tier} tier cannot be used with {max_persons} persons: the multi-person mode only runs "
+                         f"the pose tier")
+    tier = tier or 'holistic'
+    # Limit the threads used by this pipeline when it shares the host with others
+    budget = apply_thread_budget('bodypose', budget_path)
+
+    # Multi-person mode: one pose model per tracked person crop
+    if max_persons > 1:
+        from multiperson_bodypose import process_video_multiperson
+        process_video_multiperson(input_video, output_folder, max_persons=max_persons, display_video=display_video,
+                                  workers=budget.get('workers'), render_video=render_video,
+                                  model_complexity=model_complexity, checkpoint_every=checkpoint_every, resume=resume)
+        print("Video processing completed.")
+        return
+
+    data_land2 = None
+
+    # Load mp4 file
+    cap = cv2.VideoCapture(input_video)  # load video file
+
+    # Get the number of frames (from the seek index, the container header can be wrong), FPS, width, and height
+    frame_count = true_frame_count(input_video)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    idx = 0
+    part = 0
+
+    # Preallocated frame buffers and landmark rows, reused on every frame
+    buffers = FrameBuffers()
+    data_land = RowBuffer(99, frame_count)
+    # Hand and face rows of the tiers that compute them
+    data_extra = {name: RowBuffer(columns, frame_count) for name, columns in OUTPUTS[tier].items() if name != 'bodypose'}
+
+    video_name, video_ext = os.path.basename(input_video).split('.')
+    output_video_path = os.path.join(output_folder, video_name + "__bodypose." + video_ext)
+    output_csv_path = os.path.join(output_folder, video_name + "__bodypose.csv")
+
+    # Continue from the last checkpoint
+    checkpoint = Checkpoint(output_csv_path + '.ckpt', checkpoint_every or 60.0)
+    state = checkpoint.load() if resume else None
+    if state is not None:
+        idx, part, data_land2 = state['next_frame'], state['part'], state['data_land2']
+        for row in state['rows']:
+            data_land.append(row)
+        for name, rows in state.get('extra', {}).items():
+            for row in rows:
+                data_extra[name].append(row)
+        cap.release()
+        cap = open_at(input_video, idx)
+        print(f"Resuming from frame {idx}")
+
+    # Prepare video writer for saving the processed video, in parts closed at every checkpoint
+    if render_video:
+        out = VideoParts(output_video_path, fps, (width, height), split=checkpoint_every is not None, part=part)
+
+    # Model and Frame Processing Loop
+    with BodyposeEstimator(tier, model_complexity) as estimator:
+        while cap.isOpened():
+            success, image = buffers.read(cap)
+            if not success:
+                print(f'skipped: {idx=}')
+                # If the final frame, exit. Otherwise, treat as a detection failure (assign None)
+                if idx < frame_count:
+                    idx += 1
+                    data_land.append(np.zeros(99) if data_land2 is None else data_land2)
+                    for rows in data_extra.values():
+                        rows.append(0.0)
+                    continue
                 else:
-                    data_land = np.vstack((data_land, data_land2))
-                continue
-            else:
-                print('End of Files.')
-                break
-
-        # Image Preprocessing and Landmark Detection
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image.flags.writeable = False
-        results = holistic.process(image)
-        image.flags.writeable = True
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-
-        # Draw landmarks on the images
-        mp_drawing.draw_landmarks(
-            image, results.left_hand_landmarks, mp_holistic.HAND_CONNECTIONS)
-        mp_drawing.draw_landmarks(
-            image, results.right_hand_landmarks, mp_holistic.HAND_CONNECTIONS)
-        mp_drawing.draw_landmarks(
-            image, results.pose_landmarks, mp_holistic.POSE_CONNECTIONS)
-
-        # Get coordinates
-        if results.pose_landmarks is None:
-            if data_land2 is None:
-                data_land = np.vstack((data_land, np.zeros(99)))
+                    print('End of Files.')
+                    break
+
+            # Landmark Detection
+            # The RGB copy goes to its own buffer, so the BGR frame can be drawn on without converting back
+            record = estimator.process(image, idx, fps)
+
+            # Draw landmarks on the images
+            if render_video:
+                draw_result(image, estimator.result)
+
+            # Get coordinates, a frame without pose repeats the previous detection
+            rows = csv_rows(record)
+            if rows['bodypose'] is None:
+                data_land.append(np.zeros(99) if data_land2 is None else data_land2)
             else:
-                data_land = np.vstack((data_land, data_land2))
-        else:
-            data_land2 = np.zeros((1, 3))
-            for x in range(0, 33):
-                data1 = results.pose_landmarks.landmark[x].x
-                data2 = results.pose_landmarks.landmark[x].y
-                data3 = results.pose_landmarks.landmark[x].z
-                keydata = np.hstack((data1, data2, data3)).reshape(1, -1)
-                data_land2 = np.hstack((data_land2, keydata))
-            data_land2 = data_land2[:, 3:]
-            data_land = np.vstack((data_land, data_land2))
-
-        # Increment the frame number
-        idx += 1
-
-        if resize:
-            # Resize image before displaying
-            display_width = int(image.shape[1] * scale_percent / 100)
-            display_height = int(image.shape[0] * scale_percent / 100)
-            dim = (display_width, display_height)
-            display_image = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
-        else:
-            display_image = image
-
-        # Write the frame to the output video
-        out.write(image)
-
-        if display_video:
-            # Display image until "esc" key is pressed
-            cv2.imshow('MediaPipe Holistic', display_image)
-            if cv2.waitKey(5) & 0xFF == 27:
-                break
-
-# Save data_land to the new CSV file
-np.savetxt(output_csv_path, data_land, delimiter=',')
-print(f"Saved bodypose data to {output_csv_path}")
-
-cap.release()
-out.release()
-print(f"Saved processed video to {output_video_path}")
-
-if display_video:
-    cv2.destroyAllWindows()
-
-print("Video processing completed.")
+                data_land2 = rows['bodypose']
+                data_land.append(data_land2)
+            for name, row in data_extra.items():
+                row.append(rows[name])
+
+            # Increment the frame number
+            idx += 1
+
+            # Write the frame to the output video
+            if render_video:
+                out.write(image)
+
+            # Resuming is exact from a frame where MediaPipe has no pose to follow, as a fresh model
+            tracking = estimator.tracking
+            if checkpoint_every is not None and checkpoint.due(safe=not tracking):
+                if render_video:
+                    part = out.split()
+                checkpoint.save({'next_frame': idx, 'part': part, 'rows': data_land.array().copy(),
+                                 'extra': {name: rows.array().copy() for name, rows in data_extra.items()},
+                                 'data_land2': data_land2, 'exact': not tracking})
+
+            if display_video:
+                if resize:
+                    # Resize image before displaying
+                    display_width = int(image.shape[1] * scale_percent / 100)
+                    display_height = int(image.shape[0] * scale_percent / 100)
+                    dim = (display_width, display_height)
+                    display_image = buffers.resize(image, dim, 'display', interpolation=cv2.INTER_AREA)
+                else:
+                    display_image = image
+                # Display image until "esc" key is pressed
+                cv2.imshow('MediaPipe Holistic', display_image)
+                if cv2.waitKey(5) & 0xFF == 27:
+                    break
+
+        print(f"{estimator.report()} (complexity {model_complexity})")
+
+    # Save data_land to the new CSV file
+    np.savetxt(output_csv_path, data_land.array(), delimiter=',')
+    print(f"Saved bodypose data to {output_csv_path}")
+    for name, rows in data_extra.items():
+        extra_csv_path = os.path.join(output_folder, f"{video_name}__{name}.csv")
+        np.savetxt(extra_csv_path, rows.array(), delimiter=',')
+        print(f"Saved {name} data to {extra_csv_path}")
+    if idx >= frame_count:
+        checkpoint.remove()
+
+    cap.release()
+    if render_video:
+        out.release()
+        print(f"Saved processed video to {output_video_path}")
+
+    if display_video:
+        cv2.destroyAllWindows()
+
+    print("Video processing completed.")
+
+
+if __name__ == "__main__":
+    main(**parse_args(sys.argv))
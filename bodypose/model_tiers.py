@@ -0,0 +1,165 @@
+"""
+Model tiers for the bodypose estimation, from the cheapest to the most complete:
+- `pose`: MediaPipe Pose only (33 landmarks)
+- `hands`: MediaPipe Pose and MediaPipe Hands (33 + 2 x 21 landmarks)
+- `holistic`: MediaPipe Holistic (33 + 2 x 21 + 468 face landmarks), the model estimate_bodypose.py always ran before
+
+Every tier saves the 99 pose columns of `__bodypose.csv`. The tiers that compute the hands also save
+`__hands.csv` (x, y, z of the 21 landmarks of the left hand, then of the right hand, 126 columns) and holistic also
+saves `__face.csv` (x, y, z of the 468 face mesh landmarks, 1404 columns). Hands and faces that are not found
+are rows of zeros. Left and right are the hands of the person: MediaPipe Hands labels them as seen in a mirrored
+image, so its labels are swapped to match Holistic.
+
+The throughput of each tier can be compared on a clip before choosing one for a job:
+
+Usage:
+    python model_tiers.py -input <video> [-frames 300] [-tiers pose hands holistic] [-complexity 0 1 2]
+"""
+
+import time
+import argparse
+import cv2
+import mediapipe as mp
+
+TIERS = ('pose', 'hands', 'holistic')
+POSE_COLUMNS = 33 * 3
+HAND_COLUMNS = 21 * 3
+FACE_COLUMNS = 468 * 3
+
+# Outputs saved by every tier, with their number of columns
+OUTPUTS = {
+    'pose': {'bodypose': POSE_COLUMNS},
+    'hands': {'bodypose': POSE_COLUMNS, 'hands': 2 * HAND_COLUMNS},
+    'holistic': {'bodypose': POSE_COLUMNS, 'hands': 2 * HAND_COLUMNS, 'face': FACE_COLUMNS},
+}
+
+
+class TierResult:
+    """Landmarks of one frame. The landmarks that the tier does not compute or did not find are None."""
+
+    __slots__ = ('pose', 'left_hand', 'right_hand', 'face')
+
+    def __init__(self, pose=None, left_hand=None, right_hand=None, face=None):
+        self.pose = pose
+        self.left_hand = left_hand
+        self.right_hand = right_hand
+        self.face = face
+
+
+class TierModel:
+    """MediaPipe models of one tier"""
+
+    def __init__(self, tier='holistic', model_complexity=1, min_detection_confidence=0.9, min_tracking_confidence=0.9):
+        """
+        Parameters
+        ----------
+        tier : string, optional
+            'pose', 'hands' or 'holistic'. The default is 'holistic'.
+        model_complexity : int, optional
+            Complexity of the pose model (0, 1 or 2). The hand model only has 0 and 1. The default is 1.
+        min_detection_confidence : float, optional
+            The default is 0.9.
+        min_tracking_confidence : float, optional
+            The default is 0.9.
+
+        """
+        if tier not in TIERS:
+            raise ValueError(f"Unknown tier {tier}, use one of {TIERS}")
+        self.tier = tier
+        self.outputs = OUTPUTS[tier]
+        confidence = dict(min_detection_confidence=min_detection_confidence, min_tracking_confidence=min_tracking_confidence)
+        self.hands = None
+        if tier == 'holistic':
+            self.model = mp.solutions.holistic.Holistic(model_complexity=model_complexity, **confidence)
+        else:
+            self.model = mp.solutions.pose.Pose(model_complexity=model_complexity, **confidence)
+            if tier == 'hands':
+                self.hands = mp.solutions.hands.Hands(max_num_hands=2, model_complexity=min(model_complexity, 1),
+                                                      **confidence)
+        # Whether a model follows landmarks from the previous frame (state that a checkpoint cannot save)
+        self.tracking = False
+
+    def process(self, rgb):
+        """
+        Run the models on an RGB frame
+
+        Returns
+        -------
+        result : TierResult
+
+        """
+        results = self.model.process(rgb)
+        result = TierResult(results.pose_landmarks)
+        if self.tier == 'holistic':
+            result.left_hand, result.right_hand = results.left_hand_landmarks, results.right_hand_landmarks
+            result.face = results.face_landmarks
+        elif self.hands is not None:
+            hands = self.hands.process(rgb)
+            for landmarks, handedness in zip(hands.multi_hand_landmarks or [], hands.multi_handedness or []):
+                # Hands labels assume a mirrored image
+                if handedness.classification[0].label == 'Left':
+                    result.right_hand = landmarks
+                else:
+                    result.left_hand = landmarks
+        self.tracking = any(l is not None for l in (result.pose, result.left_hand, result.right_hand))
+        return result
+
+    def close(self):
+        self.model.close()
+        if self.hands is not None:
+            self.hands.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def draw_result(image, result):
+    """Draw the pose and hands of a TierResult, as estimate_bodypose.py always did"""
+    drawing = mp.solutions.drawing_utils
+    drawing.draw_landmarks(image, result.left_hand, mp.solutions.hands.HAND_CONNECTIONS)
+    drawing.draw_landmarks(image, result.right_hand, mp.solutions.hands.HAND_CONNECTIONS)
+    drawing.draw_landmarks(image, result.pose, mp.solutions.pose.POSE_CONNECTIONS)
+
+
+def benchmark(input_video, tier, model_complexity, frames=300):
+    """
+    Time the models of a tier on the first frames of a video
+
+    Returns
+    -------
+    ms_per_frame : float
+        Model time per frame, without decoding
+
+    """
+    cap = cv2.VideoCapture(input_video)
+    elapsed, n = 0.0, 0
+    with TierModel(tier, model_complexity) as model:
+        while n < frames:
+            ret, image = cap.read()
+            if not ret:
+                break
+            rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            start = time.perf_counter()
+            model.process(rgb)
+            elapsed += time.perf_counter() - start
+            n += 1
+    cap.release()
+    return elapsed / max(n, 1) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the throughput of the bodypose model tiers.")
+    parser.add_argument('-input', required=True, help="Input video")
+    parser.add_argument('-frames', type=int, default=300, help="Frames per tier")
+    parser.add_argument('-tiers', nargs='+', default=list(TIERS), choices=TIERS)
+    parser.add_argument('-complexity', nargs='+', type=int, default=[0, 1, 2], choices=[0, 1, 2])
+    args = parser.parse_args()
+
+    print(f"{'tier':>9} {'complexity':>10} {'ms/frame':>9} {'fps':>7}")
+    for tier in args.tiers:
+        for complexity in args.complexity:
+            ms = benchmark(args.input, tier, complexity, args.frames)
+            print(f"{tier:>9} {complexity:>10} {ms:9.1f} {1000 / ms:7.1f}")
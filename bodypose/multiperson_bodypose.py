@@ -0,0 +1,363 @@
+"""
+Multi-person bodypose estimation with MediaPipe Pose running on person crops.
+
+MediaPipe Holistic/Pose only follows a single person per image. This module detects person regions with
+OpenCV's HOG people detector on a downscaled copy of the frame, keeps the identities of the people across
+frames with an IoU tracker (utils/box_tracker.py) and runs one MediaPipe Pose instance per tracked person on
+a fixed-size crop. The pose instances run in parallel worker threads (MediaPipe releases the GIL while its
+graph runs), so the cost per frame grows with the number of people and not with the frame resolution.
+
+Between detections, the box of each person is refined from the landmarks found in the previous frame, so the
+detector only needs to run every few frames.
+
+The landmarks are mapped back to normalized coordinates of the full frame, so each person's CSV has the same
+99-column layout (x, y, z of the 33 pose landmarks) as the single-person output of estimate_bodypose.py.
+
+Usage:
+    python estimate_bodypose.py -input <input_video_path> -persons 3 [-display on]
+"""
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import mediapipe as mp
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.box_tracker import BoxTracker
+from utils.frame_buffers import FrameBuffers
+from utils.checkpoint import Checkpoint, VideoParts
+from utils.render_annotations import open_at
+from utils.seek_index import true_frame_count
+
+mp_pose = mp.solutions.pose
+mp_drawing = mp.solutions.drawing_utils
+
+NUM_COLUMNS = 99  # 33 landmarks x (x, y, z)
+
+
+def get_people_detector():
+    """
+    Get OpenCV's default HOG people detector
+
+    Returns
+    -------
+    hog : cv2.HOGDescriptor
+        HOG descriptor with the default people SVM loaded
+
+    """
+    hog = cv2.HOGDescriptor()
+    hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    return hog
+
+
+def find_people(img, hog, detect_width=640, threshold=0.5, nms_threshold=0.4):
+    """
+    Find the people in an image
+
+    Parameters
+    ----------
+    img : np.uint8
+        Image to find people in
+    hog : cv2.HOGDescriptor
+        People detector
+    detect_width : int, optional
+        The image is downscaled to this width before detection. The default is 640.
+    threshold : float, optional
+        Minimum SVM score of a detection. The default is 0.5.
+    nms_threshold : float, optional
+        IoU threshold for non-maximum suppression. The default is 0.4.
+
+    Returns
+    -------
+    people : np.ndarray, shape (N, 4)
+        Boxes of the people as (x, y, x1, y1) in full-resolution pixel coordinates
+
+    """
+    h, w = img.shape[:2]
+    scale = min(1.0, detect_width / w)
+    small = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else img
+    rects, weights = hog.detectMultiScale(small, winStride=(8, 8), padding=(8, 8), scale=1.05)
+    if len(rects) == 0:
+        return np.zeros((0, 4))
+
+    weights = np.asarray(weights, dtype=float).ravel()
+    keep = cv2.dnn.NMSBoxes([list(map(int, r)) for r in rects], weights.tolist(), threshold, nms_threshold)
+    keep = np.asarray(keep, dtype=int).ravel()
+    rects = np.asarray(rects, dtype=float)[keep]
+    boxes = np.column_stack((rects[:, 0], rects[:, 1], rects[:, 0] + rects[:, 2], rects[:, 1] + rects[:, 3]))
+    return boxes / scale
+
+
+def pad_box(box, shape, margin=0.15):
+    """Enlarge a box by a margin relative to its size and clip it to the image"""
+    h, w = shape[:2]
+    x, y, x1, y1 = box
+    dx = (x1 - x) * margin
+    dy = (y1 - y) * margin
+    return np.array([max(0, x - dx), max(0, y - dy), min(w, x1 + dx), min(h, y1 + dy)]).astype(int)
+
+
+class PersonPoseWorker:
+    """MediaPipe Pose instance that follows one tracked person"""
+
+    def __init__(self, crop_size=256, model_complexity=1,
+                 min_detection_confidence=0.5, min_tracking_confidence=0.5):
+        """
+        Parameters
+        ----------
+        crop_size : int, optional
+            Length of the longer side of the crop fed to the model. The default is 256.
+        model_complexity : int, optional
+            MediaPipe Pose model complexity (0, 1 or 2). The default is 1.
+        min_detection_confidence : float, optional
+            The default is 0.5.
+        min_tracking_confidence : float, optional
+            The default is 0.5.
+
+        """
+        self.crop_size = crop_size
+        self.buffers = FrameBuffers()
+        self.pose = mp_pose.Pose(model_complexity=model_complexity,
+                                 min_detection_confidence=min_detection_confidence,
+                                 min_tracking_confidence=min_tracking_confidence)
+
+    def process(self, image, box):
+        """
+        Run the pose model on the crop of a person
+
+        Parameters
+        ----------
+        image : np.uint8
+            Full BGR frame
+        box : array-like
+            Padded box of the person as (x, y, x1, y1)
+
+        Returns
+        -------
+        landmarks : NormalizedLandmarkList or None
+            Pose landmarks in normalized coordinates of the crop, or None if no pose was found
+
+        """
+        x, y, x1, y1 = box
+        crop = image[y:y1, x:x1]
+        if crop.size == 0:
+            return None
+        ch, cw = crop.shape[:2]
+        scale = self.crop_size / max(ch, cw)
+        crop = self.buffers.resize(crop, (max(1, int(cw * scale)), max(1, int(ch * scale))), 'crop',
+                                   interpolation=cv2.INTER_AREA)
+        crop = self.buffers.cvt_color(crop, cv2.COLOR_BGR2RGB, 'crop')
+        crop.flags.writeable = False
+        results = self.pose.process(crop)
+        if results.pose_landmarks is None:
+            return None
+        return results.pose_landmarks
+
+    def close(self):
+        self.pose.close()
+
+
+def crop_to_frame(landmarks, box, shape):
+    """
+    Map landmarks from normalized crop coordinates to normalized full-frame coordinates
+
+    Parameters
+    ----------
+    landmarks : NormalizedLandmarkList
+        Pose landmarks returned by MediaPipe for the crop
+    box : array-like
+        Crop box as (x, y, x1, y1)
+    shape : tuple
+        Shape of the full frame
+
+    Returns
+    -------
+    row : np.ndarray, shape (99,)
+        x, y, z of the 33 landmarks in the 99-column CSV layout
+
+    """
+    h, w = shape[:2]
+    x, y, x1, y1 = box
+    lm = np.array([(l.x, l.y, l.z) for l in landmarks.landmark])
+    lm[:, 0] = (x + lm[:, 0] * (x1 - x)) / w
+    lm[:, 1] = (y + lm[:, 1] * (y1 - y)) / h
+    lm[:, 2] = lm[:, 2] * (x1 - x) / w  # z uses the same scale as x
+    return lm.ravel()
+
+
+def landmarks_box(row, shape):
+    """Bounding box in pixels of the landmarks of one person (99-column row)"""
+    h, w = shape[:2]
+    lm = row.reshape(-1, 3)
+    xs = np.clip(lm[:, 0], 0, 1) * w
+    ys = np.clip(lm[:, 1], 0, 1) * h
+    return np.array([xs.min(), ys.min(), xs.max(), ys.max()])
+
+
+def fill_forward(frames, rows, n_frames):
+    """
+    Build a (n_frames, 99) array from the frames where a person was detected
+
+    Frames before the first detection are zeros. Later frames without detection repeat the previous
+    detection, as in the single-person output.
+    """
+    data = np.zeros((n_frames, NUM_COLUMNS))
+    if not frames:
+        return data
+    valid = np.zeros(n_frames, dtype=bool)
+    valid[frames] = True
+    data[frames] = rows
+    last = np.maximum.accumulate(np.where(valid, np.arange(n_frames), -1))
+    return np.where((last >= 0)[:, None], data[np.maximum(last, 0)], 0.0)
+
+
+def process_video_multiperson(input_video, output_folder, max_persons=3, detect_every=10,
+                              crop_size=256, model_complexity=1, display_video=False, workers=None,
+                              render_video=True, checkpoint_every=None, resume=False):
+    """
+    Estimate the bodypose of several people in a video
+
+    Parameters
+    ----------
+    input_video : string
+        Path to the input video
+    output_folder : string
+        Folder where the annotated video and the per-person CSV files are saved
+    max_persons : int, optional
+        Maximum number of people tracked at the same time. The default is 3.
+    detect_every : int, optional
+        Run the people detector every this many frames. The default is 10.
+    crop_size : int, optional
+        Size of the crops fed to the pose models. The default is 256.
+    model_complexity : int, optional
+        MediaPipe Pose model complexity. The default is 1.
+    display_video : bool, optional
+        Display the processed video. The default is False.
+    workers : int, optional
+        Number of worker threads running the pose models. The default is max_persons.
+    render_video : bool, optional
+        Draw the boxes and landmarks and save the annotated video. The default is True.
+    checkpoint_every : float, optional
+        Seconds between checkpoints. The default is None (no checkpoints).
+    resume : bool, optional
+        Continue from the last checkpoint. The default is False. The tracker and the detections are restored, but
+        the pose models of the tracked people start again from a detection on their crop, because MediaPipe cannot
+        save the pose it follows. Unless nobody was tracked at the checkpoint, the landmarks after it can differ
+        slightly from an uninterrupted run.
+
+    Returns
+    -------
+    data : dict
+        Person ID -> (frames, 99) landmark array
+
+    """
+    cap = cv2.VideoCapture(input_video)
+    frame_count = true_frame_count(input_video)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    video_name, video_ext = os.path.basename(input_video).split('.')
+    output_video_path = os.path.join(output_folder, video_name + "__bodypose." + video_ext)
+
+    hog = get_people_detector()
+    buffers = FrameBuffers()
+    tracker = BoxTracker(max_missed=3, max_tracks=max_persons)
+    pose_workers = {}
+    detections = {}  # person ID -> ([frame indices], [rows])
+    idx = 0
+    part = 0
+
+    checkpoint = Checkpoint(os.path.join(output_folder, video_name + "__bodypose_multi.ckpt"), checkpoint_every or 60.0)
+    state = checkpoint.load() if resume else None
+    if state is not None:
+        idx, part, tracker, detections = state['next_frame'], state['part'], state['tracker'], state['detections']
+        cap.release()
+        cap = open_at(input_video, idx)
+        print(f"Resuming from frame {idx}")
+        if not state['exact']:
+            print(f"{len(tracker.active())} people were tracked at the checkpoint: their pose models restart from a "
+                  f"detection, the landmarks of the next frames can differ slightly from an uninterrupted run")
+    if render_video:
+        out = VideoParts(output_video_path, fps, (width, height), split=checkpoint_every is not None, part=part)
+
+    with ThreadPoolExecutor(max_workers=workers or max_persons) as pool:
+        while cap.isOpened():
+            success, image = buffers.read(cap)
+            if not success:
+                print(f'skipped: {idx=}')
+                if idx < frame_count:
+                    idx += 1
+                    continue
+                print('End of Files.')
+                break
+
+            # Detect people every few frames, otherwise follow the boxes refined from the landmarks
+            if idx % detect_every == 0:
+                tracker.update(find_people(image, hog))
+            tracks = tracker.active()
+
+            for pid in list(pose_workers):
+                if pid not in tracks:
+                    pose_workers.pop(pid).close()
+            for pid in tracks:
+                if pid not in pose_workers:
+                    pose_workers[pid] = PersonPoseWorker(crop_size, model_complexity)
+
+            boxes = {pid: pad_box(box, image.shape) for pid, box in tracks.items()}
+            futures = {pid: pool.submit(pose_workers[pid].process, image, boxes[pid]) for pid in tracks}
+            # Wait for every crop before drawing on the frame
+            results = {pid: future.result() for pid, future in futures.items()}
+
+            for pid, landmarks in results.items():
+                x, y, x1, y1 = boxes[pid]
+                if render_video:
+                    cv2.rectangle(image, (x, y), (x1, y1), (0, 255, 0), 2)
+                    cv2.putText(image, str(pid), (x, y + 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                if landmarks is None:
+                    continue
+                row = crop_to_frame(landmarks, boxes[pid], image.shape)
+                frames, rows = detections.setdefault(pid, ([], []))
+                frames.append(idx)
+                rows.append(row)
+                tracker.set_box(pid, landmarks_box(row, image.shape))
+                if render_video:
+                    mp_drawing.draw_landmarks(image[y:y1, x:x1], landmarks, mp_pose.POSE_CONNECTIONS)
+
+            idx += 1
+            if render_video:
+                out.write(image)
+
+            # The tracker and detections are saved as they are, the pose models only when none is running (exact).
+            # With people always in view, waiting for that only delays the checkpoints, so they are taken on time.
+            if checkpoint_every is not None and checkpoint.due():
+                if render_video:
+                    part = out.split()
+                checkpoint.save({'next_frame': idx, 'part': part, 'tracker': tracker, 'detections': detections,
+                                 'exact': not pose_workers})
+
+            if display_video:
+                cv2.imshow('MediaPipe Pose (multi-person)', image)
+                if cv2.waitKey(5) & 0xFF == 27:
+                    break
+
+    for worker in pose_workers.values():
+        worker.close()
+    cap.release()
+    if render_video:
+        out.release()
+        print(f"Saved processed video to {output_video_path}")
+    if display_video:
+        cv2.destroyAllWindows()
+
+    data = {}
+    for pid, (frames, rows) in sorted(detections.items()):
+        data[pid] = fill_forward(frames, np.array(rows), idx)
+        output_csv_path = os.path.join(output_folder, f"{video_name}__bodypose_p{pid}.csv")
+        np.savetxt(output_csv_path, data[pid], delimiter=',')
+        print(f"Saved bodypose data of person {pid} to {output_csv_path}")
+    if idx >= frame_count:
+        checkpoint.remove()
+    return data
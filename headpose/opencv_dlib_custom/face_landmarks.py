@@ -71,7 +71,7 @@ def move_box(box, offset):
         bottom_y = box[3] + offset[1]
         return [left_x, top_y, right_x, bottom_y]
 
-def detect_marks(img, model, face):
+def detect_marks(img, model, face, buffers=None):
     """
     Find the facial landmarks in an image from the faces
 
@@ -83,6 +83,8 @@ def detect_marks(img, model, face):
         Loaded facial landmark model
     face : list
         Face coordinates (x, y, x1, y1) in which the landmarks are to be found
+    buffers : FrameBuffers, optional
+        Reusable buffers (utils/frame_buffers.py) for the 128x128 crop. The default is None.
 
     Returns
     -------
@@ -107,8 +109,13 @@ def detect_marks(img, model, face):
     
     face_img = img[facebox[1]: facebox[3],
                      facebox[0]: facebox[2]]
-    face_img = cv2.resize(face_img, (128, 128))
-    face_img = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)
+    if buffers is not None:
+        # Resize into the reusable crop and convert it in place
+        face_img = buffers.resize(face_img, (128, 128), 'face_crop')
+        face_img = buffers.cvt_color(face_img, cv2.COLOR_BGR2RGB, 'face_crop')
+    else:
+        face_img = cv2.resize(face_img, (128, 128))
+        face_img = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)
     
     # # Actual detection.
     predictions = model.signatures["predict"](
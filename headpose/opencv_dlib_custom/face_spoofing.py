@@ -0,0 +1,370 @@
+"""
+Face anti-spoofing (liveness) stage, to drop printed and screen faces before the head pose analysis.
+
+models/face_spoofing.pkl is the ExtraTreesClassifier of the Proctoring-AI project this folder is adapted from. It
+classifies a face crop from the 256-bin histograms of its YCrCb and LUV channels (1536 features), each histogram
+scaled to a maximum of 255; class 1 is a spoof and faces are rejected at a probability of 0.7 or more. The file was
+written by Python 2 with scikit-learn 0.19 and its bundled joblib, which current scikit-learn cannot load, so
+`load_spoofing_model` reads the arrays of the trees directly and `TreeEnsemble` evaluates them with NumPy, every
+crop of a batch and every tree level at once.
+
+Scoring every face of every frame would cost more than the rest of the pipeline. `LivenessFilter` tracks the faces
+(utils/box_tracker.py) and scores each track only a few times:
+- a new track is scored `samples` times, `sample_every` frames apart, and gets a verdict from the mean probability
+  (more samples, up to `max_samples`, while the mean is within `margin` of the threshold);
+- a track with a verdict is re-scored once every `recheck_every` frames, and its verdict is reopened if the new
+  probability drifts more than `drift` from the mean;
+- a track that resets (lost and found again by the tracker) starts over with a new ID.
+The crops of all the tracks scored in a frame go through the model in one call, cut from the frame at the
+resolution of the video even when the faces were detected on a downsampled copy, since the histograms the model was
+trained on change with the resolution. Faces of tracks without verdict yet are kept, faces of spoof tracks are
+dropped. `state` and `restore` save and restore the tracks and their verdicts, without the model.
+
+Usage:
+    python face_spoofing.py -input <video> [-frames 300]
+"""
+
+import os
+import sys
+import time
+import pickle
+import argparse
+import numpy as np
+import cv2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from utils.box_tracker import BoxTracker
+
+HEADPOSE_DIR = os.path.dirname(os.path.abspath(__file__))
+SPOOFING_MODEL = os.path.join(HEADPOSE_DIR, 'models', 'face_spoofing.pkl')
+SPOOF_THRESHOLD = 0.7
+
+
+class _State:
+    """Attributes of a pickled scikit-learn object, without scikit-learn"""
+
+    def __init__(self, *args):
+        self.args = args
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class _ArrayWrapper(_State):
+    """Array written by joblib after its pickled description"""
+
+
+class _SklearnUnpickler(pickle._Unpickler):
+    """Unpickler of the joblib format of face_spoofing.pkl: scikit-learn classes are replaced by _State and the
+    raw data of every array is read from the stream right after its wrapper"""
+
+    dispatch = dict(pickle._Unpickler.dispatch)
+
+    def find_class(self, module, name):
+        if module.endswith('numpy_pickle') and name == 'NumpyArrayWrapper':
+            return _ArrayWrapper
+        if module.startswith('sklearn'):
+            return type(name, (_State,), {})
+        return super().find_class(module, name)
+
+    def load_build(self):
+        pickle._Unpickler.load_build(self)
+        wrapper = self.stack[-1]
+        if isinstance(wrapper, _ArrayWrapper):
+            dtype = wrapper.dtype
+            if dtype.hasobject:
+                array = self.load()
+            else:
+                count = int(np.prod(wrapper.shape))
+                array = np.frombuffer(self.read(count * dtype.itemsize), dtype=dtype, count=count)
+                array = array.reshape(wrapper.shape, order=wrapper.order)
+            self.stack[-1] = array
+
+    dispatch[pickle.BUILD[0]] = load_build
+
+
+class TreeEnsemble:
+    """predict_proba of a scikit-learn forest of decision trees, in NumPy"""
+
+    def __init__(self, trees, classes):
+        """
+        Parameters
+        ----------
+        trees : list of tuple
+            (left, right, feature, threshold, proba, max_depth) of every tree, proba being the normalized class
+            distribution of every node
+        classes : np.ndarray
+
+        """
+        self.classes = classes
+        # All the trees in one node table, with the node indices of each tree offset
+        offsets = np.cumsum([0] + [len(t[0]) for t in trees[:-1]])
+        self.roots = offsets
+        self.left = np.concatenate([np.where(t[0] >= 0, t[0] + o, -1) for t, o in zip(trees, offsets)])
+        self.right = np.concatenate([np.where(t[1] >= 0, t[1] + o, -1) for t, o in zip(trees, offsets)])
+        self.feature = np.concatenate([np.maximum(t[2], 0) for t in trees])
+        self.threshold = np.concatenate([t[3] for t in trees])
+        self.proba = np.concatenate([t[4] for t in trees])
+        self.max_depth = max(int(t[5]) for t in trees)
+
+    def predict_proba(self, X):
+        """
+        Class probabilities of a batch
+
+        Parameters
+        ----------
+        X : np.ndarray, shape (N, features)
+
+        Returns
+        -------
+        proba : np.ndarray, shape (N, classes)
+            Mean of the leaf distributions of the trees
+
+        """
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, None]
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            inner = self.left[node] >= 0
+            if not inner.any():
+                break
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(inner, np.where(go_left, self.left[node], self.right[node]), node)
+        return self.proba[node].mean(axis=1)
+
+
+def load_spoofing_model(path=SPOOFING_MODEL):
+    """Load the trees of face_spoofing.pkl as a TreeEnsemble"""
+    with open(path, 'rb') as f:
+        forest = _SklearnUnpickler(f, encoding='latin1').load()
+    trees = []
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        nodes, values = tree.nodes, tree.values[:, 0, :]
+        proba = values / np.maximum(values.sum(axis=1, keepdims=True), 1e-12)
+        # scikit-learn compares float32 features with float32 thresholds
+        trees.append((nodes['left_child'], nodes['right_child'], nodes['feature'],
+                      nodes['threshold'].astype(np.float32), proba, tree.max_depth))
+    return TreeEnsemble(trees, np.asarray(forest.classes_))
+
+
+def spoof_features(img, boxes):
+    """
+    Features of face_spoofing.pkl for face crops
+
+    Parameters
+    ----------
+    img : np.uint8
+        BGR image
+    boxes : array-like, shape (N, 4)
+        Face boxes (x, y, x1, y1)
+
+    Returns
+    -------
+    features : np.ndarray, shape (N, 1536)
+        Histograms of the Y, Cr, Cb, L, U and V channels, each one scaled to a maximum of 255. Crops outside
+        the image are rows of NaN.
+
+    """
+    h, w = img.shape[:2]
+    features = np.full((len(boxes), 6 * 256), np.nan, dtype=np.float32)
+    for k, (x, y, x1, y1) in enumerate(np.asarray(boxes, dtype=int).reshape(-1, 4)):
+        roi = img[max(y, 0):min(y1, h), max(x, 0):min(x1, w)]
+        if roi.size == 0:
+            continue
+        hists = []
+        for code in (cv2.COLOR_BGR2YCrCb, cv2.COLOR_BGR2LUV):
+            converted = cv2.cvtColor(roi, code)
+            hists += [cv2.calcHist([converted], [c], None, [256], [0, 256]).ravel() for c in range(3)]
+        hists = np.array(hists)
+        features[k] = (hists * (255.0 / hists.max(axis=1, keepdims=True))).ravel()
+    return features
+
+
+class _TrackVerdict:
+    """Spoof probabilities of one track"""
+
+    __slots__ = ('scores', 'verdict', 'last')
+
+    def __init__(self):
+        self.scores = []
+        self.verdict = None  # True for live, False for spoof, None while undecided
+        self.last = -np.inf  # frame of the last score
+
+
+class LivenessFilter:
+    """Anti-spoofing verdict per tracked face, scoring each track only a few times"""
+
+    def __init__(self, model=None, threshold=SPOOF_THRESHOLD, samples=3, max_samples=8, sample_every=5,
+                 margin=0.1, recheck_every=300, drift=0.25, max_batch=8):
+        """
+        Parameters
+        ----------
+        model : TreeEnsemble, optional
+            The default is None (models/face_spoofing.pkl).
+        threshold : float, optional
+            Spoof probability from which a face is rejected. The default is 0.7.
+        samples : int, optional
+            Scores of a new track before its verdict. The default is 3.
+        max_samples : int, optional
+            Scores of a track whose mean stays close to the threshold. The default is 8.
+        sample_every : int, optional
+            Frames between two scores of an undecided track. The default is 5.
+        margin : float, optional
+            Distance of the mean to the threshold required for a verdict before max_samples. The default is 0.1.
+        recheck_every : int, optional
+            Frames between two scores of a track with a verdict. The default is 300.
+        drift : float, optional
+            Change of the probability at a re-check that reopens the verdict. The default is 0.25.
+        max_batch : int, optional
+            Crops scored per frame at most, undecided tracks first. The default is 8.
+
+        """
+        self.model = model if model is not None else load_spoofing_model()
+        self.spoof_column = list(self.model.classes).index(1)
+        self.threshold = threshold
+        self.samples = samples
+        self.max_samples = max_samples
+        self.sample_every = sample_every
+        self.margin = margin
+        self.recheck_every = recheck_every
+        self.drift = drift
+        self.max_batch = max_batch
+        self.tracker = BoxTracker(max_missed=5)
+        self.tracks = {}
+        self.time = 0.0
+        self.frames = 0
+        self.crops = 0
+        self.batches = 0
+
+    def _due(self, state, frame_idx):
+        interval = self.sample_every if state.verdict is None else self.recheck_every
+        return frame_idx - state.last >= interval
+
+    def _score(self, state, proba, frame_idx):
+        state.last = frame_idx
+        if state.verdict is not None:
+            mean = np.mean(state.scores)
+            if abs(proba - mean) <= self.drift:
+                state.scores.append(proba)
+                return
+            # The face changed since the verdict (other person on the track, spoof shown later): start over
+            state.scores, state.verdict = [], None
+        state.scores.append(proba)
+        mean = np.mean(state.scores)
+        n = len(state.scores)
+        if n >= self.max_samples or (n >= self.samples and abs(mean - self.threshold) >= self.margin):
+            state.verdict = bool(mean < self.threshold)
+
+    def filter(self, img, faces, frame_idx, scale=1.0):
+        """
+        Drop the faces of the tracks judged as spoofs
+
+        Parameters
+        ----------
+        img : np.uint8
+            BGR frame at the resolution of the video, the crops are scored from it
+        faces : list
+            Face boxes (x, y, x1, y1) in the coordinates of the frame the faces were detected in
+        frame_idx : int
+        scale : float, optional
+            Scale of the frame the faces were detected in relative to img. The default is 1.
+
+        Returns
+        -------
+        faces : list
+            The faces that are live or not judged yet
+
+        """
+        start = time.perf_counter()
+        boxes = np.asarray(faces, dtype=float).reshape(-1, 4) / scale
+        tracks = self.tracker.update(boxes)
+        for track_id in list(self.tracks):
+            if track_id not in self.tracker.ids:
+                del self.tracks[track_id]
+        face_tracks = [next((i for i, box in tracks.items() if np.array_equal(box, b)), None) for b in boxes]
+
+        # Tracks to score in this frame, the undecided ones first
+        due = []
+        for k, track_id in enumerate(face_tracks):
+            if track_id is None:
+                continue
+            state = self.tracks.setdefault(track_id, _TrackVerdict())
+            if self._due(state, frame_idx):
+                due.append((state.verdict is not None, k, state))
+        due = sorted(due, key=lambda d: d[0])[:self.max_batch]
+        if due:
+            features = spoof_features(img, boxes[[k for _, k, _ in due]])
+            valid = ~np.isnan(features).any(axis=1)
+            if valid.any():
+                proba = self.model.predict_proba(features[valid])[:, self.spoof_column]
+                for (_, _, state), p in zip([d for d, v in zip(due, valid) if v], proba):
+                    self._score(state, float(p), frame_idx)
+                self.crops += int(valid.sum())
+                self.batches += 1
+
+        kept = [face for face, track_id in zip(faces, face_tracks)
+                if track_id is None or self.tracks[track_id].verdict is not False]
+        self.time += time.perf_counter() - start
+        self.frames += 1
+        return kept
+
+    def state(self):
+        """Tracks, verdicts and statistics to save in a checkpoint, without the model"""
+        return {'tracker': self.tracker, 'tracks': self.tracks, 'time': self.time, 'frames': self.frames,
+                'crops': self.crops, 'batches': self.batches}
+
+    def restore(self, state):
+        """Continue from a `state` of a previous run, with the model of this filter"""
+        self.tracker, self.tracks = state['tracker'], state['tracks']
+        self.time, self.frames, self.crops, self.batches = (state['time'], state['frames'], state['crops'],
+                                                            state['batches'])
+
+    def verdicts(self):
+        """Track ID -> True (live), False (spoof) or None (undecided) for the current tracks"""
+        return {track_id: state.verdict for track_id, state in self.tracks.items()}
+
+    def report(self, frame_time=None):
+        """Scoring statistics and time share of the stage"""
+        if not self.frames:
+            return "Anti-spoofing: no frames"
+        text = (f"Anti-spoofing: {self.crops} crops scored in {self.batches} batches over {self.frames} frames, "
+                f"{self.time / self.frames * 1000:.2f} ms/frame")
+        if frame_time:
+            text += f", {self.time / frame_time * 100:.1f}% of the frame time"
+        return text
+
+
+if __name__ == "__main__":
+    from face_detector import get_face_detector, find_faces
+
+    parser = argparse.ArgumentParser(description="Anti-spoofing verdicts of the tracked faces of a video.")
+    parser.add_argument('-input', required=True, help="Input video")
+    parser.add_argument('-frames', type=int, default=300, help="Frames to process")
+    args = parser.parse_args()
+
+    face_model = get_face_detector(os.path.join(HEADPOSE_DIR, 'models', 'res10_300x300_ssd_iter_140000.caffemodel'),
+                                   os.path.join(HEADPOSE_DIR, 'models', 'deploy.prototxt'))
+    liveness = LivenessFilter()
+    cap = cv2.VideoCapture(args.input)
+    detect_time, every_frame_time, faces_seen, dropped = 0.0, 0.0, 0, 0
+    for frame_idx in range(args.frames):
+        ret, img = cap.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+        faces = find_faces(img, face_model)
+        detect_time += time.perf_counter() - start
+        kept = liveness.filter(img, faces, frame_idx)
+        faces_seen += len(faces)
+        dropped += len(faces) - len(kept)
+        # Cost of scoring every face of every frame, for comparison
+        start = time.perf_counter()
+        if faces:
+            liveness.model.predict_proba(np.nan_to_num(spoof_features(img, faces)))
+        every_frame_time += time.perf_counter() - start
+    cap.release()
+
+    print(liveness.report(detect_time + liveness.time))
+    print(f"{faces_seen} faces, {dropped} dropped as spoofs. Verdicts: {liveness.verdicts()}")
+    print(f"Scoring every face: {every_frame_time / max(liveness.frames, 1) * 1000:.2f} ms/frame")
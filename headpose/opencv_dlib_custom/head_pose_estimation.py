@@ -7,143 +7,54 @@ It also displays the angles of head rotation in degrees and prints messages indi
 
 This script is adapted from the Proctoring-AI project on GitHub: https://github.com/vardanagarwal/Proctoring-AI.git
 
+The per-face steps (solvePnP, pose lines and angles, drawing, CSV rows) are in headpose_core.py and the models run
+through HeadposeEstimator (headpose_estimator.py), called on every frame.
+
 Author: Santiago Poveda Gutiérrez
 Date: 2024-06-20
 """
 
 import os
+import sys
 import argparse
 import logging
 import warnings
-import math
 import numpy as np
 import cv2
-from face_detector import get_face_detector, find_faces
-from face_landmarks import get_landmark_model, detect_marks
+from online_classifier import OnlineClassifier, RuleModel, SklearnModel, frame_features
+from headpose_core import head_directions, save_headpose_csv
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from utils.box_tracker import BoxTracker
+from utils.thread_budget import apply_thread_budget
+from utils.frame_buffers import FrameBuffers
+from utils.checkpoint import Checkpoint, VideoParts
+from utils.render_annotations import open_at
 
 INPUT_FOLDER = "../../data/data_raw/videos"
 DEFAULT_VIDEO = "test_1min_1p.avi"
 OUTPUT_FOLDER = "../../data/data_processed/videos/opencv_dlib_custom"
 
-def get_2d_points(img, rotation_vector, translation_vector, camera_matrix, val):
-    """Return the 3D points present as 2D for making annotation box"""
-    point_3d = []
-    dist_coeffs = np.zeros((4,1))
-    rear_size = val[0]
-    rear_depth = val[1]
-    point_3d.append((-rear_size, -rear_size, rear_depth))
-    point_3d.append((-rear_size, rear_size, rear_depth))
-    point_3d.append((rear_size, rear_size, rear_depth))
-    point_3d.append((rear_size, -rear_size, rear_depth))
-    point_3d.append((-rear_size, -rear_size, rear_depth))
-    
-    front_size = val[2]
-    front_depth = val[3]
-    point_3d.append((-front_size, -front_size, front_depth))
-    point_3d.append((-front_size, front_size, front_depth))
-    point_3d.append((front_size, front_size, front_depth))
-    point_3d.append((front_size, -front_size, front_depth))
-    point_3d.append((-front_size, -front_size, front_depth))
-    point_3d = np.array(point_3d, dtype=float).reshape(-1, 3)
-    
-    # Map to 2d img points
-    (point_2d, _) = cv2.projectPoints(point_3d,
-                                    rotation_vector,
-                                    translation_vector,
-                                    camera_matrix,
-                                    dist_coeffs)
-    point_2d = np.int32(point_2d.reshape(-1, 2))
-    return point_2d
-
-def draw_annotation_box(img, rotation_vector, translation_vector, camera_matrix,
-                        rear_size=300, rear_depth=0, front_size=500, front_depth=400,
-                        color=(255, 255, 0), line_width=2):
-    """
-    Draw a 3D anotation box on the face for head pose estimation
-
-    Parameters
-    ----------
-    img : np.unit8
-        Original Image.
-    rotation_vector : Array of float64
-        Rotation Vector obtained from cv2.solvePnP
-    translation_vector : Array of float64
-        Translation Vector obtained from cv2.solvePnP
-    camera_matrix : Array of float64
-        The camera matrix
-    rear_size : int, optional
-        Size of rear box. The default is 300.
-    rear_depth : int, optional
-        The default is 0.
-    front_size : int, optional
-        Size of front box. The default is 500.
-    front_depth : int, optional
-        Front depth. The default is 400.
-    color : tuple, optional
-        The color with which to draw annotation box. The default is (255, 255, 0).
-    line_width : int, optional
-        line width of lines drawn. The default is 2.
-
-    Returns
-    -------
-    None.
-
-    """
-    
-    rear_size = 1
-    rear_depth = 0
-    front_size = img.shape[1]
-    front_depth = front_size*2
-    val = [rear_size, rear_depth, front_size, front_depth]
-    point_2d = get_2d_points(img, rotation_vector, translation_vector, camera_matrix, val)
-    # # Draw all the lines
-    cv2.polylines(img, [point_2d], True, color, line_width, cv2.LINE_AA)
-    cv2.line(img, tuple(point_2d[1]), tuple(
-        point_2d[6]), color, line_width, cv2.LINE_AA)
-    cv2.line(img, tuple(point_2d[2]), tuple(
-        point_2d[7]), color, line_width, cv2.LINE_AA)
-    cv2.line(img, tuple(point_2d[3]), tuple(
-        point_2d[8]), color, line_width, cv2.LINE_AA)
-    
-    
-def head_pose_points(img, rotation_vector, translation_vector, camera_matrix):
-    """
-    Get the points to estimate head pose sideways    
-
-    Parameters
-    ----------
-    img : np.unit8
-        Original Image.
-    rotation_vector : Array of float64
-        Rotation Vector obtained from cv2.solvePnP
-    translation_vector : Array of float64
-        Translation Vector obtained from cv2.solvePnP
-    camera_matrix : Array of float64
-        The camera matrix
-
-    Returns
-    -------
-    (x, y) : tuple
-        Coordinates of line to estimate head pose
-
-    """
-    rear_size = 1
-    rear_depth = 0
-    front_size = img.shape[1]
-    front_depth = front_size*2
-    val = [rear_size, rear_depth, front_size, front_depth]
-    point_2d = get_2d_points(img, rotation_vector, translation_vector, camera_matrix, val)
-    y = (point_2d[5] + point_2d[8])//2
-    x = point_2d[2]
-    
-    return (x, y)
 
 def main():
     parser = argparse.ArgumentParser(description="Head Pose Estimation")
     parser.add_argument('-i', '--input', type=str, help='Path to input video file')
     parser.add_argument('-v', '--verbose', type=str, choices=['cam', 'war', 'all'], help='Verbosity level: cam, war, all')
+    parser.add_argument('-c', '--classify', action='store_true', help='Label the tracked faces with the online action classifier')
+    parser.add_argument('--classifier_model', type=str, help='Pickled scikit-learn classifier to use instead of the default rules')
+    parser.add_argument('--budget', type=float, default=5.0, help='Classification latency budget per frame in milliseconds')
+    parser.add_argument('--thread_budget', type=str, help='Thread budget JSON (see utils/thread_budget.py)')
+    parser.add_argument('--no_render', action='store_true', help='Only save the headpose CSV, render the video later with utils/render_annotations.py')
+    parser.add_argument('--checkpoint', type=float, help='Save a checkpoint every this many seconds (video files only)')
+    parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint')
+    parser.add_argument('--out_dir', type=str, default=OUTPUT_FOLDER, help='Output folder')
+    parser.add_argument('--liveness', action='store_true', help='Drop printed and screen faces with the anti-spoofing stage (see face_spoofing.py)')
+    parser.add_argument('--min_face', type=int, help='Run the models at the smallest resolution that keeps faces this many pixels wide (see resolution_controller.py)')
     args = parser.parse_args()
 
+    # Limit OpenCV and TensorFlow threads before the models are loaded
+    apply_thread_budget('headpose', args.thread_budget)
+
     if args.verbose:
         if args.verbose == 'war':
             logging.basicConfig(level=logging.WARNING)
@@ -159,145 +70,156 @@ def main():
         logging.basicConfig(level=logging.ERROR)
         warnings.filterwarnings("ignore", category=UserWarning, module='tensorflow')
 
+    video_path = None  # only video files can be checkpointed and resumed
     if args.input:
         if os.path.isfile(args.input):
+            video_path = args.input
             cap = cv2.VideoCapture(args.input)
             print(f"Using video file: {args.input}")
             # Get the filename and extension
             filename, ext = os.path.splitext(os.path.basename(args.input))
             # Create the output video file path
-            output_video_path = os.path.join(OUTPUT_FOLDER, f"{filename}_headpose{ext}")
+            output_video_path = os.path.join(args.out_dir, f"{filename}_headpose{ext}")
         else:
-            cap = cv2.VideoCapture(os.path.join(INPUT_FOLDER, DEFAULT_VIDEO))
+            video_path = os.path.join(INPUT_FOLDER, DEFAULT_VIDEO)
+            cap = cv2.VideoCapture(video_path)
             print(f"Input video file not found. Using default video file: {DEFAULT_VIDEO}")
             filename, ext = os.path.splitext(os.path.basename(DEFAULT_VIDEO))
-            output_video_path = os.path.join(OUTPUT_FOLDER, f"{filename}_headpose{ext}")
+            output_video_path = os.path.join(args.out_dir, f"{filename}_headpose{ext}")
 
     else:
         cap = cv2.VideoCapture(0)
         if not cap.isOpened():
-            cap = cv2.VideoCapture(os.path.join(INPUT_FOLDER, DEFAULT_VIDEO))
+            video_path = os.path.join(INPUT_FOLDER, DEFAULT_VIDEO)
+            cap = cv2.VideoCapture(video_path)
             print(f"Webcam not found. Using default video file: {DEFAULT_VIDEO}")
             filename, ext = os.path.splitext(os.path.basename(DEFAULT_VIDEO))
         else:
             print("Using webcam")
             filename, ext = "webcam", ".avi"
-        output_video_path = os.path.join(OUTPUT_FOLDER, f"{filename}_headpose{ext}")
+        output_video_path = os.path.join(args.out_dir, f"{filename}_headpose{ext}")
+    output_csv_path = os.path.join(args.out_dir, f"{filename}_headpose.csv")
+    render = not args.no_render
+    checkpointing = args.checkpoint is not None and video_path is not None
+
+    # Models load once, the frames below are only read, passed to the estimator and drawn
+    from headpose_estimator import HeadposeEstimator, draw_record, csv_rows
+    from resolution_controller import ResolutionController
+    from face_spoofing import LivenessFilter
+    controller = ResolutionController(args.min_face) if args.min_face else None
+    liveness = LivenessFilter() if args.liveness else None
+    estimator = HeadposeEstimator(controller=controller, liveness=liveness)
+
+    # Online action classification on the tracked faces
+    classifier = None
+    if args.classify:
+        model = SklearnModel(args.classifier_model) if args.classifier_model else RuleModel()
+        classifier = OnlineClassifier(model, budget_ms=args.budget)
+        tracker = BoxTracker(max_missed=5)
+    frames = 0
+    buffers = FrameBuffers()
+    rows = []
+    part = 0
+
+    # Continue from the last checkpoint. Every frame is processed on its own, so the resumed rows are identical.
+    checkpoint = Checkpoint(output_csv_path + '.ckpt', args.checkpoint or 60.0)
+    state = checkpoint.load() if args.resume and video_path is not None else None
+    if state is not None:
+        frames, rows, part = state['frames'], state['rows'], state['part']
+        estimator.frames, estimator.pose_time = frames, state['pose_time']
+        estimator.controller = state.get('controller', controller)
+        if liveness is not None and state.get('liveness') is not None:
+            # Tracks and verdicts only, the model was loaded above
+            liveness.restore(state['liveness'])
+        if classifier is not None:
+            classifier, tracker = state['classifier'], state['tracker']
+        cap.release()
+        # The first read below only gets the image size, so position it on the last processed frame
+        cap = open_at(video_path, frames)
+        print(f"Resuming from frame {frames + 1}")
 
-    face_model = get_face_detector()
-    landmark_model = get_landmark_model()
-    
     ret, img = cap.read()
     if not ret:
         print("Error: Unable to read video source")
         return
 
-    size = img.shape
     font = cv2.FONT_HERSHEY_SIMPLEX 
-    # 3D model points.
-    model_points = np.array([
-                                (0.0, 0.0, 0.0),             # Nose tip
-                                (0.0, -330.0, -65.0),        # Chin
-                                (-225.0, 170.0, -135.0),     # Left eye left corner
-                                (225.0, 170.0, -135.0),      # Right eye right corne
-                                (-150.0, -150.0, -125.0),    # Left Mouth corner
-                                (150.0, -150.0, -125.0)      # Right mouth corner
-                            ])
 
-    # Camera internals
-    focal_length = size[1]
-    center = (size[1]/2, size[0]/2)
-    camera_matrix = np.array(
-                            [[focal_length, 0, center[0]],
-                            [0, focal_length, center[1]],
-                            [0, 0, 1]], dtype = "double"
-                            )
-    
     # Get the video properties
     fps = cap.get(cv2.CAP_PROP_FPS)
     frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     
     # Set up the video writer
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # Codec
-    out = cv2.VideoWriter(output_video_path, fourcc, fps, (frame_width, frame_height))
-    print(f"Writing output to: {output_video_path}")
+    if render:
+        out = VideoParts(output_video_path, fps, (frame_width, frame_height), split=checkpointing, part=part)
+        print(f"Writing output to: {output_video_path}")
       
     while True:
-        ret, img = cap.read()
+        ret, img = buffers.read(cap)
         if ret == True:
-            faces = find_faces(img, face_model)
+            # The first frame was read above to get the image size
+            faces = estimator.process(img, frames + 1)
+            rows.extend(csv_rows(faces))
+            if classifier is not None:
+                # Keep an ID per face so each one has its own rolling window
+                tracks = tracker.update(faces['box'])
+                for stream_id in list(classifier.buffers):
+                    if stream_id not in tracker.ids:
+                        classifier.drop(stream_id)
             for face in faces:
-                marks = detect_marks(img, landmark_model, face)
-                # mark_detector.draw_marks(img, marks, color=(0, 255, 0))
-                image_points = np.array([
-                                        marks[30],     # Nose tip
-                                        marks[8],      # Chin
-                                        marks[36],     # Left eye left corner
-                                        marks[45],     # Right eye right corne
-                                        marks[48],     # Left Mouth corner
-                                        marks[54]      # Right mouth corner
-                                    ], dtype="double")
-                dist_coeffs = np.zeros((4,1)) # Assuming no lens distortion
-                (success, rotation_vector, translation_vector) = cv2.solvePnP(model_points, image_points, camera_matrix, dist_coeffs, flags=cv2.SOLVEPNP_UPNP)
-                
-                
-                # Project a 3D point (0, 0, 1000.0) onto the image plane.
-                # We use this to draw a line sticking out of the nose
-                
-                (nose_end_point2D, jacobian) = cv2.projectPoints(np.array([(0.0, 0.0, 1000.0)]), rotation_vector, translation_vector, camera_matrix, dist_coeffs)
-                
-                for p in image_points:
-                    cv2.circle(img, (int(p[0]), int(p[1])), 3, (0,0,255), -1)
-                
-                
-                p1 = ( int(image_points[0][0]), int(image_points[0][1]))
-                p2 = ( int(nose_end_point2D[0][0][0]), int(nose_end_point2D[0][0][1]))
-                x1, x2 = head_pose_points(img, rotation_vector, translation_vector, camera_matrix)
-
-                cv2.line(img, p1, p2, (0, 255, 255), 2)
-                cv2.line(img, tuple(x1), tuple(x2), (255, 255, 0), 2)
-                # for (x, y) in marks:
-                #     cv2.circle(img, (x, y), 4, (255, 255, 0), -1)
-                # cv2.putText(img, str(p1), p1, font, 1, (0, 255, 255), 1)
-                try:
-                    m = (p2[1] - p1[1])/(p2[0] - p1[0])
-                    ang1 = int(math.degrees(math.atan(m)))
-                except:
-                    ang1 = 90
-
-                try:
-                    m = (x2[1] - x1[1])/(x2[0] - x1[0])
-                    ang2 = int(math.degrees(math.atan(-1/m)))
-                except:
-                    ang2 = 90
-                    
-                    # print('div by zero error')
-                if ang1 >= 48:
-                    logging.info('Head down')
-                    cv2.putText(img, 'Head down', (30, 30), font, 2, (255, 255, 128), 3)
-                elif ang1 <= -48:
-                    logging.info('Head up')
-                    cv2.putText(img, 'Head up', (30, 30), font, 2, (255, 255, 128), 3)
-                
-                if ang2 >= 48:
-                    logging.info('Head right')
-                    cv2.putText(img, 'Head right', (90, 30), font, 2, (255, 255, 128), 3)
-                elif ang2 <= -48:
-                    logging.info('Head left')
-                    cv2.putText(img, 'Head left', (90, 30), font, 2, (255, 255, 128), 3)
-                
-                cv2.putText(img, str(ang1), tuple(p1), font, 2, (128, 255, 255), 3)
-                cv2.putText(img, str(ang2), tuple(x1), font, 2, (255, 255, 128), 3)
-            cv2.imshow('img', img)
-            out.write(img)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+                pitch, yaw = np.degrees(face['euler'][:2])
+                for direction, _ in head_directions(pitch, yaw):
+                    logging.info(direction)
+                if render:
+                    # mark_detector.draw_marks(img, face['marks'], color=(0, 255, 0))
+                    draw_record(img, face)
+
+                if classifier is not None:
+                    stream_id = next((i for i, box in tracks.items() if np.array_equal(box, face['box'])), None)
+                    if stream_id is not None:
+                        classifier.push(stream_id, frame_features(pitch, yaw, face['box'], face['marks']))
+            frames += 1
+
+            if classifier is not None:
+                previous = {i: list(labels) for i, labels in classifier.labels.items()}
+                labels = classifier.step()
+                for stream_id, face_labels in labels.items():
+                    if face_labels != previous.get(stream_id):
+                        logging.info(f'Face {stream_id}: {", ".join(face_labels) or "no action"}')
+                    if render and stream_id in tracks and face_labels:
+                        x, y = int(tracks[stream_id][0]), int(tracks[stream_id][3])
+                        cv2.putText(img, ', '.join(face_labels), (x, y + 30), font, 1, (0, 128, 255), 2)
+            if render:
+                cv2.imshow('img', img)
+                out.write(img)
+            if checkpointing and checkpoint.due():
+                if render:
+                    part = out.split()
+                checkpoint.save({'next_frame': frames + 1, 'frames': frames, 'rows': rows, 'pose_time': estimator.pose_time,
+                                 'part': part, 'classifier': classifier, 'tracker': tracker if classifier is not None else None,
+                                 'controller': estimator.controller,
+                                 'liveness': liveness.state() if liveness is not None else None})
+            if render and cv2.waitKey(1) & 0xFF == ord('q'):
                 break
         else:
+            checkpoint.remove()
             break
-    cv2.destroyAllWindows()
     cap.release()
-    out.release()
+    if render:
+        cv2.destroyAllWindows()
+        out.release()
+
+    save_headpose_csv(output_csv_path, rows)
+    print(f"Saved headpose data to {output_csv_path}")
+
+    print(estimator.report())
+    if estimator.controller is not None:
+        print(estimator.controller.report())
+    if estimator.liveness is not None:
+        print(estimator.liveness.report(estimator.pose_time))
+    if classifier is not None:
+        print(classifier.report())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,250 @@
+"""
+Per-face steps of the head pose pipeline: 3D model, camera matrix, solvePnP, pose lines and angles, drawing and
+rows of the headpose CSV.
+
+They are shared by head_pose_estimation.py (the script), headpose_estimator.py (the library API), pose_sweep.py and
+utils/render_annotations.py, so that none of them imports the script and its models. The geometry of all the faces
+of a frame at once is in pose_geometry.py.
+"""
+
+import numpy as np
+import cv2
+import pose_geometry
+
+# 3D model points.
+MODEL_POINTS = np.array([
+                            (0.0, 0.0, 0.0),             # Nose tip
+                            (0.0, -330.0, -65.0),        # Chin
+                            (-225.0, 170.0, -135.0),     # Left eye left corner
+                            (225.0, 170.0, -135.0),      # Right eye right corne
+                            (-150.0, -150.0, -125.0),    # Left Mouth corner
+                            (150.0, -150.0, -125.0)      # Right mouth corner
+                        ])
+
+# Columns of the headpose CSV: one row per face and frame. ang1 and ang2 are the legacy line angles, pitch, yaw and
+# roll (degrees) come from the rotation matrix, see pose_geometry.py
+HEADPOSE_COLUMNS = (['frame', 'face', 'x', 'y', 'x1', 'y1', 'ang1', 'ang2', 'rx', 'ry', 'rz', 'tx', 'ty', 'tz']
+                    + [f'p{i}_{axis}' for i in range(len(MODEL_POINTS)) for axis in ('x', 'y')]
+                    + ['pitch', 'yaw', 'roll'])
+
+# Pitch or yaw beyond which the head is turned up, down, left or right, in degrees (0.35 rad as the event index)
+DIRECTION_ANGLE = 20
+
+def get_2d_points(img, rotation_vector, translation_vector, camera_matrix, val):
+    """Return the 3D points present as 2D for making annotation box"""
+    rear_size, rear_depth, front_size, front_depth = val
+    # Corners of the rear and front squares, see pose_geometry.py
+    point_3d = np.concatenate((pose_geometry.REAR_BOX * [rear_size, rear_size, 0] + [0, 0, rear_depth],
+                               pose_geometry.FRONT_BOX * [front_size, front_size, 0] + [0, 0, front_depth]))
+
+    # Map to 2d img points
+    point_2d = pose_geometry.project(point_3d, rotation_vector, translation_vector, camera_matrix)[0]
+    return point_2d.astype(np.int32)
+
+def draw_annotation_box(img, rotation_vector, translation_vector, camera_matrix,
+                        rear_size=300, rear_depth=0, front_size=500, front_depth=400,
+                        color=(255, 255, 0), line_width=2):
+    """
+    Draw a 3D anotation box on the face for head pose estimation
+
+    Parameters
+    ----------
+    img : np.unit8
+        Original Image.
+    rotation_vector : Array of float64
+        Rotation Vector obtained from cv2.solvePnP
+    translation_vector : Array of float64
+        Translation Vector obtained from cv2.solvePnP
+    camera_matrix : Array of float64
+        The camera matrix
+    rear_size : int, optional
+        Size of rear box. The default is 300.
+    rear_depth : int, optional
+        The default is 0.
+    front_size : int, optional
+        Size of front box. The default is 500.
+    front_depth : int, optional
+        Front depth. The default is 400.
+    color : tuple, optional
+        The color with which to draw annotation box. The default is (255, 255, 0).
+    line_width : int, optional
+        line width of lines drawn. The default is 2.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    rear_size = 1
+    rear_depth = 0
+    front_size = img.shape[1]
+    front_depth = front_size*2
+    val = [rear_size, rear_depth, front_size, front_depth]
+    point_2d = get_2d_points(img, rotation_vector, translation_vector, camera_matrix, val)
+    # # Draw all the lines
+    cv2.polylines(img, [point_2d], True, color, line_width, cv2.LINE_AA)
+    cv2.line(img, tuple(point_2d[1]), tuple(
+        point_2d[6]), color, line_width, cv2.LINE_AA)
+    cv2.line(img, tuple(point_2d[2]), tuple(
+        point_2d[7]), color, line_width, cv2.LINE_AA)
+    cv2.line(img, tuple(point_2d[3]), tuple(
+        point_2d[8]), color, line_width, cv2.LINE_AA)
+    
+    
+def head_pose_points(img, rotation_vector, translation_vector, camera_matrix):
+    """
+    Get the points to estimate head pose sideways    
+
+    Parameters
+    ----------
+    img : np.unit8
+        Original Image.
+    rotation_vector : Array of float64
+        Rotation Vector obtained from cv2.solvePnP
+    translation_vector : Array of float64
+        Translation Vector obtained from cv2.solvePnP
+    camera_matrix : Array of float64
+        The camera matrix
+
+    Returns
+    -------
+    (x, y) : tuple
+        Coordinates of line to estimate head pose
+
+    """
+    rear_size = 1
+    rear_depth = 0
+    front_size = img.shape[1]
+    front_depth = front_size*2
+    val = [rear_size, rear_depth, front_size, front_depth]
+    point_2d = get_2d_points(img, rotation_vector, translation_vector, camera_matrix, val)
+    y = (point_2d[5] + point_2d[8])//2
+    x = point_2d[2]
+    
+    return (x, y)
+
+def get_camera_matrix(size):
+    """Approximate camera matrix of an image of the given shape (focal length = image width)"""
+    focal_length = size[1]
+    center = (size[1]/2, size[0]/2)
+    return np.array(
+                    [[focal_length, 0, center[0]],
+                    [0, focal_length, center[1]],
+                    [0, 0, 1]], dtype = "double"
+                    )
+
+def solve_pose(marks, camera_matrix, pnp_flags=None):
+    """
+    Solve the head pose from the 68 facial landmarks
+
+    Returns
+    -------
+    image_points : Array of float64
+        The 6 landmarks matching MODEL_POINTS
+    rotation_vector : Array of float64
+    translation_vector : Array of float64
+
+    """
+    image_points = np.array([
+                            marks[30],     # Nose tip
+                            marks[8],      # Chin
+                            marks[36],     # Left eye left corner
+                            marks[45],     # Right eye right corne
+                            marks[48],     # Left Mouth corner
+                            marks[54]      # Right mouth corner
+                        ], dtype="double")
+    dist_coeffs = np.zeros((4,1)) # Assuming no lens distortion
+    if pnp_flags is None:
+        pnp_flags = cv2.SOLVEPNP_UPNP
+    (success, rotation_vector, translation_vector) = cv2.solvePnP(MODEL_POINTS, image_points, camera_matrix, dist_coeffs, flags=pnp_flags)
+    return image_points, rotation_vector, translation_vector
+
+def head_angles(img, image_points, rotation_vector, translation_vector, camera_matrix):
+    """
+    Get the legacy up/down and left/right angles of the head from the projected pose lines
+
+    Returns
+    -------
+    ang1 : int
+        Up/down angle of the nose line in degrees
+    ang2 : int
+        Left/right angle in degrees
+    (p1, p2) : tuple
+        Line sticking out of the nose
+    (x1, x2) : tuple
+        Line used for the left/right angle
+
+    """
+    # The line sticking out of the nose goes to the projection of (0, 0, 1000.0),
+    # see pose_geometry.py for all the faces of a frame at once
+    lines = pose_geometry.head_lines(image_points[:1], rotation_vector, translation_vector, camera_matrix, img.shape[1])
+    ang1, ang2 = pose_geometry.line_angles(lines)
+    p1, p2, x1, x2 = (tuple(int(v) for v in point) for point in lines[0])
+    return int(ang1[0]), int(ang2[0]), (p1, p2), (x1, x2)
+
+def pose_degrees(rotation_vector):
+    """Pitch, yaw and roll of the head in degrees from the rotation matrix (see pose_geometry.openface_angles)"""
+    return np.degrees(pose_geometry.openface_angles(np.ravel(rotation_vector)))[0]
+
+def head_directions(pitch, yaw):
+    """Head direction messages for pitch and yaw beyond ±DIRECTION_ANGLE, with the position where they are drawn"""
+    directions = []
+    if pitch >= DIRECTION_ANGLE:
+        directions.append(('Head down', (30, 30)))
+    elif pitch <= -DIRECTION_ANGLE:
+        directions.append(('Head up', (30, 30)))
+
+    if yaw >= DIRECTION_ANGLE:
+        directions.append(('Head right', (90, 30)))
+    elif yaw <= -DIRECTION_ANGLE:
+        directions.append(('Head left', (90, 30)))
+    return directions
+
+def draw_head_pose(img, image_points, p1, p2, x1, x2, pitch, yaw):
+    """
+    Draw the head pose of one face: landmarks, pose lines, head direction and angles
+
+    Parameters
+    ----------
+    img : np.uint8
+        Image to draw on
+    image_points : Array of float64
+        The 6 landmarks used by solvePnP
+    p1, p2 : tuple
+        Line sticking out of the nose, from head_angles
+    x1, x2 : tuple
+        Line used for the left/right angle, from head_angles
+    pitch, yaw : float
+        Up/down and left/right angles in degrees, from pose_degrees
+
+    Returns
+    -------
+    None.
+
+    """
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    for p in image_points:
+        cv2.circle(img, (int(p[0]), int(p[1])), 3, (0,0,255), -1)
+
+    cv2.line(img, p1, p2, (0, 255, 255), 2)
+    cv2.line(img, tuple(x1), tuple(x2), (255, 255, 0), 2)
+    # for (x, y) in marks:
+    #     cv2.circle(img, (x, y), 4, (255, 255, 0), -1)
+    # cv2.putText(img, str(p1), p1, font, 1, (0, 255, 255), 1)
+    for direction, position in head_directions(pitch, yaw):
+        cv2.putText(img, direction, position, font, 2, (255, 255, 128), 3)
+
+    cv2.putText(img, str(int(pitch)), tuple(p1), font, 2, (128, 255, 255), 3)
+    cv2.putText(img, str(int(yaw)), tuple(x1), font, 2, (255, 255, 128), 3)
+
+def headpose_row(frame_idx, face_idx, face, image_points, rotation_vector, translation_vector, ang1, ang2):
+    """Row of the headpose CSV for one face (see HEADPOSE_COLUMNS)"""
+    return ([frame_idx, face_idx] + [int(v) for v in face] + [ang1, ang2]
+            + list(np.ravel(rotation_vector)) + list(np.ravel(translation_vector)) + list(np.ravel(image_points))
+            + list(pose_degrees(rotation_vector)))
+
+def save_headpose_csv(path, rows):
+    """Save the headpose rows of a video to a CSV file"""
+    data = np.array(rows, dtype=float).reshape(-1, len(HEADPOSE_COLUMNS))
+    np.savetxt(path, data, delimiter=',', fmt='%.8g', header=','.join(HEADPOSE_COLUMNS), comments='')
@@ -0,0 +1,238 @@
+"""
+Library API of the head pose estimation, to run it in-process without going through the CSV files.
+
+`HeadposeEstimator` loads the face detector and the landmark model once and turns frames into compact records of
+the structured NumPy dtype HEADPOSE_DTYPE, one per detected face: frame index, face box, up/down and left/right
+angles, OpenFace pitch, yaw and roll, solvePnP rotation and translation vectors, the 6 image points of
+MODEL_POINTS, the 68 landmarks and the pose lines that head_pose_estimation.py draws, all at the resolution of the
+input frames. With a ResolutionController (see resolution_controller.py), the models run on frames downsampled to
+the smallest resolution that keeps the faces large enough, and with a LivenessFilter (see face_spoofing.py) the
+faces of tracks judged as printed or screen faces are dropped before the landmarks. `stream` takes any iterable of
+BGR frames and yields the records of every frame, so results can be consumed while the video is still being read.
+head_pose_estimation.py calls `process` on every frame it reads and keeps the drawing, the messages, the CSV file
+and the checkpoints around it.
+
+Example:
+    import numpy as np
+    from headpose_estimator import HeadposeEstimator, video_frames
+
+    estimator = HeadposeEstimator()
+    for faces in estimator.stream(video_frames('video.mp4')):
+        for face in faces:
+            print(face['frame'], np.degrees(face['euler']))
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+import headpose_core as core
+import pose_geometry
+from resolution_controller import to_full_resolution
+from face_detector import get_face_detector, find_faces
+from face_landmarks import get_landmark_model, detect_marks
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from utils.frame_buffers import FrameBuffers
+from utils.render_annotations import open_at
+
+HEADPOSE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# One record per face and frame
+HEADPOSE_DTYPE = np.dtype([
+    ('frame', np.int64),
+    ('face', np.int32),             # index of the face in the frame
+    ('box', np.int32, 4),           # x, y, x1, y1
+    ('ang1', np.int32),             # legacy up/down angle of the nose line in degrees
+    ('ang2', np.int32),             # legacy left/right angle in degrees
+    ('euler', np.float64, 3),       # pose_Rx, pose_Ry, pose_Rz of OpenFace (pitch, yaw, roll) in radians
+    ('rvec', np.float64, 3),
+    ('tvec', np.float64, 3),
+    ('points', np.float64, (6, 2)),  # image points of MODEL_POINTS
+    ('marks', np.int32, (68, 2)),
+    ('lines', np.int32, (4, 2)),    # p1, p2 (nose line) and x1, x2 (left/right line) of head_angles
+])
+
+
+def video_frames(video_path, start=0):
+    """Frames of a video file for `stream`, until the first frame that cannot be read"""
+    cap = open_at(video_path, start)
+    while True:
+        ret, img = cap.read()
+        if not ret:
+            break
+        yield img
+    cap.release()
+
+
+def estimate_face_pose(img, face, landmark_model, camera_matrix, buffers=None, pnp_flags=None):
+    """
+    Find the landmarks of a face and solve its pose
+
+    Parameters
+    ----------
+    img : np.uint8
+        Original Image.
+    face : list
+        Face coordinates (x, y, x1, y1) returned by find_faces
+    landmark_model : Tensorflow model
+        Loaded facial landmark model
+    camera_matrix : Array of float64
+        The camera matrix
+    buffers : FrameBuffers, optional
+        Reusable crop buffers passed to detect_marks. The default is None.
+    pnp_flags : int, optional
+        cv2.solvePnP method. The default is None (cv2.SOLVEPNP_UPNP).
+
+    Returns
+    -------
+    marks : numpy array
+        68 facial landmark points
+    image_points : Array of float64
+        The 6 landmarks matching MODEL_POINTS (headpose_core.py)
+    rotation_vector : Array of float64
+    translation_vector : Array of float64
+
+    """
+    marks = detect_marks(img, landmark_model, face, buffers)
+    image_points, rotation_vector, translation_vector = core.solve_pose(marks, camera_matrix, pnp_flags)
+    return marks, image_points, rotation_vector, translation_vector
+
+
+class HeadposeEstimator:
+    """Face detector and landmark model, loaded once, producing per-face records"""
+
+    def __init__(self, face_model=None, landmark_model=None, pnp_flags=None, quantized=False, controller=None,
+                 liveness=None):
+        """
+        Parameters
+        ----------
+        face_model : dnn_Net, optional
+            Face detection model. The default is None (the detector of models/, see get_face_detector).
+        landmark_model : Tensorflow model, optional
+            Facial landmark model. The default is None (models/pose_model).
+        pnp_flags : int, optional
+            cv2.solvePnP method. The default is None (cv2.SOLVEPNP_UPNP).
+        quantized : bool, optional
+            Load the quantized TensorFlow face detector instead of the Caffe one. The default is False.
+        controller : ResolutionController, optional
+            Adaptive working resolution of the models. The default is None (full resolution).
+        liveness : LivenessFilter, optional
+            Anti-spoofing stage between the detection and the landmarks. The default is None (every face).
+
+        """
+        models = os.path.join(HEADPOSE_DIR, 'models')
+        if face_model is None and quantized:
+            face_model = get_face_detector(os.path.join(models, 'opencv_face_detector_uint8.pb'),
+                                           os.path.join(models, 'opencv_face_detector.pbtxt'), quantized=True)
+        elif face_model is None:
+            face_model = get_face_detector(os.path.join(models, 'res10_300x300_ssd_iter_140000.caffemodel'),
+                                           os.path.join(models, 'deploy.prototxt'))
+        if landmark_model is None:
+            landmark_model = get_landmark_model(os.path.join(models, 'pose_model'))
+        self.face_model = face_model
+        self.landmark_model = landmark_model
+        self.pnp_flags = pnp_flags
+        self.controller = controller
+        self.liveness = liveness
+        self.buffers = FrameBuffers()
+        self.camera_matrices = {}  # per working frame size
+        self.pose_time = 0.0
+        self.frames = 0
+
+    def process(self, img, index=0, faces=None):
+        """
+        Estimate the head pose of the faces of one frame
+
+        Parameters
+        ----------
+        img : np.uint8
+            BGR frame
+        index : int, optional
+            Frame index. The default is 0.
+        faces : list, optional
+            Face boxes (x, y, x1, y1) of img already detected, e.g. by the frame bus. The default is None (run the
+            face detector).
+
+        Returns
+        -------
+        faces : np.ndarray, shape (faces,)
+            Records of dtype HEADPOSE_DTYPE, with the coordinates of img
+
+        """
+        start = time.perf_counter()
+        scale = 1.0
+        full = img
+        if self.controller is not None:
+            img, scale = self.controller.downsample(img, self.buffers)
+        camera_matrix = self.camera_matrices.get(img.shape[:2])
+        if camera_matrix is None:
+            # Camera internals of the first frame, or of a new resolution
+            camera_matrix = self.camera_matrices[img.shape[:2]] = core.get_camera_matrix(img.shape)
+
+        if faces is None:
+            faces = find_faces(img, self.face_model)
+        elif scale != 1.0:
+            faces = [[int(round(v * scale)) for v in face] for face in faces]
+        if self.liveness is not None:
+            # The crops are scored at full resolution, the model was trained on full-resolution histograms
+            faces = self.liveness.filter(full, faces, index, scale)
+        records = np.zeros(len(faces), dtype=HEADPOSE_DTYPE)
+        records['frame'], records['face'] = index, np.arange(len(faces))
+        for record, face in zip(records, faces):
+            marks, image_points, rotation_vector, translation_vector = estimate_face_pose(
+                img, face, self.landmark_model, camera_matrix, self.buffers, self.pnp_flags)
+            record['box'], record['marks'], record['points'] = face, marks, image_points
+            record['rvec'], record['tvec'] = np.ravel(rotation_vector), np.ravel(translation_vector)
+        # Projections and angles of all the faces together
+        records['lines'] = pose_geometry.head_lines(records['points'][:, 0], records['rvec'], records['tvec'],
+                                                    camera_matrix, img.shape[1])
+        records['ang1'], records['ang2'] = pose_geometry.line_angles(records['lines'])
+        records['euler'] = pose_geometry.openface_angles(records['rvec'])
+        if self.controller is not None:
+            to_full_resolution(records, scale)
+            self.controller.update(records['box'])
+        self.pose_time += time.perf_counter() - start
+        self.frames += 1
+        return records
+
+    def stream(self, frames, start=0):
+        """
+        Estimate the head pose of a sequence of frames
+
+        Parameters
+        ----------
+        frames : iterable
+            BGR frames
+        start : int, optional
+            Index of the first frame. The default is 0.
+
+        Yields
+        ------
+        faces : np.ndarray
+            Records of the faces of every frame (see `process`). np.concatenate(list(...)) gives one array.
+
+        """
+        for index, img in enumerate(frames, start):
+            yield self.process(img, index)
+
+    def report(self):
+        """Pose estimation time per frame"""
+        if not self.frames:
+            return "Pose estimation: no frames"
+        return (f"Pose estimation: {self.frames} frames, {self.pose_time / self.frames * 1000:.1f} ms/frame, "
+                f"{self.frames / self.pose_time:.1f} fps")
+
+
+def draw_record(img, record):
+    """Draw the head pose of one face record, as head_pose_estimation.py does"""
+    p1, p2, x1, x2 = (tuple(int(v) for v in point) for point in record['lines'])
+    pitch, yaw = np.degrees(record['euler'][:2])
+    core.draw_head_pose(img, record['points'], p1, p2, x1, x2, pitch, yaw)
+
+
+def csv_rows(records):
+    """Rows of the headpose CSV of face records (see HEADPOSE_COLUMNS in headpose_core.py)"""
+    return [core.headpose_row(int(r['frame']), int(r['face']), r['box'], r['points'], r['rvec'], r['tvec'],
+                             int(r['ang1']), int(r['ang2'])) for r in records]
@@ -0,0 +1,237 @@
+"""
+Online classification of live head pose streams into action labels (head turned away, leaning in, speaking gesture).
+
+Every tracked face is a stream. For each new frame, `OnlineClassifier.push` adds the per-frame features of a
+stream to its rolling window, and `OnlineClassifier.step` classifies the windows of all the streams pushed in
+that frame with a single call to the model (micro-batching). Streams that were not pushed in the frame (face not
+matched) are left out of the batch and of the labels, and are dropped after `max_missed` frames. The classification
+stride adapts to a per-frame latency budget: if a batch takes longer than the budget, the windows are classified
+less often, and the labels are kept in between.
+Labels are debounced with hysteresis so they do not flicker from one frame to the next.
+
+Any lightweight CPU model can be plugged in as long as it follows the `OnlineModel` interface. `RuleModel` is
+the default and only needs the features computed in head_pose_estimation.py. A scikit-learn classifier trained
+on flattened windows can be used with `SklearnModel`.
+"""
+
+import time
+import pickle
+import numpy as np
+
+# Per-frame features of a stream, in this order
+FEATURES = ['pitch', 'yaw', 'face_width', 'mouth_open']
+
+
+def frame_features(pitch, yaw, face, marks):
+    """
+    Per-frame features of one face
+
+    Parameters
+    ----------
+    pitch : float
+        Up/down angle of the head in degrees, from the rotation matrix (see pose_geometry.openface_angles)
+    yaw : float
+        Left/right angle of the head in degrees
+    face : list
+        Face box (x, y, x1, y1)
+    marks : numpy array
+        68 facial landmarks
+
+    Returns
+    -------
+    features : np.ndarray, shape (4,)
+        Values of FEATURES. The mouth opening is normalized by the face width.
+
+    """
+    width = max(float(face[2] - face[0]), 1.0)
+    mouth_open = np.linalg.norm(marks[66].astype(float) - marks[62].astype(float)) / width
+    return np.array([pitch, yaw, width, mouth_open], dtype=float)
+
+
+class OnlineModel:
+    """Interface of the models used by OnlineClassifier"""
+
+    labels = []
+
+    def predict(self, windows):
+        """
+        Score a batch of windows
+
+        Parameters
+        ----------
+        windows : np.ndarray, shape (B, window, len(FEATURES))
+            Rolling windows of B streams, oldest frame first
+
+        Returns
+        -------
+        scores : np.ndarray, shape (B, len(labels))
+            Score between 0 and 1 of every label
+
+        """
+        raise NotImplementedError
+
+
+class RuleModel(OnlineModel):
+    """Threshold rules on the window statistics, vectorized over the batch"""
+
+    labels = ['head turned away', 'leaning in', 'speaking gesture']
+
+    def __init__(self, away_angle=20, lean_ratio=1.15, mouth_std=0.015):
+        self.away_angle = away_angle
+        self.lean_ratio = lean_ratio
+        self.mouth_std = mouth_std
+
+    def predict(self, windows):
+        pitch, yaw, width, mouth = (windows[..., i] for i in range(len(FEATURES)))
+        away = np.mean((np.abs(pitch) >= self.away_angle) | (np.abs(yaw) >= self.away_angle), axis=1)
+        # The face grows in the image when the person leans towards the camera
+        half = windows.shape[1] // 2
+        growth = width[:, half:].mean(axis=1) / np.maximum(width[:, :half].mean(axis=1), 1.0)
+        lean = np.clip((growth - 1) / (self.lean_ratio - 1), 0, 1)
+        speak = np.clip(mouth.std(axis=1) / self.mouth_std, 0, 1)
+        return np.column_stack((away, lean, speak))
+
+
+class SklearnModel(OnlineModel):
+    """scikit-learn classifier with predict_proba, trained on windows flattened to one row each"""
+
+    def __init__(self, model_path, labels=None):
+        with open(model_path, 'rb') as f:
+            self.model = pickle.load(f)
+        self.labels = labels or [str(c) for c in self.model.classes_]
+
+    def predict(self, windows):
+        return self.model.predict_proba(windows.reshape(len(windows), -1))
+
+
+class Debouncer:
+    """Hysteresis on the label scores of one stream"""
+
+    def __init__(self, n_labels, on=0.6, off=0.4, min_count=3):
+        """
+        Parameters
+        ----------
+        n_labels : int
+            Number of labels
+        on : float, optional
+            Score above which a label turns on. The default is 0.6.
+        off : float, optional
+            Score below which a label turns off. The default is 0.4.
+        min_count : int, optional
+            Number of consecutive decisions needed to switch a label. The default is 3.
+
+        """
+        self.on = on
+        self.off = off
+        self.min_count = min_count
+        self.state = np.zeros(n_labels, dtype=bool)
+        self.count = np.zeros(n_labels, dtype=int)
+
+    def update(self, scores):
+        """Update the labels with new scores and return the current state"""
+        switch = np.where(self.state, scores <= self.off, scores >= self.on)
+        self.count = np.where(switch, self.count + 1, 0)
+        flip = self.count >= self.min_count
+        self.state = self.state ^ flip
+        self.count[flip] = 0
+        return self.state
+
+
+class OnlineClassifier:
+    """Rolling windows of several streams classified in micro-batches within a latency budget"""
+
+    def __init__(self, model=None, window=15, budget_ms=5.0, max_stride=10, max_missed=5):
+        """
+        Parameters
+        ----------
+        model : OnlineModel, optional
+            The default is RuleModel().
+        window : int, optional
+            Window length in frames. The default is 15.
+        budget_ms : float, optional
+            Time allowed for classification per frame, in milliseconds. The default is 5.
+        max_stride : int, optional
+            Maximum number of frames between two classifications. The default is 10.
+        max_missed : int, optional
+            Number of frames without features after which a stream is dropped. The default is 5.
+
+        """
+        self.model = model or RuleModel()
+        self.window = window
+        self.budget_ms = budget_ms
+        self.max_stride = max_stride
+        self.max_missed = max_missed
+        self.stride = 1
+        self.frame = 0
+        self.buffers = {}
+        self.filled = {}
+        self.debouncers = {}
+        self.labels = {}
+        self.last_push = {}  # stream ID -> frame of its last features
+        self.batch_times = []
+        self.batch_sizes = []
+
+    def push(self, stream_id, features):
+        """Add the features of the current frame of a stream"""
+        if stream_id not in self.buffers:
+            self.buffers[stream_id] = np.zeros((self.window, len(features)))
+            self.filled[stream_id] = 0
+            self.debouncers[stream_id] = Debouncer(len(self.model.labels))
+            self.labels[stream_id] = []
+        buf = self.buffers[stream_id]
+        buf[:-1] = buf[1:]
+        buf[-1] = features
+        self.filled[stream_id] = min(self.filled[stream_id] + 1, self.window)
+        self.last_push[stream_id] = self.frame
+
+    def drop(self, stream_id):
+        """Forget a stream, e.g. when its track is lost"""
+        for d in (self.buffers, self.filled, self.debouncers, self.labels, self.last_push):
+            d.pop(stream_id, None)
+
+    def step(self):
+        """
+        Classify the full windows if the current frame is due, in one model call
+
+        Returns
+        -------
+        labels : dict
+            Stream ID -> list of active labels, for the streams pushed in the current frame
+
+        """
+        current = self.frame
+        self.frame += 1
+        # Age out the streams without features for too long, and leave the others not seen in this frame out
+        for s in [s for s, last in self.last_push.items() if current - last > self.max_missed]:
+            self.drop(s)
+        fresh = [s for s, last in self.last_push.items() if last == current]
+        ready = [s for s in fresh if self.filled[s] == self.window]
+        if not ready or self.frame % self.stride:
+            return {s: self.labels[s] for s in fresh}
+
+        start = time.perf_counter()
+        scores = self.model.predict(np.stack([self.buffers[s] for s in ready]))
+        for s, score in zip(ready, scores):
+            state = self.debouncers[s].update(score)
+            self.labels[s] = [label for label, on in zip(self.model.labels, state) if on]
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.batch_times.append(elapsed_ms)
+        self.batch_sizes.append(len(ready))
+
+        # Spread the classifications over more frames when they exceed the per-frame budget
+        if elapsed_ms > self.budget_ms:
+            self.stride = min(self.stride * 2, self.max_stride)
+        elif elapsed_ms < self.budget_ms / 4 and self.stride > 1:
+            self.stride -= 1
+        return {s: self.labels[s] for s in fresh}
+
+    def report(self):
+        """Latency and throughput of the classification stage"""
+        if not self.batch_times:
+            return "Classification: no windows classified"
+        times = np.array(self.batch_times)
+        total_s = times.sum() / 1000
+        windows = int(np.sum(self.batch_sizes))
+        return (f"Classification: {len(times)} batches, {windows} windows, "
+                f"latency mean {times.mean():.2f} ms / p95 {np.percentile(times, 95):.2f} ms per batch, "
+                f"throughput {windows / max(total_s, 1e-9):.0f} windows/s, final stride {self.stride}")
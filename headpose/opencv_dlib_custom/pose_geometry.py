@@ -0,0 +1,156 @@
+"""
+Vectorized head pose geometry for all the faces of a frame, or of many frames, at once.
+
+head_pose_estimation.py used to call cv2.projectPoints for every face twice: once for the nose line and once for
+a 10-point annotation box rebuilt as a Python list on every call, and derived ang1/ang2 from the slopes of the
+projected lines with try/except around the divisions. Here the 3D points are constant arrays, the rotation vectors
+of N faces are turned into rotation matrices together (Rodrigues formula) and all the points of all the faces are
+projected with one batched pinhole projection (no lens distortion, as in the pipeline).
+
+- `project`: (P, 3) model points of N poses -> (N, P, 2) image points
+- `head_lines`: nose line (p1, p2) and left/right line (x1, x2) that head_pose_estimation.py draws
+- `line_angles`: the legacy ang1 (up/down) and ang2 (left/right) of those lines, in integer degrees, still written
+  to the headpose CSV. Vertical and horizontal lines give ±90 from arctan2 instead of an exception. They depend on
+  where the lines fall in the image and flip sign as the head turns, so nothing is decided on them any more.
+- `openface_angles`: pose_Rx, pose_Ry, pose_Rz of OpenFace (pitch, yaw, roll, R = Rx Ry Rz in camera axes) from the
+  rotation matrices, in radians. Pitch is positive with the head down and yaw with the head turned right. These are
+  the angles the head directions, the event index and the online classifier use.
+"""
+
+import numpy as np
+
+# MODEL_POINTS have y up and the face towards +z, OpenFace uses camera axes (y down, face towards -z)
+MODEL_TO_CAMERA_AXES = np.diag([1.0, -1.0, -1.0])
+
+# Far end of the line sticking out of the nose
+NOSE_END = np.array([[0.0, 0.0, 1000.0]])
+
+# Corners of the rear (size 1 at depth 0) and front (size 1, depth 2, scaled by the image width) squares of the
+# annotation box, as closed polylines
+_SQUARE = np.array([(-1, -1), (-1, 1), (1, 1), (1, -1), (-1, -1)], dtype=float)
+REAR_BOX = np.column_stack((_SQUARE, np.zeros(5)))
+FRONT_BOX = np.column_stack((_SQUARE, np.full(5, 2.0)))
+
+
+def box_points(width):
+    """3D points of the annotation box of get_2d_points for an image of the given width, shape (10, 3)"""
+    return np.concatenate((REAR_BOX, FRONT_BOX * width))
+
+
+def rotation_matrices(rvecs):
+    """
+    Rotation matrices of rotation vectors (Rodrigues formula)
+
+    Parameters
+    ----------
+    rvecs : array-like, shape (N, 3)
+
+    Returns
+    -------
+    R : np.ndarray, shape (N, 3, 3)
+
+    """
+    rvecs = np.asarray(rvecs, dtype=float).reshape(-1, 3)
+    theta = np.linalg.norm(rvecs, axis=1)
+    k = rvecs / np.maximum(theta, 1e-12)[:, None]
+    K = np.zeros((len(rvecs), 3, 3))
+    K[:, 0, 1], K[:, 0, 2], K[:, 1, 2] = -k[:, 2], k[:, 1], -k[:, 0]
+    K -= K.transpose(0, 2, 1)
+    sin, cos = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+    return np.eye(3) + sin * K + (1 - cos) * (K @ K)
+
+
+def project(points, rvecs, tvecs, camera_matrix):
+    """
+    Project 3D model points under N poses
+
+    Parameters
+    ----------
+    points : array-like, shape (P, 3)
+    rvecs, tvecs : array-like, shape (N, 3)
+        solvePnP rotation and translation vectors
+    camera_matrix : np.ndarray, shape (3, 3)
+
+    Returns
+    -------
+    image_points : np.ndarray, shape (N, P, 2)
+
+    """
+    R = rotation_matrices(rvecs)
+    tvecs = np.asarray(tvecs, dtype=float).reshape(-1, 1, 3)
+    camera = np.asarray(points, dtype=float) @ R.transpose(0, 2, 1) + tvecs
+    pixels = camera @ np.asarray(camera_matrix, dtype=float).T
+    return pixels[..., :2] / pixels[..., 2:]
+
+
+def head_lines(nose_points, rvecs, tvecs, camera_matrix, width):
+    """
+    Lines drawn for the head pose of N faces, as head_angles of headpose_core.py
+
+    Parameters
+    ----------
+    nose_points : array-like, shape (N, 2)
+        Nose tip in the image (first image point)
+    rvecs, tvecs : array-like, shape (N, 3)
+    camera_matrix : np.ndarray, shape (3, 3)
+    width : int
+        Image width, the size of the front of the annotation box
+
+    Returns
+    -------
+    lines : np.ndarray of int32, shape (N, 4, 2)
+        p1, p2 (nose line) and x1, x2 (left/right line)
+
+    """
+    points = project(np.concatenate((NOSE_END, box_points(width))), rvecs, tvecs, camera_matrix)
+    nose_end = points[:, 0]
+    box = points[:, 1:].astype(np.int32)
+    lines = np.empty((len(points), 4, 2), dtype=np.int32)
+    lines[:, 0] = np.asarray(nose_points, dtype=float).reshape(-1, 2)
+    lines[:, 1] = nose_end
+    lines[:, 2] = box[:, 2]
+    lines[:, 3] = (box[:, 5] + box[:, 8]) // 2
+    return lines
+
+
+def _fold(degrees):
+    """Angle of a line, folded to (-90, 90] as the arctangent of its slope"""
+    return 90.0 - np.mod(90.0 - degrees, 180.0)
+
+
+def line_angles(lines):
+    """
+    Legacy ang1 and ang2 of the headpose CSV from the lines of `head_lines` (see `openface_angles` for the head
+    pose angles)
+
+    Returns
+    -------
+    ang1 : np.ndarray of int, shape (N,)
+        Angle of the nose line in degrees (up/down)
+    ang2 : np.ndarray of int, shape (N,)
+        Angle of the normal of the left/right line in degrees (left/right)
+
+    """
+    d = np.diff(np.asarray(lines, dtype=float).reshape(-1, 2, 2, 2), axis=2)[:, :, 0]
+    ang1 = _fold(np.degrees(np.arctan2(d[:, 0, 1], d[:, 0, 0])))
+    ang2 = _fold(np.degrees(np.arctan2(-d[:, 1, 0], d[:, 1, 1])))
+    return np.trunc(ang1).astype(int), np.trunc(ang2).astype(int)
+
+
+def openface_angles(rvecs):
+    """
+    pose_Rx, pose_Ry, pose_Rz of OpenFace for solvePnP rotations of MODEL_POINTS
+
+    Parameters
+    ----------
+    rvecs : array-like, shape (N, 3)
+
+    Returns
+    -------
+    angles : np.ndarray, shape (N, 3)
+        Pitch, yaw and roll in radians, R = Rx(pitch) Ry(yaw) Rz(roll)
+
+    """
+    R = rotation_matrices(rvecs) @ MODEL_TO_CAMERA_AXES
+    return np.column_stack((np.arctan2(-R[:, 1, 2], R[:, 2, 2]), np.arcsin(np.clip(R[:, 0, 2], -1, 1)),
+                            np.arctan2(-R[:, 0, 1], R[:, 0, 0])))
@@ -0,0 +1,370 @@
+"""
+Accuracy vs speed sweep of the head pose pipeline against OpenFace.
+
+Runs the pipeline of head_pose_estimation.py (face detector, landmarks, solvePnP) on recorded clips under a grid
+of configurations and compares its head rotation with the OpenFace CSV of the same videos:
+- detector: `caffe` (res10 SSD) or `quantized` (uint8 TensorFlow SSD), see face_detector.py
+- scale: input resolution relative to the video
+- detect_every: the detector runs every N frames, the faces found last are reused in between
+- landmarks: `cnn` (models/pose_model), `dlib` (models/shape_predictor_68_face_landmarks.dat) or `lbf`
+  (OpenCV contrib Facemark, models/lbfmodel.yaml). Backends whose package or model is missing are skipped.
+- pnp: solvePnP method (`upnp`, `iterative`, `epnp`, `sqpnp`)
+
+The stages are measured separately and shared between the configurations that only differ later in the pipeline
+(the landmarks of one detector setting are solved with every PnP method), so the grid costs a few passes per
+scale instead of one pass per configuration. Decoding is not timed, it is the same for every configuration.
+
+The rotation is compared as OpenFace's pose_Rx, pose_Ry and pose_Rz (Euler angles of R = Rx Ry Rz, in camera
+coordinates). Faces are matched to the OpenFace faces of the same frame by the distance between their nose tips
+(OpenFace landmark 30, `x_30`/`y_30`). OpenFace CSVs written without the 2D landmarks (only `pose_T*`/`pose_R*`)
+use the projection of the head position `pose_Tx/Ty/Tz` instead, and a frame with one face on both sides is
+matched directly. The reference columns are checked before the sweep starts.
+The table lists the throughput, the latency percentiles and the mean absolute error of every configuration, with
+the ones on the Pareto front of error vs throughput marked.
+
+Usage:
+    python pose_sweep.py -clips <video> [...] [-openface <openface.csv> ...] [-frames 300]
+                         [-detector caffe quantized] [-scale 1 0.5] [-detect_every 1 5] [-landmarks cnn]
+                         [-pnp upnp iterative] [-out sweep.csv]
+"""
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import cv2
+
+HEADPOSE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HEADPOSE_DIR, '..', '..', 'analysis'))
+from session_store import read_openface
+from face_detector import get_face_detector, find_faces
+import headpose_core as core
+from pose_geometry import openface_angles
+
+OPENFACE_FOLDER = os.path.join(HEADPOSE_DIR, '..', '..', 'data', 'data_processed', 'videos', 'OpenFace')
+
+# solvePnP methods available in the installed OpenCV (SOLVEPNP_UPNP was removed in OpenCV 5)
+PNP_FLAGS = {name: getattr(cv2, f'SOLVEPNP_{name.upper()}') for name in ('upnp', 'iterative', 'epnp', 'sqpnp')
+             if hasattr(cv2, f'SOLVEPNP_{name.upper()}')}
+
+# Columns of the OpenFace reference: the angles, and the nose tip or else the head position to match the faces
+ANGLE_COLUMNS = ['pose_Rx', 'pose_Ry', 'pose_Rz']
+NOSE_COLUMNS = ['x_30', 'y_30']
+HEAD_COLUMNS = ['pose_Tx', 'pose_Ty', 'pose_Tz']
+
+GRID = {
+    'detector': ['caffe', 'quantized'],
+    'scale': [1.0, 0.5],
+    'detect_every': [1, 5],
+    'landmarks': ['cnn'],
+    'pnp': [name for name in ('upnp', 'iterative') if name in PNP_FLAGS],
+}
+
+
+def load_detector(name):
+    """Face detection model of face_detector.py"""
+    models = os.path.join(HEADPOSE_DIR, 'models')
+    if name == 'quantized':
+        return get_face_detector(os.path.join(models, 'opencv_face_detector_uint8.pb'),
+                                 os.path.join(models, 'opencv_face_detector.pbtxt'), quantized=True)
+    return get_face_detector(os.path.join(models, 'res10_300x300_ssd_iter_140000.caffemodel'),
+                             os.path.join(models, 'deploy.prototxt'))
+
+
+def load_landmarks(name):
+    """
+    Landmark backend
+
+    Returns
+    -------
+    marks_fn : function
+        marks_fn(img, face) -> (68, 2) landmarks of the face in image coordinates
+
+    """
+    models = os.path.join(HEADPOSE_DIR, 'models')
+    if name == 'cnn':
+        from face_landmarks import get_landmark_model, detect_marks
+        model = get_landmark_model(os.path.join(models, 'pose_model'))
+        return lambda img, face: detect_marks(img, model, face)
+    if name == 'dlib':
+        import dlib
+        predictor = dlib.shape_predictor(os.path.join(models, 'shape_predictor_68_face_landmarks.dat'))
+
+        def dlib_marks(img, face):
+            shape = predictor(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), dlib.rectangle(*(int(v) for v in face)))
+            return np.array([(p.x, p.y) for p in shape.parts()], dtype=float)
+        return dlib_marks
+    if name == 'lbf':
+        facemark = cv2.face.createFacemarkLBF()
+        facemark.loadModel(os.path.join(models, 'lbfmodel.yaml'))
+
+        def lbf_marks(img, face):
+            x, y, x1, y1 = face
+            _, landmarks = facemark.fit(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), np.array([[x, y, x1 - x, y1 - y]]))
+            return landmarks[0][0]
+        return lbf_marks
+    raise ValueError(f"Unknown landmark backend: {name}")
+
+
+def read_frames(video_path, scale, max_frames):
+    """Yield (index, frame at the given scale, resize time) for the first max_frames frames"""
+    cap = cv2.VideoCapture(video_path)
+    idx = 0
+    while idx < max_frames:
+        ret, img = cap.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+        if scale != 1.0:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        yield idx, img, time.perf_counter() - start
+        idx += 1
+    cap.release()
+
+
+def detection_pass(video_path, scale, detector, max_frames):
+    """Faces and detection time (resize included) of every frame"""
+    faces, times = [], []
+    for _, img, resize_time in read_frames(video_path, scale, max_frames):
+        start = time.perf_counter()
+        faces.append(find_faces(img, detector))
+        times.append(time.perf_counter() - start + resize_time)
+    return faces, np.array(times)
+
+
+def reused_faces(faces, detect_every):
+    """Faces of every frame when the detector only runs every detect_every frames"""
+    return [faces[k - k % detect_every] for k in range(len(faces))]
+
+
+def landmark_pass(video_path, scale, faces, marks_fn):
+    """Landmarks of the given faces and landmark time of every frame"""
+    marks, times = [], []
+    for idx, img, _ in read_frames(video_path, scale, len(faces)):
+        start = time.perf_counter()
+        marks.append([np.asarray(marks_fn(img, face), dtype=float) for face in faces[idx]])
+        times.append(time.perf_counter() - start)
+    return marks, np.array(times)
+
+
+def pnp_pass(marks, faces, scale, camera_matrix, pnp_flags):
+    """
+    Solve the pose of every face
+
+    Returns
+    -------
+    poses : np.ndarray, shape (N, 7)
+        frame, nose x, nose y, face width (full-resolution pixels) and the 3 OpenFace angles of every face
+    times : np.ndarray
+        PnP time of every frame
+
+    """
+    poses, times = [], []
+    for idx, (frame_marks, frame_faces) in enumerate(zip(marks, faces)):
+        start = time.perf_counter()
+        frame_poses, rvecs = [], []
+        for face_marks, face in zip(frame_marks, frame_faces):
+            image_points, rotation_vector, _ = core.solve_pose(face_marks, camera_matrix, pnp_flags)
+            frame_poses.append([idx, *(image_points[0] / scale), (face[2] - face[0]) / scale])
+            rvecs.append(np.ravel(rotation_vector))
+        if frame_poses:
+            # Angles of all the faces of the frame together
+            poses.append(np.column_stack((frame_poses, openface_angles(rvecs))))
+        times.append(time.perf_counter() - start)
+    return np.concatenate(poses) if poses else np.zeros((0, 7)), np.array(times)
+
+
+def check_reference(reference, path):
+    """Raise a ValueError if an OpenFace reference lacks the angles, or both the nose tip and the head position"""
+    if not reference:
+        raise ValueError(f"{path} has no face")
+    columns = next(iter(reference.values())).columns
+    missing = [c for c in ANGLE_COLUMNS if c not in columns]
+    if not all(c in columns for c in NOSE_COLUMNS) and not all(c in columns for c in HEAD_COLUMNS):
+        missing += [c for c in HEAD_COLUMNS if c not in columns]
+    if missing:
+        raise ValueError(f"{path} has no {', '.join(missing)} column: run OpenFace with -pose (and -2Dfp)")
+
+
+def nose_positions(stream, camera_matrix):
+    """
+    Nose tip of every sample of an OpenFace stream in full-resolution pixels
+
+    From the landmark 30 when the CSV has the 2D landmarks, otherwise the head position pose_Tx/Ty/Tz (millimeters
+    in camera coordinates) projected with camera_matrix.
+    """
+    if all(c in stream.columns for c in NOSE_COLUMNS):
+        return stream.values[:, stream.column_index(NOSE_COLUMNS)]
+    head = stream.values[:, stream.column_index(HEAD_COLUMNS)] @ np.asarray(camera_matrix, dtype=float).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return head[:, :2] / head[:, 2:]
+
+
+def compare(poses, reference, n_frames, camera_matrix):
+    """
+    Match the faces to the OpenFace faces of the same frames
+
+    Parameters
+    ----------
+    poses : np.ndarray, shape (N, 7)
+        Output of pnp_pass
+    reference : dict
+        face_id -> Stream from read_openface
+    n_frames : int
+        Number of processed frames
+    camera_matrix : np.ndarray, shape (3, 3)
+        Camera matrix at the resolution of the video, to project the OpenFace head positions
+
+    Returns
+    -------
+    errors : np.ndarray, shape (M, 3)
+        Absolute angle errors in degrees of the matched faces
+    total : int
+        Number of valid OpenFace faces in the processed frames
+
+    """
+    errors, total = [], 0
+    by_frame = {int(f): poses[poses[:, 0] == f] for f in np.unique(poses[:, 0])}
+    for stream in reference.values():
+        keep = stream.valid & (stream.frames < n_frames)
+        noses = nose_positions(stream, camera_matrix)[keep]
+        angles_of = stream.values[keep][:, stream.column_index(ANGLE_COLUMNS)]
+        for frame, (x, y), angles in zip(stream.frames[keep], noses, angles_of):
+            total += 1
+            candidates = by_frame.get(int(frame))
+            if candidates is None:
+                continue
+            dist = np.hypot(candidates[:, 1] - x, candidates[:, 2] - y)
+            best = np.argmin(np.nan_to_num(dist, nan=np.inf))
+            only = len(reference) == 1 and len(candidates) == 1
+            if not only and not dist[best] <= 0.5 * candidates[best, 3]:
+                continue
+            diff = candidates[best, 4:] - angles
+            errors.append(np.abs((diff + np.pi) % (2 * np.pi) - np.pi))
+    return np.degrees(np.array(errors).reshape(-1, 3)), total
+
+
+def pareto_front(error, fps):
+    """Configurations that no other configuration beats on both error and throughput"""
+    error, fps = np.asarray(error), np.asarray(fps)
+    dominated = ((error[None, :] <= error[:, None]) & (fps[None, :] >= fps[:, None])
+                 & ((error[None, :] < error[:, None]) | (fps[None, :] > fps[:, None])))
+    return ~dominated.any(axis=1)
+
+
+def sweep(clips, references, grid, detectors, landmark_fns, max_frames=300):
+    """
+    Run every configuration of the grid on the clips
+
+    Parameters
+    ----------
+    clips : list of string
+        Videos
+    references : list of dict
+        OpenFace streams of every clip (read_openface)
+    grid : dict
+        Values of the scale, detect_every and pnp axes, as GRID
+    detectors : dict
+        Detector name -> model, see load_backends
+    landmark_fns : dict
+        Landmark backend name -> function, see load_backends
+    max_frames : int, optional
+        Frames processed per clip. The default is 300.
+
+    Returns
+    -------
+    table : pd.DataFrame
+        One row per configuration
+
+    """
+    results = {}  # configuration -> (frame latencies, errors, matched, total)
+    for clip, reference in zip(clips, references):
+        for scale, detector in itertools.product(grid['scale'], detectors):
+            faces, detect_times = detection_pass(clip, scale, detectors[detector], max_frames)
+            n_frames = len(faces)
+            if n_frames == 0:
+                continue
+            _, img, _ = next(read_frames(clip, scale, 1))
+            camera_matrix = core.get_camera_matrix(img.shape)
+            # Camera matrix of the video, the poses are compared at full resolution
+            full_matrix = camera_matrix.copy()
+            full_matrix[:2] /= scale
+            for detect_every, landmarks in itertools.product(grid['detect_every'], landmark_fns):
+                frame_faces = reused_faces(faces, detect_every)
+                detect_cost = np.where(np.arange(n_frames) % detect_every == 0, detect_times, 0.0)
+                marks, mark_times = landmark_pass(clip, scale, frame_faces, landmark_fns[landmarks])
+                for pnp in grid['pnp']:
+                    poses, pnp_times = pnp_pass(marks, frame_faces, scale, camera_matrix, PNP_FLAGS[pnp])
+                    errors, total = compare(poses, reference, n_frames, full_matrix)
+                    key = (detector, scale, detect_every, landmarks, pnp)
+                    latency, all_errors, matched, all_total = results.get(key, ([], [], 0, 0))
+                    results[key] = (latency + list(detect_cost + mark_times + pnp_times), all_errors + [errors],
+                                    matched + len(errors), all_total + total)
+
+    rows = []
+    for (detector, scale, detect_every, landmarks, pnp), (latency, errors, matched, total) in results.items():
+        latency = np.array(latency) * 1000
+        errors = np.concatenate(errors) if errors else np.zeros((0, 3))
+        mae = errors.mean(axis=0) if len(errors) else np.full(3, np.nan)
+        rows.append({'detector': detector, 'scale': scale, 'detect_every': detect_every, 'landmarks': landmarks,
+                     'pnp': pnp, 'fps': 1000 * len(latency) / latency.sum(),
+                     'p50_ms': np.percentile(latency, 50), 'p95_ms': np.percentile(latency, 95),
+                     'rx_mae': mae[0], 'ry_mae': mae[1], 'rz_mae': mae[2], 'mae_deg': mae.mean(),
+                     'matched': matched / total if total else np.nan})
+    table = pd.DataFrame(rows)
+    if len(table):
+        table['pareto'] = pareto_front(table['mae_deg'].fillna(np.inf), table['fps'])
+        table = table.sort_values('fps', ascending=False, ignore_index=True)
+    return table
+
+
+def load_backends(names, loader):
+    """Load the detectors or landmark backends, skipping the ones whose package or model is missing"""
+    backends = {}
+    for name in names:
+        try:
+            backends[name] = loader(name)
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+    return backends
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy vs speed sweep of the head pose pipeline against OpenFace.")
+    parser.add_argument('-clips', nargs='+', required=True, help="Recorded videos")
+    parser.add_argument('-openface', nargs='*', help="OpenFace CSV of every clip. The default is <OpenFace folder>/<video name>.csv")
+    parser.add_argument('-frames', type=int, default=300, help="Frames processed per clip")
+    parser.add_argument('-detector', nargs='+', default=GRID['detector'], choices=['caffe', 'quantized'])
+    parser.add_argument('-scale', nargs='+', type=float, default=GRID['scale'])
+    parser.add_argument('-detect_every', nargs='+', type=int, default=GRID['detect_every'])
+    parser.add_argument('-landmarks', nargs='+', default=GRID['landmarks'], choices=['cnn', 'dlib', 'lbf'])
+    parser.add_argument('-pnp', nargs='+', default=GRID['pnp'], choices=list(PNP_FLAGS))
+    parser.add_argument('-out', help="CSV file for the table")
+    args = parser.parse_args()
+
+    openface_paths = args.openface or [os.path.join(OPENFACE_FOLDER, os.path.splitext(os.path.basename(c))[0] + '.csv')
+                                       for c in args.clips]
+    if len(openface_paths) != len(args.clips):
+        parser.error("Give one OpenFace CSV per clip")
+    # The references are read and checked before the detection and landmark passes
+    references = [read_openface(p) for p in openface_paths]
+    for reference, path in zip(references, openface_paths):
+        try:
+            check_reference(reference, path)
+        except ValueError as error:
+            parser.error(str(error))
+    detectors = load_backends(args.detector, load_detector)
+    landmark_fns = load_backends(args.landmarks, load_landmarks)
+    if not detectors or not landmark_fns:
+        parser.error("No detector or landmark backend could be loaded")
+
+    grid = {'scale': args.scale, 'detect_every': args.detect_every, 'pnp': args.pnp}
+    table = sweep(args.clips, references, grid, detectors, landmark_fns, args.frames)
+    pd.set_option('display.width', 200)
+    print(table.to_string(index=False, float_format=lambda v: f"{v:.3g}"))
+    if args.out:
+        table.to_csv(args.out, index=False)
+        print(f"Saved the sweep to {args.out}")
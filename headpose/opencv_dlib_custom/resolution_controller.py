@@ -0,0 +1,166 @@
+"""
+Adaptive working resolution of the head pose estimation.
+
+find_faces shrinks every frame to 300x300 and the landmark CNN only sees 128x128 face crops, so on 4K panoramas
+most of the per-frame cost of the full-resolution frame is moving pixels that are never used. The controller
+downsamples each frame once (INTER_AREA, into a reused buffer) to the smallest scale of a fixed ladder that still
+keeps the smallest recent face at least `min_face` pixels wide, the size of the landmark crop. Detection, landmarks
+and solvePnP run on the small frame (with the camera matrix of its size, which gives the same rotation and
+translation) and only the output coordinates are mapped back to full resolution.
+
+The scale follows the face widths of the last `window` frames: it only goes down when the faces are `margin`
+times larger than needed, so it does not oscillate, and it goes back to full resolution when no face was seen
+in the window. Every `probe_every` frames one frame is processed at full resolution, so that a smaller face
+entering the scene is not missed.
+
+Compare the pipeline with and without the controller on a clip:
+
+Usage:
+    python resolution_controller.py -input <video> [-min_face 128] [-frames 300]
+"""
+
+import argparse
+from collections import deque
+import numpy as np
+import cv2
+
+# Working scales, from full resolution down
+SCALES = (1.0, 0.75, 0.5, 0.375, 0.25, 0.125)
+
+
+class ResolutionController:
+    """Working scale of the frames from the recent face sizes"""
+
+    def __init__(self, min_face=128, scales=SCALES, window=30, probe_every=30, margin=1.25):
+        """
+        Parameters
+        ----------
+        min_face : int, optional
+            Minimum face width in pixels at the working resolution. The default is 128 (the landmark crop).
+        scales : tuple of float, optional
+            Allowed scales. The default is SCALES.
+        window : int, optional
+            Number of recent frames whose face widths are considered. The default is 30.
+        probe_every : int, optional
+            Process one frame in this many at full resolution, 0 to never probe. The default is 30.
+        margin : float, optional
+            Factor over min_face required before lowering the scale. The default is 1.25.
+
+        """
+        self.min_face = min_face
+        self.scales = sorted(set(scales) | {1.0})
+        self.probe_every = probe_every
+        self.margin = margin
+        self.scale = 1.0
+        self.widths = deque(maxlen=window)  # smallest face width of each recent frame, at full resolution
+        self.frames = 0
+        self.pixels = 0.0  # sum of the pixel fractions processed, for the report
+
+    def next_scale(self):
+        """Scale of the next frame"""
+        self.frames += 1
+        scale = 1.0 if self.probe_every and self.frames % self.probe_every == 0 else self.scale
+        self.pixels += scale * scale
+        return scale
+
+    def downsample(self, img, buffers=None):
+        """
+        Resize the next frame to its working scale
+
+        Parameters
+        ----------
+        img : np.uint8
+            Full resolution frame
+        buffers : FrameBuffers, optional
+            Reusable buffers, one per scale. The default is None.
+
+        Returns
+        -------
+        small : np.uint8
+            Frame at the working scale (img itself at full resolution)
+        scale : float
+
+        """
+        scale = self.next_scale()
+        if scale == 1.0:
+            return img, scale
+        dsize = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+        if buffers is not None:
+            return buffers.resize(img, dsize, f'work{scale}', interpolation=cv2.INTER_AREA), scale
+        return cv2.resize(img, dsize, interpolation=cv2.INTER_AREA), scale
+
+    def update(self, boxes):
+        """
+        Update the scale with the face boxes of a frame
+
+        Parameters
+        ----------
+        boxes : array-like, shape (faces, 4)
+            Face boxes (x, y, x1, y1) at full resolution
+
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.widths.append((boxes[:, 2] - boxes[:, 0]).min() if len(boxes) else np.nan)
+        recent = np.array(self.widths)
+        if np.all(np.isnan(recent)):
+            self.scale = 1.0
+            return
+        smallest = np.nanmin(recent)
+        # The smallest scale that keeps the faces large enough, with a margin to go lower than the current one
+        fits = [s for s in self.scales if s * smallest >= self.min_face * (self.margin if s < self.scale else 1.0)]
+        self.scale = min(fits) if fits else 1.0
+
+    def report(self):
+        """Mean working scale and share of the pixels processed"""
+        if not self.frames:
+            return "Resolution: no frames"
+        return (f"Resolution: current scale {self.scale:g}, {self.pixels / self.frames * 100:.0f}% of the pixels "
+                f"processed over {self.frames} frames")
+
+
+def to_full_resolution(records, scale):
+    """Map the image coordinates of headpose records (see HEADPOSE_DTYPE) from the working scale back to full
+    resolution, in place"""
+    if scale == 1.0:
+        return records
+    for field in ('box', 'marks', 'lines'):
+        records[field] = np.round(records[field] / scale)
+    records['points'] /= scale
+    return records
+
+
+if __name__ == "__main__":
+    import time
+    from headpose_estimator import HeadposeEstimator, video_frames
+
+    parser = argparse.ArgumentParser(description="Compare the head pose pipeline with and without the adaptive resolution.")
+    parser.add_argument('-input', required=True, help="Input video")
+    parser.add_argument('-min_face', type=int, default=128, help="Minimum face width in pixels at the working resolution")
+    parser.add_argument('-frames', type=int, default=300, help="Frames to process")
+    args = parser.parse_args()
+
+    frames = []
+    for img in video_frames(args.input):
+        frames.append(img)
+        if len(frames) == args.frames:
+            break
+
+    estimator = HeadposeEstimator()
+    results = {}
+    for name, controller in (('full', None), ('adaptive', ResolutionController(args.min_face))):
+        estimator.controller = controller
+        start = time.perf_counter()
+        results[name] = [estimator.process(img, index) for index, img in enumerate(frames)]
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: {elapsed / len(frames) * 1000:.1f} ms/frame, "
+              f"{sum(len(faces) for faces in results[name])} faces")
+        if controller is not None:
+            print(controller.report())
+
+    # Angle differences on the frames where both runs found the same number of faces
+    diffs = [np.abs(np.degrees(a['euler'] - b['euler'])).T
+             for a, b in zip(results['full'], results['adaptive']) if len(a) == len(b) and len(a)]
+    if diffs:
+        diffs = np.concatenate(diffs, axis=1)
+        print(f"Mean absolute difference: pitch {diffs[0].mean():.2f} deg, yaw {diffs[1].mean():.2f} deg, "
+              f"roll {diffs[2].mean():.2f} deg")
@@ -0,0 +1,157 @@
+"""
+Lightweight IoU tracker that keeps stable identities for bounding boxes across video frames.
+
+Boxes are given as (x, y, x1, y1) pixel coordinates, the same convention used by `find_faces`.
+The association between existing tracks and new detections is done on a vectorized IoU matrix,
+so the cost per frame only depends on the number of boxes, not on the frame resolution.
+"""
+
+import numpy as np
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    Compute the pairwise intersection-over-union of two sets of boxes
+
+    Parameters
+    ----------
+    boxes_a : array-like, shape (N, 4)
+        Boxes as (x, y, x1, y1)
+    boxes_b : array-like, shape (M, 4)
+        Boxes as (x, y, x1, y1)
+
+    Returns
+    -------
+    iou : np.ndarray, shape (N, M)
+        IoU of every box in boxes_a against every box in boxes_b
+
+    """
+    a = np.asarray(boxes_a, dtype=float).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=float).reshape(-1, 4)
+    ix0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    iy0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    ix1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    iy1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(ix1 - ix0, 0, None) * np.clip(iy1 - iy0, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+
+def match_boxes(iou, min_iou=0.3):
+    """
+    Greedily assign rows to columns of an IoU matrix, best overlaps first
+
+    Parameters
+    ----------
+    iou : np.ndarray, shape (N, M)
+        IoU matrix as returned by `iou_matrix`
+    min_iou : float, optional
+        Pairs with a lower overlap are never matched. The default is 0.3.
+
+    Returns
+    -------
+    pairs : list of tuple
+        Matched (row, column) index pairs
+
+    """
+    if iou.size == 0:
+        return []
+    # Visit candidate pairs in order of decreasing overlap
+    order = np.argsort(iou, axis=None)[::-1]
+    rows, cols = np.unravel_index(order, iou.shape)
+    keep = iou[rows, cols] >= min_iou
+    rows, cols = rows[keep], cols[keep]
+
+    pairs = []
+    used_rows = np.zeros(iou.shape[0], dtype=bool)
+    used_cols = np.zeros(iou.shape[1], dtype=bool)
+    for r, c in zip(rows, cols):
+        if used_rows[r] or used_cols[c]:
+            continue
+        used_rows[r] = True
+        used_cols[c] = True
+        pairs.append((int(r), int(c)))
+    return pairs
+
+
+class BoxTracker:
+    """Keep track identities for boxes detected in consecutive frames"""
+
+    def __init__(self, min_iou=0.3, max_missed=30, max_tracks=None):
+        """
+        Parameters
+        ----------
+        min_iou : float, optional
+            Minimum overlap to continue a track. The default is 0.3.
+        max_missed : int, optional
+            Number of consecutive updates without a match before a track is dropped. The default is 30.
+        max_tracks : int, optional
+            Maximum number of simultaneous tracks. The default is None (no limit).
+
+        """
+        self.min_iou = min_iou
+        self.max_missed = max_missed
+        self.max_tracks = max_tracks
+        self.next_id = 0
+        self.ids = []
+        self.boxes = np.zeros((0, 4))
+        self.missed = np.zeros(0, dtype=int)
+
+    def update(self, detections):
+        """
+        Associate new detections with the existing tracks
+
+        Parameters
+        ----------
+        detections : array-like, shape (M, 4)
+            Boxes detected in the current frame as (x, y, x1, y1)
+
+        Returns
+        -------
+        tracks : dict
+            Track ID -> box for every track matched or started in this frame
+
+        """
+        detections = np.asarray(detections, dtype=float).reshape(-1, 4)
+        pairs = match_boxes(iou_matrix(self.boxes, detections), self.min_iou)
+
+        matched_tracks = np.zeros(len(self.ids), dtype=bool)
+        matched_dets = np.zeros(len(detections), dtype=bool)
+        for t, d in pairs:
+            self.boxes[t] = detections[d]
+            matched_tracks[t] = True
+            matched_dets[d] = True
+
+        self.missed = np.where(matched_tracks, 0, self.missed + 1)
+        alive = self.missed <= self.max_missed
+        self.ids = [i for i, a in zip(self.ids, alive) if a]
+        self.boxes = self.boxes[alive]
+        matched_tracks = matched_tracks[alive]
+        self.missed = self.missed[alive]
+
+        # Start new tracks for the detections nobody claimed, largest boxes first
+        new = detections[~matched_dets]
+        areas = (new[:, 2] - new[:, 0]) * (new[:, 3] - new[:, 1])
+        new = new[np.argsort(-areas)]
+        if self.max_tracks is not None:
+            new = new[:max(0, self.max_tracks - len(self.ids))]
+        for box in new:
+            self.ids.append(self.next_id)
+            self.next_id += 1
+        self.boxes = np.vstack((self.boxes, new))
+        self.missed = np.concatenate((self.missed, np.zeros(len(new), dtype=int)))
+        matched_tracks = np.concatenate((matched_tracks, np.ones(len(new), dtype=bool)))
+
+        return {i: self.boxes[k].copy() for k, i in enumerate(self.ids) if matched_tracks[k]}
+
+    def set_box(self, track_id, box):
+        """Overwrite the box of a track, e.g. with a refined box from a landmark model"""
+        k = self.ids.index(track_id)
+        self.boxes[k] = box
+        self.missed[k] = 0
+
+    def active(self):
+        """Return a dict of track ID -> box for all tracks that are currently alive"""
+        return {i: self.boxes[k].copy() for k, i in enumerate(self.ids)}
@@ -0,0 +1,150 @@
+"""
+Periodic checkpoints for long video jobs, so a crashed or killed run can resume where it stopped.
+
+A checkpoint holds everything a script needs to continue: the results so far, the index of the next frame and
+the state of its trackers. It is written atomically (temporary file + rename), so a job killed while writing
+keeps the previous checkpoint.
+
+MediaPipe keeps internal tracking state that cannot be saved. A resumed bodypose run is only identical to an
+uninterrupted one if it restarts from a frame where that state is empty, i.e. right after a frame without
+detection (the model runs its detector again on the next frame, as a fresh model does). `Checkpoint.due` lets the
+caller wait for such a safe frame once the interval has elapsed, and only falls back to an inexact checkpoint if
+no safe frame comes within `max_wait` intervals.
+
+The annotated video cannot be appended to after a crash (an MP4 killed while writing has no index), so the video
+is written in parts closed at every checkpoint and concatenated at the end.
+"""
+
+import os
+import time
+import pickle
+import cv2
+
+from utils.render_annotations import concat_segments
+
+
+class Checkpoint:
+    """Checkpoint file of one job"""
+
+    def __init__(self, path, interval=60.0, max_wait=2.0):
+        """
+        Parameters
+        ----------
+        path : string
+            Checkpoint file
+        interval : float, optional
+            Seconds between checkpoints. The default is 60.
+        max_wait : float, optional
+            Number of intervals to wait for a safe frame before writing an inexact checkpoint. The default is 2.
+
+        """
+        self.path = path
+        self.interval = interval
+        self.max_wait = max_wait
+        self.last = time.monotonic()
+
+    def due(self, safe=True):
+        """
+        Check if a checkpoint should be written now
+
+        Parameters
+        ----------
+        safe : bool, optional
+            Whether resuming from the current frame gives the same results as an uninterrupted run. The default
+            is True.
+
+        Returns
+        -------
+        due : bool
+
+        """
+        elapsed = time.monotonic() - self.last
+        return elapsed >= self.interval and (safe or elapsed >= self.interval * self.max_wait)
+
+    def save(self, state):
+        """Write the state (any picklable dict) atomically"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last = time.monotonic()
+        print(f"Checkpoint saved at frame {state.get('next_frame')} to {self.path}")
+
+    def load(self):
+        """Return the saved state, or None if there is no checkpoint"""
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        if not state.get('exact', True):
+            print("Warning: the checkpoint was not taken at a safe frame, the first frames after resuming may differ")
+        return state
+
+    def remove(self):
+        """Delete the checkpoint once the job is complete"""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def part_path(video_path, part):
+    """Path of one part of a video written in parts"""
+    root, ext = os.path.splitext(video_path)
+    return f"{root}.part{part:03d}{ext}"
+
+
+class VideoParts:
+    """
+    cv2.VideoWriter that closes the current part and starts a new one at every checkpoint
+
+    Without parts (split=False), it writes directly to the output video like a plain cv2.VideoWriter.
+    """
+
+    def __init__(self, path, fps, size, split=False, part=0):
+        """
+        Parameters
+        ----------
+        path : string
+            Final output video
+        fps : float
+        size : tuple
+            (width, height)
+        split : bool, optional
+            Write the video in parts. The default is False.
+        part : int, optional
+            Index of the first part to write, from the checkpoint when resuming. The default is 0.
+
+        """
+        self.path = path
+        self.fps = fps
+        self.size = size
+        self.split_parts = split
+        self.part = part
+        self.fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.out = self._open()
+
+    def _open(self):
+        path = part_path(self.path, self.part) if self.split_parts else self.path
+        return cv2.VideoWriter(path, self.fourcc, self.fps, self.size)
+
+    def write(self, img):
+        self.out.write(img)
+
+    def split(self):
+        """Close the current part, so it survives a crash, and continue in the next one"""
+        if self.split_parts:
+            self.out.release()
+            self.part += 1
+            self.out = self._open()
+        return self.part
+
+    def release(self):
+        """Close the video and join the parts into the final output"""
+        self.out.release()
+        if self.split_parts:
+            paths = [part_path(self.path, k) for k in range(self.part + 1)]
+            paths = [p for p in paths if os.path.isfile(p)]
+            concat_segments(paths, self.path, self.fps, self.size)
+            for p in paths:
+                os.remove(p)
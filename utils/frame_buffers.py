@@ -0,0 +1,165 @@
+"""
+Reusable frame and crop buffers for the per-frame loops.
+
+Without them, every frame allocates a new array in `cap.read()`, another one in each `cv2.cvtColor` and another
+one in each `cv2.resize`. `FrameBuffers` keeps one preallocated array per named buffer and passes it as the
+output of those calls (`cap.read(image)`, `dst=`), so after the first frame the loop does not allocate frame-sized
+arrays anymore. A buffer is only reallocated when the shape of the output changes; face crops of any size are
+resized into the same 128x128 buffer.
+
+`FrameBuffers(enabled=False)` runs the same calls without buffers, which is the old behaviour. The comparison
+below measures with tracemalloc (which sees the arrays NumPy and OpenCV allocate) the memory allocated inside each
+frame of a decode, convert and resize loop in both modes.
+
+Usage (allocation and memory comparison on a long clip):
+    python frame_buffers.py -input <video> [-frames 3000]
+"""
+
+import os
+import sys
+import json
+import argparse
+import resource
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import cv2
+
+
+class FrameBuffers:
+    """Named preallocated output arrays for the OpenCV calls of a per-frame loop"""
+
+    def __init__(self, enabled=True):
+        """
+        Parameters
+        ----------
+        enabled : bool, optional
+            Reuse the buffers. If False, every call allocates its output. The default is True.
+
+        """
+        self.enabled = enabled
+        self.buffers = {}
+
+    def _keep(self, name, out):
+        """Keep the output as the buffer of the next call"""
+        if self.enabled:
+            self.buffers[name] = out
+        return out
+
+    def _buffer(self, name):
+        buf = self.buffers.get(name) if self.enabled else None
+        if buf is not None:
+            buf.flags.writeable = True
+        return buf
+
+    def read(self, cap, name='frame'):
+        """cap.read() into the named buffer"""
+        buf = self._buffer(name)
+        ret, img = cap.read(buf) if buf is not None else cap.read()
+        if ret:
+            self._keep(name, img)
+        return ret, img
+
+    def cvt_color(self, src, code, name):
+        """cv2.cvtColor into the named buffer. src may be the buffer itself for in-place conversions."""
+        buf = self._buffer(name)
+        out = cv2.cvtColor(src, code, dst=buf) if buf is not None else cv2.cvtColor(src, code)
+        return self._keep(name, out)
+
+    def resize(self, src, dsize, name, interpolation=cv2.INTER_LINEAR):
+        """cv2.resize into the named buffer"""
+        buf = self._buffer(name)
+        if buf is not None and buf.shape[:2] != (dsize[1], dsize[0]):
+            buf = None
+        out = (cv2.resize(src, dsize, dst=buf, interpolation=interpolation) if buf is not None
+               else cv2.resize(src, dsize, interpolation=interpolation))
+        return self._keep(name, out)
+
+
+class RowBuffer:
+    """Preallocated (rows, columns) array that grows by doubling, instead of np.vstack on every frame"""
+
+    def __init__(self, columns, capacity=1024):
+        self.data = np.zeros((max(capacity, 1), columns))
+        self.size = 0
+
+    def append(self, row):
+        if self.size == len(self.data):
+            self.data = np.vstack((self.data, np.zeros_like(self.data)))
+        self.data[self.size] = row
+        self.size += 1
+
+    def array(self):
+        """View of the rows filled so far"""
+        return self.data[:self.size]
+
+
+def run_loop(input_video, frames, enabled):
+    """
+    Decode, convert and resize like the bodypose loop, without the model
+
+    Returns
+    -------
+    stats : dict
+        Memory allocated within each frame (tracemalloc, mean over the frames), tracemalloc peak, peak RSS and
+        time per frame
+
+    """
+    tracemalloc.start()
+    buffers = FrameBuffers(enabled)
+    cap = cv2.VideoCapture(input_video)
+    rows = RowBuffer(99) if enabled else None
+    data_land = np.zeros((0, 99))
+    n = 0
+    allocated = 0
+    start = time.perf_counter()
+    while n < frames:
+        # Memory allocated within the frame: the highest traced memory reached during the frame above the memory
+        # held before it
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        ret, image = buffers.read(cap)
+        if not ret:
+            break
+        rgb = buffers.cvt_color(image, cv2.COLOR_BGR2RGB, 'rgb')
+        if not enabled:
+            # The old loop converted back to BGR before drawing
+            image = buffers.cvt_color(rgb, cv2.COLOR_RGB2BGR, 'bgr')
+        dim = (int(image.shape[1] * 0.45), int(image.shape[0] * 0.45))
+        buffers.resize(image, dim, 'display', interpolation=cv2.INTER_AREA)
+        if enabled:
+            rows.append(np.zeros(99))
+        else:
+            data_land = np.vstack((data_land, np.zeros(99)))
+        allocated += tracemalloc.get_traced_memory()[1] - before
+        n += 1
+    elapsed = time.perf_counter() - start
+    cap.release()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'frames': n, 'allocated_kb_per_frame': allocated / max(n, 1) / 1024,
+            'tracemalloc_peak_mb': peak / 2**20,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'ms_per_frame': elapsed / max(n, 1) * 1000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare allocations and memory with and without frame buffers.")
+    parser.add_argument('-input', required=True, help="Input video (the longer the better)")
+    parser.add_argument('-frames', type=int, default=3000, help="Maximum number of frames")
+    parser.add_argument('-mode', choices=['pooled', 'plain'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        # Child process, so that the peak RSS of each mode is measured on its own
+        print(json.dumps(run_loop(args.input, args.frames, args.mode == 'pooled')))
+    else:
+        for mode in ('plain', 'pooled'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '-input', args.input,
+                                     '-frames', str(args.frames), '-mode', mode],
+                                    capture_output=True, text=True, check=True).stdout
+            stats = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>7}: {stats['frames']} frames, {stats['allocated_kb_per_frame']:.0f} kB allocated per frame, "
+                  f"tracemalloc peak {stats['tracemalloc_peak_mb']:.1f} MB, peak RSS {stats['max_rss_mb']:.1f} MB, "
+                  f"{stats['ms_per_frame']:.2f} ms/frame")
@@ -0,0 +1,278 @@
+"""
+Decode a video once and fan the frames out to several analyzers running concurrently.
+
+Running estimate_bodypose.py and head_pose_estimation.py on the same recording decodes the video twice and
+converts every frame to RGB twice. The frame bus decodes each frame once, converts it to RGB once if any
+analyzer needs it, marks both arrays read-only and hands the same objects to every registered analyzer. The
+SSD face detector also runs once per frame on the bus when an analyzer needs the face boxes (`headpose`, `faces`),
+and the boxes are shared with the frame.
+Each analyzer runs in its own thread (OpenCV DNN, TensorFlow and MediaPipe release the GIL while they run)
+behind a bounded queue, so a slow analyzer applies back-pressure to the decoder instead of buffering the video.
+
+Analyzers write their own outputs:
+- `bodypose`: MediaPipe Holistic, `<video>__bodypose.csv` with the same 99 columns as estimate_bodypose.py
+- `headpose`: SSD face detector + CNN landmarks + solvePnP, `<video>_headpose.csv` (see HEADPOSE_COLUMNS in
+  headpose_core.py)
+- `faces`: SSD face detector only, `<video>_faces.csv` with one row per face (frame, x, y, x1, y1)
+
+Usage:
+    python frame_bus.py -input <video> -analyzers bodypose headpose [faces] -out_dir <output_folder>
+"""
+
+import os
+import sys
+import queue
+import argparse
+import threading
+import time
+import numpy as np
+import cv2
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEADPOSE_DIR = os.path.join(REPO_DIR, 'headpose', 'opencv_dlib_custom')
+sys.path.append(REPO_DIR)
+from utils.seek_index import true_frame_count
+
+
+class Frame:
+    """One decoded frame shared read-only by all the analyzers"""
+
+    __slots__ = ('index', 'timestamp', 'bgr', 'rgb', 'faces')
+
+    def __init__(self, index, timestamp, bgr, rgb=None, faces=None):
+        self.index = index
+        self.timestamp = timestamp
+        self.bgr = bgr
+        self.rgb = rgb
+        self.faces = faces  # face boxes (x, y, x1, y1) of the bus detector, if an analyzer needs them
+
+
+class Analyzer:
+    """Base class of the analyzers registered on a FrameBus"""
+
+    name = 'analyzer'
+    needs_rgb = False
+    needs_faces = False
+    face_model = None  # face detector of the bus, set before open() when needs_faces
+
+    def open(self, video_path, fps, size, out_dir):
+        """Load the models and prepare the outputs. size is (width, height)."""
+
+    def process(self, frame):
+        """Analyze one frame. frame.bgr is None when the frame could not be decoded."""
+        raise NotImplementedError
+
+    def close(self):
+        """Write the outputs and release the models"""
+
+
+class BodyposeAnalyzer(Analyzer):
+    """MediaPipe Holistic pose landmarks, saved like estimate_bodypose.py"""
+
+    name = 'bodypose'
+    needs_rgb = True
+
+    def open(self, video_path, fps, size, out_dir):
+        import mediapipe as mp
+        sys.path.append(os.path.join(REPO_DIR, 'bodypose'))
+        from multiperson_bodypose import crop_to_frame
+        self.crop_to_frame = crop_to_frame
+        self.holistic = mp.solutions.holistic.Holistic(min_detection_confidence=0.9, min_tracking_confidence=0.9)
+        self.size = size
+        self.rows = []
+        self.last = np.zeros(99)
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        self.output_csv_path = os.path.join(out_dir, video_name + "__bodypose.csv")
+
+    def process(self, frame):
+        if frame.rgb is not None:
+            results = self.holistic.process(frame.rgb)
+            if results.pose_landmarks is not None:
+                w, h = self.size
+                self.last = self.crop_to_frame(results.pose_landmarks, (0, 0, w, h), (h, w))
+        # Detection failures repeat the previous detection
+        self.rows.append(self.last)
+
+    def close(self):
+        self.holistic.close()
+        np.savetxt(self.output_csv_path, np.array(self.rows).reshape(-1, 99), delimiter=',')
+        print(f"Saved bodypose data to {self.output_csv_path}")
+
+
+def load_face_detector():
+    """SSD face detector of head_pose_estimation.py"""
+    sys.path.append(HEADPOSE_DIR)
+    from face_detector import get_face_detector
+    return get_face_detector(modelFile=os.path.join(HEADPOSE_DIR, "models/res10_300x300_ssd_iter_140000.caffemodel"),
+                             configFile=os.path.join(HEADPOSE_DIR, "models/deploy.prototxt"))
+
+
+class FaceAnalyzer(Analyzer):
+    """Face boxes of the bus detector"""
+
+    name = 'faces'
+    needs_faces = True
+
+    def open(self, video_path, fps, size, out_dir):
+        self.rows = []
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        self.output_csv_path = os.path.join(out_dir, f"{video_name}_{self.name}.csv")
+
+    def process(self, frame):
+        if frame.bgr is None:
+            return
+        for face in frame.faces:
+            self.rows.append([frame.index] + list(face))
+
+    def close(self):
+        np.savetxt(self.output_csv_path, np.array(self.rows).reshape(-1, 5), delimiter=',', fmt='%d',
+                   header='frame,x,y,x1,y1', comments='')
+        print(f"Saved face detections to {self.output_csv_path}")
+
+
+class HeadposeAnalyzer(FaceAnalyzer):
+    """CNN landmarks and solvePnP on the faces of the bus detector, as in head_pose_estimation.py"""
+
+    name = 'headpose'
+
+    def open(self, video_path, fps, size, out_dir):
+        super().open(video_path, fps, size, out_dir)
+        from headpose_core import save_headpose_csv
+        from headpose_estimator import HeadposeEstimator, csv_rows
+        self.save_headpose_csv = save_headpose_csv
+        self.csv_rows = csv_rows
+        self.estimator = HeadposeEstimator(face_model=self.face_model)
+
+    def process(self, frame):
+        if frame.bgr is None:
+            return
+        self.rows.extend(self.csv_rows(self.estimator.process(frame.bgr, frame.index, faces=frame.faces)))
+
+    def close(self):
+        self.save_headpose_csv(self.output_csv_path, self.rows)
+        print(f"Saved headpose data to {self.output_csv_path}")
+
+
+ANALYZERS = {cls.name: cls for cls in (BodyposeAnalyzer, HeadposeAnalyzer, FaceAnalyzer)}
+
+
+class FrameBus:
+    """Decode a video once and feed every frame to a set of analyzers"""
+
+    def __init__(self, video_path, analyzers, out_dir, queue_size=8):
+        """
+        Parameters
+        ----------
+        video_path : string
+            Input video
+        analyzers : list of Analyzer
+            Analyzers to run on every frame
+        out_dir : string
+            Folder for the analyzer outputs
+        queue_size : int, optional
+            Frames buffered per analyzer before the decoder waits. The default is 8.
+
+        """
+        self.video_path = video_path
+        self.analyzers = analyzers
+        self.out_dir = out_dir
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in analyzers]
+        self.errors = []
+        self.busy = [0.0] * len(analyzers)
+
+    def _worker(self, k):
+        analyzer, q = self.analyzers[k], self.queues[k]
+        while True:
+            frame = q.get()
+            if frame is None:
+                break
+            if self.errors:
+                continue  # keep draining so the decoder never blocks
+            try:
+                start = time.perf_counter()
+                analyzer.process(frame)
+                self.busy[k] += time.perf_counter() - start
+            except Exception as e:
+                self.errors.append((analyzer.name, e))
+
+    def run(self):
+        """
+        Decode the video and wait until every analyzer is done
+
+        Returns
+        -------
+        frames : int
+            Number of frames sent to the analyzers
+
+        """
+        cap = cv2.VideoCapture(self.video_path)
+        if not cap.isOpened():
+            raise IOError(f"Unable to open {self.video_path}")
+        # From the seek index, as estimate_bodypose.py, so the CSV files have the same length
+        frame_count = true_frame_count(self.video_path)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        needs_rgb = any(a.needs_rgb for a in self.analyzers)
+        # One detector for all the analyzers that need the face boxes, run once per frame
+        face_model = load_face_detector() if any(a.needs_faces for a in self.analyzers) else None
+        if face_model is not None:
+            from face_detector import find_faces
+
+        for analyzer in self.analyzers:
+            if analyzer.needs_faces:
+                analyzer.face_model = face_model
+            analyzer.open(self.video_path, fps, size, self.out_dir)
+        threads = [threading.Thread(target=self._worker, args=(k,), daemon=True) for k in range(len(self.analyzers))]
+        for t in threads:
+            t.start()
+
+        idx = 0
+        start = time.perf_counter()
+        while not self.errors:
+            success, image = cap.read()
+            if not success:
+                # Same convention as estimate_bodypose.py: failures before the end count as frames
+                if idx < frame_count:
+                    frame = Frame(idx, idx / fps if fps else 0.0, None)
+                else:
+                    break
+            else:
+                image.flags.writeable = False
+                rgb = None
+                if needs_rgb:
+                    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    rgb.flags.writeable = False
+                faces = find_faces(image, face_model) if face_model is not None else None
+                frame = Frame(idx, idx / fps if fps else 0.0, image, rgb, faces)
+            for q in self.queues:
+                q.put(frame)
+            idx += 1
+        cap.release()
+
+        for q in self.queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        if self.errors:
+            name, error = self.errors[0]
+            raise RuntimeError(f"Analyzer {name} failed") from error
+
+        for analyzer in self.analyzers:
+            analyzer.close()
+        print(f"Processed {idx} frames in {elapsed:.1f} s ({idx / max(elapsed, 1e-9):.1f} fps)")
+        for analyzer, busy in zip(self.analyzers, self.busy):
+            print(f"  {analyzer.name}: {busy:.1f} s busy")
+        return idx
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several analyzers on one decode of a video.")
+    parser.add_argument('-input', required=True, help="Input video")
+    parser.add_argument('-analyzers', nargs='+', required=True, choices=list(ANALYZERS))
+    parser.add_argument('-out_dir', default='.', help="Output folder")
+    args = parser.parse_args()
+
+    sys.path.append(HEADPOSE_DIR)
+    bus = FrameBus(args.input, [ANALYZERS[name]() for name in args.analyzers], args.out_dir)
+    bus.run()
@@ -0,0 +1,298 @@
+"""
+Render annotated videos from stored bodypose and headpose results, only when they are needed.
+
+estimate_bodypose.py (-render off) and head_pose_estimation.py (--no_render) can skip drawing and writing the
+annotated video, which most runs never watch. This script draws the same annotations afterwards from the
+source video and the stored CSV files:
+- bodypose: `__bodypose.csv` (or `__bodypose_p<id>.csv` of the multi-person mode), 99 columns per frame, and the
+  `__hands.csv` file that the hands and holistic tiers write next to it (see model_tiers.py), and with -face the
+  `__face.csv` file of the holistic tier, which the inline rendering does not draw
+- headpose: `_headpose.csv` (see HEADPOSE_COLUMNS in headpose/opencv_dlib_custom/headpose_core.py)
+
+The frame range is split into segments rendered in parallel worker processes, and the segments are concatenated
+at the end (with ffmpeg if available, otherwise with OpenCV). A single time range can be rendered with -start and
+-end without processing the rest of the video.
+
+Usage:
+    python render_annotations.py -input <video> [-bodypose <csv> ...] [-headpose <csv>] [-start 10 -end 20]
+                                 [-face] [-workers 4] -out <annotated.mp4>
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEADPOSE_DIR = os.path.join(REPO_DIR, 'headpose', 'opencv_dlib_custom')
+sys.path.append(REPO_DIR)
+from utils.seek_index import SeekReader, SeekIndex, true_frame_count
+
+
+def open_at(video_path, start):
+    """
+    Open a video positioned at a frame
+
+    Returns
+    -------
+    cap : cv2.VideoCapture
+        Capture whose next read() returns frame `start`, positioned with the seek index of the video
+        (see seek_index.py)
+
+    """
+    index = SeekIndex.for_video(video_path) if start > 0 else None
+    if index is not None:
+        reader = SeekReader(video_path, index)
+        reader.seek(min(start, index.frame_count))
+        return reader.cap
+    cap = cv2.VideoCapture(video_path)
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+            # The container does not seek exactly, decode from the beginning instead
+            cap.release()
+            cap = cv2.VideoCapture(video_path)
+            for _ in range(start):
+                cap.grab()
+    return cap
+
+
+def load_headpose(csv_path):
+    """Headpose rows grouped by frame: dict frame -> (faces, columns) array"""
+    data = np.loadtxt(csv_path, delimiter=',', skiprows=1, ndmin=2)
+    if len(data) == 0:
+        return {}
+    data = data[np.argsort(data[:, 0], kind='stable')]
+    frames, first = np.unique(data[:, 0].astype(int), return_index=True)
+    return dict(zip(frames, np.split(data, first[1:])))
+
+
+def tier_outputs(bodypose_path, face=False):
+    """
+    CSV files written with a bodypose CSV by its model tier
+
+    Parameters
+    ----------
+    bodypose_path : string
+        Bodypose CSV file
+    face : bool, optional
+        Include the `__face.csv` file of the holistic tier. The default is False.
+
+    Returns
+    -------
+    paths : dict
+        'bodypose' -> bodypose_path, and 'hands' / 'face' -> `__hands.csv` / `__face.csv` next to it if they exist
+        (and face is set)
+
+    """
+    paths = {'bodypose': bodypose_path}
+    if bodypose_path.endswith('__bodypose.csv'):
+        stem = bodypose_path[:-len('__bodypose.csv')]
+        for name in ('hands', 'face') if face else ('hands',):
+            if os.path.exists(f"{stem}__{name}.csv"):
+                paths[name] = f"{stem}__{name}.csv"
+    return paths
+
+
+def draw_row(img, row, drawing, connections, landmark_pb2):
+    """Draw landmarks stored as x, y, z columns, unless they were not found (all zeros)"""
+    if not np.any(row):
+        return
+    landmarks = landmark_pb2.NormalizedLandmarkList()
+    for x, y, z in row.reshape(-1, 3):
+        landmarks.landmark.add(x=x, y=y, z=z)
+    drawing.draw_landmarks(img, landmarks, connections)
+
+
+def draw_bodypose(img, rows, mp, landmark_pb2):
+    """
+    Draw the landmarks of one person in one frame, as draw_result of model_tiers.py does, plus the face
+    contours if a face row is given
+
+    Parameters
+    ----------
+    rows : dict
+        'bodypose' -> 99-column row, and optionally 'hands' -> 126-column row (left then right hand) and
+        'face' -> 1404-column row
+
+    """
+    drawing = mp.solutions.drawing_utils
+    if 'hands' in rows:
+        half = len(rows['hands']) // 2
+        draw_row(img, rows['hands'][:half], drawing, mp.solutions.hands.HAND_CONNECTIONS, landmark_pb2)
+        draw_row(img, rows['hands'][half:], drawing, mp.solutions.hands.HAND_CONNECTIONS, landmark_pb2)
+    draw_row(img, rows['bodypose'], drawing, mp.solutions.pose.POSE_CONNECTIONS, landmark_pb2)
+    if 'face' in rows:
+        draw_row(img, rows['face'], drawing, mp.solutions.face_mesh.FACEMESH_CONTOURS, landmark_pb2)
+
+
+def draw_headpose(img, rows, core, camera_matrix):
+    """Draw the head pose of the faces of one frame, as head_pose_estimation.py does"""
+    columns = core.HEADPOSE_COLUMNS
+    r0, t0, p0 = columns.index('rx'), columns.index('tx'), columns.index('p0_x')
+    for row in rows:
+        image_points = row[p0:p0 + 2 * len(core.MODEL_POINTS)].reshape(-1, 2)
+        rotation_vector = row[r0:r0 + 3].reshape(3, 1)
+        translation_vector = row[t0:t0 + 3].reshape(3, 1)
+        ang1, ang2, (p1, p2), (x1, x2) = core.head_angles(img, image_points, rotation_vector, translation_vector, camera_matrix)
+        pitch, yaw, _ = core.pose_degrees(rotation_vector)
+        core.draw_head_pose(img, image_points, p1, p2, x1, x2, pitch, yaw)
+
+
+def render_segment(video_path, start, end, out_path, bodypose_paths, headpose_path, face=False):
+    """
+    Render frames [start, end) of a video to out_path
+
+    Returns
+    -------
+    frames : int
+        Number of frames written
+
+    """
+    # Per person: every CSV of its tier
+    bodypose = [{name: np.loadtxt(path, delimiter=',', ndmin=2) for name, path in tier_outputs(p, face).items()}
+                for p in bodypose_paths]
+    if bodypose:
+        import mediapipe as mp
+        from mediapipe.framework.formats import landmark_pb2
+    headpose = {}
+    if headpose_path:
+        sys.path.append(HEADPOSE_DIR)
+        import headpose_core as core
+        headpose = load_headpose(headpose_path)
+
+    cap = open_at(video_path, start)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    camera_matrix = None
+    out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+
+    idx = start
+    img = None
+    while idx < end:
+        ret, img = cap.read(img) if img is not None else cap.read()
+        if not ret:
+            break
+        for data in bodypose:
+            rows = {name: values[idx] for name, values in data.items() if idx < len(values)}
+            if 'bodypose' in rows:
+                draw_bodypose(img, rows, mp, landmark_pb2)
+        if idx in headpose:
+            if camera_matrix is None:
+                camera_matrix = core.get_camera_matrix(img.shape)
+            draw_headpose(img, headpose[idx], core, camera_matrix)
+        out.write(img)
+        idx += 1
+    cap.release()
+    out.release()
+    return idx - start
+
+
+def concat_segments(segment_paths, out_path, fps, size):
+    """Concatenate the rendered segments, without re-encoding if ffmpeg is available"""
+    if shutil.which('ffmpeg'):
+        list_path = out_path + '.segments.txt'
+        with open(list_path, 'w') as f:
+            for path in segment_paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                        '-c', 'copy', out_path], check=True)
+        os.remove(list_path)
+        return
+    out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for path in segment_paths:
+        cap = cv2.VideoCapture(path)
+        img = None
+        while True:
+            ret, img = cap.read(img) if img is not None else cap.read()
+            if not ret:
+                break
+            out.write(img)
+        cap.release()
+    out.release()
+
+
+def render(video_path, out_path, bodypose_paths=(), headpose_path=None, start=0.0, end=None, workers=None,
+           face=False):
+    """
+    Render the annotated video of a time range with parallel workers
+
+    Parameters
+    ----------
+    video_path : string
+        Source video
+    out_path : string
+        Annotated video to write
+    bodypose_paths : list of string, optional
+        Bodypose CSV files, one per person. The default is none.
+    headpose_path : string, optional
+        Headpose CSV file. The default is None.
+    start : float, optional
+        Start of the range in seconds. The default is 0.
+    end : float, optional
+        End of the range in seconds. The default is the end of the video.
+    workers : int, optional
+        Number of worker processes (and segments). The default is the number of cores.
+    face : bool, optional
+        Also draw the face contours of the holistic tier (`__face.csv`). The default is False, like the inline
+        rendering of estimate_bodypose.py.
+
+    Returns
+    -------
+    frames : int
+        Number of frames rendered
+
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    cap.release()
+    # True frame count, from the seek index that the workers use, built once before they start
+    frame_count = true_frame_count(video_path)
+
+    first = int(round(start * fps))
+    last = frame_count if end is None else min(frame_count, int(round(end * fps)))
+    if last <= first:
+        raise ValueError(f"No frames to render between {start} s and {end} s ({frame_count} frames)")
+    workers = max(1, min(workers or os.cpu_count(), last - first))
+    bounds = np.unique(np.linspace(first, last, workers + 1).astype(int))
+    workers = len(bounds) - 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        segment_paths = [os.path.join(tmp_dir, f"segment_{k:03d}.mp4") for k in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(render_segment, video_path, bounds[k], bounds[k + 1], segment_paths[k],
+                                   list(bodypose_paths), headpose_path, face) for k in range(workers)]
+            counts = [f.result() for f in futures]
+        # A segment past the last decodable frame is empty, and an empty file breaks the concatenation
+        segment_paths = [path for path, count in zip(segment_paths, counts) if count > 0]
+        if not segment_paths:
+            raise ValueError(f"No frame of {video_path} could be read between {start} s and {end} s")
+        concat_segments(segment_paths, out_path, fps, size)
+    return sum(counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render an annotated video from stored pose results.")
+    parser.add_argument('-input', required=True, help="Source video")
+    parser.add_argument('-bodypose', nargs='*', default=[], help="Bodypose CSV files")
+    parser.add_argument('-headpose', help="Headpose CSV file")
+    parser.add_argument('-start', type=float, default=0.0, help="Start of the range in seconds")
+    parser.add_argument('-end', type=float, default=None, help="End of the range in seconds")
+    parser.add_argument('-face', action='store_true',
+                        help="Also draw the face contours of the holistic tier (__face.csv)")
+    parser.add_argument('-workers', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('-out', required=True, help="Annotated video to write")
+    args = parser.parse_args()
+
+    try:
+        frames = render(args.input, args.out, args.bodypose, args.headpose, args.start, args.end, args.workers,
+                        args.face)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Rendered {frames} frames to {args.out}")
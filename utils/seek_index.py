@@ -0,0 +1,301 @@
+"""
+Frame-accurate seek index of a video, saved as a sidecar file next to it.
+
+cv2.VideoCapture seeks with CAP_PROP_POS_FRAMES by converting the frame number to a timestamp with the nominal
+frame rate, which lands on the wrong frame on some containers (variable frame rate, start offsets), and
+CAP_PROP_FRAME_COUNT is an estimate from the container header. The index scans the video once, reading the
+packets without decoding them (CAP_PROP_FORMAT -1 of the FFmpeg backend), and records the true frame count, the
+timestamp of every frame and the keyframes. It is saved as `<video>.seek.npz` and rebuilt when the video changes.
+
+`SeekReader` reads any frame exactly: it seeks to the frame, checks from the timestamp of the last decoded frame
+where the capture actually is, and decodes forward from there. If the capture went past the frame, it seeks to
+the preceding keyframes instead, and as a last resort decodes from the start. A read close after the current
+position (within the same group of pictures) only decodes forward, so the cost of a random read is bounded by
+the keyframe interval.
+
+Usage:
+    python seek_index.py -input <video> [-check 50]
+"""
+
+import os
+import argparse
+import numpy as np
+import cv2
+
+INDEX_VERSION = 1
+
+
+def sidecar_path(video_path):
+    """Path of the index file of a video"""
+    return video_path + '.seek.npz'
+
+
+def scan_packets(video_path):
+    """
+    Timestamps and keyframe flags of the packets of a video, without decoding it
+
+    Returns
+    -------
+    pts : np.ndarray, shape (frames,)
+        Presentation timestamps in milliseconds, in decoding order
+    keys : np.ndarray of bool, shape (frames,)
+        None if the backend cannot read packets
+
+    """
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+    if not cap.isOpened() or not cap.set(cv2.CAP_PROP_FORMAT, -1):
+        cap.release()
+        return None
+    pts, keys = [], []
+    while cap.grab():
+        pts.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+        keys.append(bool(cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME)))
+    cap.release()
+    return np.array(pts), np.array(keys, dtype=bool)
+
+
+def scan_frames(video_path):
+    """Timestamps of the frames of a video by decoding it, when its packets cannot be read"""
+    cap = cv2.VideoCapture(video_path)
+    pts = []
+    while cap.grab():
+        pts.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+    cap.release()
+    return np.array(pts)
+
+
+class SeekIndex:
+    """True frame count, frame timestamps and keyframes of a video"""
+
+    def __init__(self, pts, keyframes, size=0, mtime=0):
+        self.pts = np.asarray(pts, dtype=float)
+        self.keyframes = np.asarray(keyframes, dtype=np.int64)
+        self.size = int(size)
+        self.mtime = int(mtime)
+        # Half the typical frame interval: a timestamp closer than this to a frame's is that frame
+        self.tolerance = 0.5 * np.median(np.diff(self.pts)) if len(self.pts) > 1 else 1.0
+
+    @property
+    def frame_count(self):
+        return len(self.pts)
+
+    @property
+    def exact(self):
+        """The timestamps identify the frames, so the position of the capture can be checked after a seek"""
+        return len(self.pts) < 2 or bool(np.all(np.diff(self.pts) > 0))
+
+    @classmethod
+    def build(cls, video_path):
+        """Scan a video and index it"""
+        stat = os.stat(video_path)
+        scanned = scan_packets(video_path)
+        if scanned is not None:
+            pts, keys = scanned
+            # Packets come in decoding order: the frames are in the order of their timestamps
+            display = np.sort(pts)
+            keyframes = np.searchsorted(display, pts[keys])
+        else:
+            display, keyframes = scan_frames(video_path), np.zeros(0, dtype=np.int64)
+        index = cls(display, np.union1d([0], keyframes), stat.st_size, stat.st_mtime_ns)
+        if not index.exact:
+            # Frames that share a timestamp cannot be told apart after a seek, decode from the start instead
+            index.keyframes = np.zeros(1, dtype=np.int64)
+        return index
+
+    def matches(self, video_path):
+        """The index was built from the current version of the video"""
+        stat = os.stat(video_path)
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime
+
+    def save(self, path):
+        """Save the index, atomically so that concurrent readers never see a partial file"""
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, version=INDEX_VERSION, pts=self.pts, keyframes=self.keyframes,
+                            size=self.size, mtime=self.mtime)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved index, None if it is missing or of another version"""
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != INDEX_VERSION:
+                    return None
+                return cls(data['pts'], data['keyframes'], int(data['size']), int(data['mtime']))
+        except (OSError, KeyError, ValueError):
+            return None
+
+    @classmethod
+    def for_video(cls, video_path):
+        """
+        Index of a video, from its sidecar file or built and saved if it is missing or outdated
+
+        Returns
+        -------
+        index : SeekIndex
+            None if video_path is not a file (e.g. a camera or a stream URL)
+
+        """
+        if not os.path.isfile(video_path):
+            return None
+        index = cls.load(sidecar_path(video_path))
+        if index is None or not index.matches(video_path):
+            index = cls.build(video_path)
+            try:
+                index.save(sidecar_path(video_path))
+            except OSError:
+                pass  # read-only folder, the index is rebuilt next time
+        return index
+
+    def keyframe_before(self, frame):
+        """Last keyframe at or before a frame"""
+        return int(self.keyframes[np.searchsorted(self.keyframes, frame, side='right') - 1])
+
+    def frame_at(self, msec):
+        """Index of the frame with the given timestamp, None if no frame has it"""
+        k = int(np.clip(np.searchsorted(self.pts, msec), 1, max(len(self.pts) - 1, 1)))
+        k = k - 1 if k == len(self.pts) or abs(self.pts[k - 1] - msec) <= abs(self.pts[k] - msec) else k
+        return k if len(self.pts) and abs(self.pts[k] - msec) < self.tolerance else None
+
+
+class SeekReader:
+    """Video capture that reads any frame exactly, with the seek index of the video"""
+
+    def __init__(self, video_path, index=None):
+        """
+        Parameters
+        ----------
+        video_path : string
+        index : SeekIndex, optional
+            The default is None (SeekIndex.for_video).
+
+        """
+        self.video_path = video_path
+        self.index = index if index is not None else SeekIndex.for_video(video_path)
+        self.cap = cv2.VideoCapture(video_path)
+        self.next = 0      # frame returned by the next read
+        self.decoded = 0   # frames decoded only to reach a position
+        self.seeks = 0
+
+    @property
+    def frame_count(self):
+        return self.index.frame_count
+
+    def _reopen(self):
+        self.cap.release()
+        self.cap = cv2.VideoCapture(self.video_path)
+        self.next = 0
+
+    def _seek_to(self, target):
+        """Seek the capture near a frame, returns the frame its next read gives, None if unknown"""
+        self.seeks += 1
+        if target == 0:
+            self._reopen()
+            return 0
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+        last = self.index.frame_at(self.cap.get(cv2.CAP_PROP_POS_MSEC)) if self.index.exact else None
+        return None if last is None else last + 1
+
+    def seek(self, frame):
+        """Position the capture so that its next read returns `frame`"""
+        if not 0 <= frame <= self.frame_count:
+            raise IndexError(f"Frame {frame} is out of range (0-{self.frame_count})")
+        key = self.index.keyframe_before(frame)
+        if not key <= self.next <= frame:
+            # Seek straight to the frame, then to the preceding keyframes if the capture went past it
+            targets = [frame] + [int(k) for k in self.index.keyframes[self.index.keyframes <= key][::-1][:2]]
+            for target in targets:
+                position = self._seek_to(target)
+                if position is not None and position <= frame:
+                    self.next = position
+                    break
+            else:
+                self._reopen()
+        while self.next < frame:
+            if not self.cap.grab():
+                break
+            self.next += 1
+            self.decoded += 1
+
+    def read(self, frame=None, image=None):
+        """
+        Read a frame
+
+        Parameters
+        ----------
+        frame : int, optional
+            Frame index. The default is None (the next frame).
+        image : np.uint8, optional
+            Buffer to decode into, as cv2.VideoCapture.read. The default is None.
+
+        Returns
+        -------
+        ret : bool
+        image : np.uint8
+
+        """
+        if frame is not None and frame != self.next:
+            self.seek(frame)
+        ret, image = self.cap.read(image) if image is not None else self.cap.read()
+        if ret:
+            self.next += 1
+        return ret, image
+
+    def release(self):
+        self.cap.release()
+
+
+def true_frame_count(video_path):
+    """True frame count of a video from its seek index, CAP_PROP_FRAME_COUNT if it cannot be indexed"""
+    index = SeekIndex.for_video(video_path)
+    if index is not None:
+        return index.frame_count
+    cap = cv2.VideoCapture(video_path)
+    count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return max(count, 0)
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="Index a video for frame-accurate seeking and check random reads.")
+    parser.add_argument('-input', required=True, help="Video to index")
+    parser.add_argument('-check', type=int, default=0, help="Number of random frames to compare with a sequential read")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = SeekIndex.build(args.input)
+    index.save(sidecar_path(args.input))
+    elapsed = time.perf_counter() - start
+    cap = cv2.VideoCapture(args.input)
+    header = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    gaps = np.diff(np.append(index.keyframes, index.frame_count))
+    print(f"{index.frame_count} frames (container header: {header}), {len(index.keyframes)} keyframes, "
+          f"longest keyframe interval {gaps.max() if len(gaps) else 0} frames, indexed in {elapsed:.2f} s")
+    print(f"Saved index to {sidecar_path(args.input)}")
+
+    if args.check:
+        frames = np.sort(np.random.default_rng(0).choice(index.frame_count, min(args.check, index.frame_count),
+                                                         replace=False))
+        # Reference frames from one sequential read
+        expected, wanted = {}, set(frames.tolist())
+        cap = cv2.VideoCapture(args.input)
+        for k in range(frames[-1] + 1):
+            ret, img = cap.read()
+            if k in wanted:
+                expected[k] = img
+        cap.release()
+
+        reader = SeekReader(args.input, index)
+        start = time.perf_counter()
+        wrong = 0
+        for k in np.random.default_rng(1).permutation(frames):
+            ret, img = reader.read(int(k))
+            wrong += not ret or not np.array_equal(img, expected[int(k)])
+        elapsed = time.perf_counter() - start
+        reader.release()
+        print(f"{len(frames)} random reads: {wrong} wrong frames, {elapsed / len(frames) * 1000:.1f} ms/read, "
+              f"{reader.decoded / len(frames):.1f} frames decoded forward and {reader.seeks / len(frames):.1f} seeks "
+              f"per read")
@@ -0,0 +1,286 @@
+"""
+Thread budget for running the bodypose, headpose and OpenFace pipelines side by side on one host.
+
+Each pipeline assumes it owns every core: OpenCV has its own thread pool, TensorFlow has intra-op and inter-op
+pools and MediaPipe/TFLite and OpenFace start their own threads. Running them together oversubscribes the CPU.
+The budget is a JSON file with one entry per pipeline:
+
+    {
+        "bodypose": {"cv2": 2, "workers": 3, "cpus": [0, 1, 2, 3]},
+        "headpose": {"cv2": 2, "tf_intra": 2, "tf_inter": 1, "cpus": [4, 5, 6]},
+        "openface": {"threads": 1, "cpus": [7]}
+    }
+
+- `cv2`: size of OpenCV's thread pool (cv2.setNumThreads)
+- `tf_intra`, `tf_inter`: TensorFlow intra-op and inter-op pool sizes
+- `threads`: OpenMP/BLAS threads (OMP_NUM_THREADS, OPENBLAS_NUM_THREADS), used by OpenFace and NumPy
+- `workers`: size of the worker pools of the pipeline (e.g. one pose model per person in multi-person mode)
+- `cpus`: optional list of cores the pipeline is pinned to. MediaPipe does not expose its thread count, pinning
+  is the way to bound it.
+
+Usage:
+    python thread_budget.py -propose -clip <video> [-pipelines bodypose headpose] [-cores 8] [-out budget.json]
+    python thread_budget.py -openface <budget.json> -- ./bin/FeatureExtraction -f video.mp4 ...
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import itertools
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.seek_index import true_frame_count
+
+DEFAULT_BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thread_budget.json')
+PIPELINES = ['bodypose', 'headpose', 'openface']
+
+
+def load_budget(pipeline, budget_path=None):
+    """
+    Read the budget of a pipeline
+
+    Parameters
+    ----------
+    pipeline : string
+        'bodypose', 'headpose' or 'openface'
+    budget_path : string, optional
+        Path to the budget JSON. The default is $THREAD_BUDGET, or utils/thread_budget.json if it exists.
+
+    Returns
+    -------
+    budget : dict
+        Budget of the pipeline, empty if there is no budget file or no entry for the pipeline
+
+    """
+    budget_path = budget_path or os.environ.get('THREAD_BUDGET') or DEFAULT_BUDGET
+    if not os.path.isfile(budget_path):
+        return {}
+    with open(budget_path) as f:
+        return json.load(f).get(pipeline, {})
+
+
+def budget_env(budget):
+    """Environment variables that carry a budget to libraries and child processes"""
+    env = {}
+    if 'threads' in budget:
+        for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            env[var] = str(budget['threads'])
+    if 'tf_intra' in budget:
+        env['TF_NUM_INTRAOP_THREADS'] = str(budget['tf_intra'])
+    if 'tf_inter' in budget:
+        env['TF_NUM_INTEROP_THREADS'] = str(budget['tf_inter'])
+    return env
+
+
+def apply_thread_budget(pipeline, budget_path=None):
+    """
+    Apply the budget of a pipeline to the current process
+
+    Call it before the first TensorFlow operation: TensorFlow cannot resize its pools once they exist.
+
+    Parameters
+    ----------
+    pipeline : string
+        'bodypose', 'headpose' or 'openface'
+    budget_path : string, optional
+        Path to the budget JSON. See load_budget.
+
+    Returns
+    -------
+    budget : dict
+        The applied budget (empty if none), so the caller can size its own worker pools with budget['workers']
+
+    """
+    budget = load_budget(pipeline, budget_path)
+    if not budget:
+        return budget
+
+    os.environ.update(budget_env(budget))
+    if 'cpus' in budget and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, budget['cpus'])
+    if 'cv2' in budget:
+        import cv2
+        cv2.setNumThreads(budget['cv2'])
+    if 'tensorflow' in sys.modules and ('tf_intra' in budget or 'tf_inter' in budget):
+        tf = sys.modules['tensorflow']
+        try:
+            if 'tf_intra' in budget:
+                tf.config.threading.set_intra_op_parallelism_threads(budget['tf_intra'])
+            if 'tf_inter' in budget:
+                tf.config.threading.set_inter_op_parallelism_threads(budget['tf_inter'])
+        except RuntimeError:
+            print("Warning: TensorFlow is already initialized, its thread pools keep their size")
+    print(f"Applied {pipeline} thread budget: {budget}")
+    return budget
+
+
+def run_with_budget(command, pipeline, budget_path=None):
+    """Run an external command (e.g. an OpenFace binary) with the budget of a pipeline"""
+    budget = load_budget(pipeline, budget_path)
+    env = dict(os.environ, **budget_env(budget))
+    if 'cpus' in budget:
+        command = ['taskset', '-c', ','.join(map(str, budget['cpus']))] + list(command)
+    return subprocess.call(command, env=env)
+
+
+def bench_pipeline(pipeline, clip, frames, threads):
+    """
+    Measure the frame rate of the core loop of a pipeline with a given number of threads
+
+    Runs in the current process, which the caller pins to `threads` cores.
+
+    Returns
+    -------
+    fps : float
+
+    """
+    import cv2
+    cv2.setNumThreads(threads)
+    cap = cv2.VideoCapture(clip)
+    images = []
+    while len(images) < frames:
+        ret, img = cap.read()
+        if not ret:
+            break
+        images.append(img)
+    cap.release()
+    if not images:
+        raise IOError(f"Unable to read {clip}")
+
+    if pipeline == 'bodypose':
+        import mediapipe as mp
+        with mp.solutions.holistic.Holistic(min_detection_confidence=0.9, min_tracking_confidence=0.9) as holistic:
+            start = time.perf_counter()
+            for img in images:
+                holistic.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    elif pipeline == 'headpose':
+        headpose_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'headpose', 'opencv_dlib_custom')
+        os.chdir(headpose_dir)
+        sys.path.insert(0, headpose_dir)
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+        from face_detector import get_face_detector, find_faces
+        from face_landmarks import get_landmark_model, detect_marks
+        face_model = get_face_detector()
+        landmark_model = get_landmark_model()
+        start = time.perf_counter()
+        for img in images:
+            for face in find_faces(img, face_model):
+                detect_marks(img, landmark_model, face)
+    elif pipeline == 'openface':
+        openface_bin = os.environ.get('OPENFACE_BIN', 'FeatureExtraction')
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), OPENBLAS_NUM_THREADS=str(threads))
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as out_dir:
+            subprocess.run([openface_bin, '-f', clip, '-pose', '-q', '-out_dir', out_dir],
+                           env=env, check=True, stdout=subprocess.DEVNULL)
+        return true_frame_count(clip) / (time.perf_counter() - start)
+    else:
+        raise ValueError(f"Unknown pipeline: {pipeline}")
+    return len(images) / (time.perf_counter() - start)
+
+
+def measure(pipeline, clip, frames, cpus):
+    """Run bench_pipeline in a child process pinned to the given cores and return its frame rate"""
+    command = [sys.executable, os.path.abspath(__file__), '-bench', pipeline, '-clip', os.path.abspath(clip),
+               '-frames', str(frames), '-threads', str(len(cpus))]
+    if hasattr(os, 'sched_setaffinity'):
+        command = ['taskset', '-c', ','.join(map(str, cpus))] + command
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def propose_split(curves, cores, objective='sum'):
+    """
+    Choose how many cores to give to each pipeline
+
+    Parameters
+    ----------
+    curves : dict
+        Pipeline -> list of frame rates measured with 1, 2, ... cores
+    cores : int
+        Number of cores to split
+    objective : string, optional
+        'sum' maximizes the aggregate frame rate, 'min' maximizes the frame rate of the slowest pipeline.
+        The default is 'sum'.
+
+    Returns
+    -------
+    split : dict
+        Pipeline -> number of cores
+    score : float
+        Value of the objective for this split
+
+    """
+    names = list(curves)
+    best, best_score = None, -1.0
+    for counts in itertools.product(*(range(1, len(curves[n]) + 1) for n in names)):
+        if sum(counts) > cores:
+            continue
+        rates = [curves[n][k - 1] for n, k in zip(names, counts)]
+        score = sum(rates) if objective == 'sum' else min(rates)
+        if score > best_score:
+            best, best_score = dict(zip(names, counts)), score
+    return best, best_score
+
+
+def split_to_budget(split):
+    """Turn a core split into a budget with contiguous pinned cores"""
+    budget = {}
+    first = 0
+    for pipeline, k in split.items():
+        cpus = list(range(first, first + k))
+        first += k
+        if pipeline == 'bodypose':
+            budget[pipeline] = {'cv2': k, 'workers': k, 'cpus': cpus}
+        elif pipeline == 'headpose':
+            budget[pipeline] = {'cv2': k, 'tf_intra': k, 'tf_inter': 1, 'cpus': cpus}
+        else:
+            budget[pipeline] = {'threads': k, 'cpus': cpus}
+    return budget
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Thread budget for concurrent pipelines.")
+    parser.add_argument('-propose', action='store_true', help="Measure the pipelines and propose a split")
+    parser.add_argument('-pipelines', nargs='+', default=['bodypose', 'headpose'], choices=PIPELINES)
+    parser.add_argument('-clip', help="Short video used for the measurements")
+    parser.add_argument('-frames', type=int, default=100, help="Frames per measurement")
+    parser.add_argument('-cores', type=int, default=os.cpu_count(), help="Number of cores to split")
+    parser.add_argument('-objective', choices=['sum', 'min'], default='sum')
+    parser.add_argument('-out', default=DEFAULT_BUDGET, help="Where to write the proposed budget")
+    parser.add_argument('-openface', metavar='BUDGET', help="Run the command after -- with the OpenFace budget")
+    parser.add_argument('-bench', choices=PIPELINES, help=argparse.SUPPRESS)
+    parser.add_argument('-threads', type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if args.bench:
+        # Child process of measure()
+        print(bench_pipeline(args.bench, args.clip, args.frames, args.threads))
+    elif args.openface:
+        command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        sys.exit(run_with_budget(command, 'openface', args.openface))
+    elif args.propose:
+        # Each pipeline alone, pinned to 1..N cores, leaving at least one core per other pipeline
+        max_cores = args.cores - len(args.pipelines) + 1
+        curves = {}
+        for pipeline in args.pipelines:
+            curves[pipeline] = []
+            for k in range(1, max_cores + 1):
+                fps = measure(pipeline, args.clip, args.frames, list(range(k)))
+                curves[pipeline].append(fps)
+                print(f"{pipeline}: {k} cores -> {fps:.1f} fps")
+        split, score = propose_split(curves, args.cores, args.objective)
+        budget = split_to_budget(split)
+        print(f"Proposed split: {split} ({args.objective} of fps = {score:.1f})")
+        with open(args.out, 'w') as f:
+            json.dump(budget, f, indent=4)
+        print(f"Saved thread budget to {args.out}")
+    else:
+        parser.print_help()
@@ -0,0 +1,572 @@
+"""
+Work queue on a shared directory, to split a corpus of videos across several machines without a network service.
+
+Every node that mounts the queue directory (NFS, SMB, ...) can run workers. The queue is made of plain files:
+
+    <queue>/jobs/<job>.json       pending or running job: pipeline, video, output folder, command, attempts
+    <queue>/leases/<job>.lease    claim of a running job, created with O_CREAT | O_EXCL so only one worker gets it
+    <queue>/leases/<job>.lease.*.expired   expired lease of a dead worker, counted by the next claim of the job
+    <queue>/done/<job>.json       finished job: worker, attempts, seconds, frames and output files
+    <queue>/failed/<job>.json     job that failed `max_attempts` times, with the last exit code
+    <queue>/workers/<name>.json   throughput of every worker: jobs, busy seconds, frames, frames per second
+
+A worker claims the first job without lease, then touches its lease every `heartbeat` seconds while the job runs.
+A lease that was not touched for `lease_timeout` seconds belongs to a dead worker (crash, killed job, lost node):
+any worker renames it to an expired lease (only one rename succeeds) and the job becomes claimable again. The job
+files are only written by the worker holding the lease of the job: the next claim counts the expired leases as
+failed attempts before it runs the job, so a job is never counted, failed or revived by a worker that does not
+hold it. Lease ages are measured with the clock of the file server (the modification time of a file touched just
+before), so the clocks of the nodes do not need to agree. A worker whose lease expired under it stops its job.
+
+Each attempt writes into its own staging folder next to the outputs. The files are only moved to the output
+folder (os.replace, atomic on the same file system) once the job exited successfully and the worker still holds
+the lease, so a crash never leaves half-written CSV files and a retried job never mixes two attempts.
+
+Jobs run as child processes with the command of their pipeline (see COMMANDS): estimate_bodypose.py with
+-render off, head_pose_estimation.py with --no_render, or the OpenFace FeatureExtraction binary ($OPENFACE_BIN),
+with the thread budget of the pipeline (see thread_budget.py) if one is given. Every job runs in its own session
+and its process group is killed when the worker loses the lease or stops; on Linux the job is also killed when its
+worker dies, even by SIGKILL, so a dead worker never leaves a job running next to its retry.
+
+`selftest` starts several worker processes against a temporary queue, kills one of them in the middle of a job
+and checks that every job is done exactly once.
+
+Usage:
+    python work_queue.py submit -queue <dir> -pipeline bodypose|headpose|openface -videos <video> [...] -out_dir <dir>
+    python work_queue.py work -queue <dir> [-name <worker>] [-budget <budget.json>] [-exit_when_empty]
+    python work_queue.py status -queue <dir>
+    python work_queue.py selftest [-workers 3] [-jobs 9]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(REPO_DIR)
+from utils.thread_budget import load_budget, budget_env
+from utils.seek_index import true_frame_count
+
+# Command of every pipeline. The placeholders are replaced by the worker that runs the job: {python} and {repo}
+# by its interpreter and repository (nodes may have them in different places), {openface} by its $OPENFACE_BIN,
+# {video} and {job} by those of the job and {out_dir} by the staging folder of the attempt.
+COMMANDS = {
+    'bodypose': ['{python}', '{repo}/bodypose/estimate_bodypose.py', '-input', '{video}', '-output', '{out_dir}',
+                 '-render', 'off'],
+    'headpose': ['{python}', '{repo}/headpose/opencv_dlib_custom/head_pose_estimation.py', '-i', '{video}',
+                 '--out_dir', '{out_dir}', '--no_render'],
+    'openface': ['{openface}', '-f', '{video}', '-out_dir', '{out_dir}'],
+}
+
+FOLDERS = ('jobs', 'leases', 'done', 'failed', 'workers')
+
+
+def write_json(path, data):
+    """Write a JSON file atomically (temporary file in the same folder + rename)"""
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    """Read a JSON file, None if it does not exist (any more)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def job_id(pipeline, video):
+    """Job name from the pipeline and the video, with a hash of the path so videos with the same name differ"""
+    name = os.path.splitext(os.path.basename(video))[0]
+    digest = hashlib.sha1(os.path.abspath(video).encode()).hexdigest()[:8]
+    return f"{pipeline}__{name}__{digest}"
+
+
+def count_frames(video):
+    """True frame count of a video from its seek index (saved next to it for the other nodes), 0 if it cannot be
+    read"""
+    return true_frame_count(video)
+
+
+def die_with_parent(parent_pid):
+    """
+    Function run in a job process before its command, so that Linux kills it when its worker dies
+
+    Returns
+    -------
+    preexec_fn : callable or None
+        None on other systems, where the jobs are only killed by a worker that stops normally
+
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+
+    def preexec():
+        import ctypes
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+        if os.getppid() != parent_pid:
+            # The worker died before the request
+            os.kill(os.getpid(), signal.SIGKILL)
+    return preexec
+
+
+def kill_group(process):
+    """Kill a job started in its own session, with every process it started, and wait for it"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def publish(staging, out_dir):
+    """Move every file of a staging folder to the output folder, each one atomically"""
+    outputs = []
+    for root, _, files in os.walk(staging):
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(out_dir, os.path.relpath(src, staging))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+            outputs.append(dst)
+    shutil.rmtree(staging, ignore_errors=True)
+    return sorted(outputs)
+
+
+class WorkQueue:
+    """Queue directory shared by the workers of every node"""
+
+    def __init__(self, root, lease_timeout=120.0, max_attempts=3):
+        """
+        Parameters
+        ----------
+        root : string
+            Queue directory, created if it does not exist
+        lease_timeout : float, optional
+            Seconds without heartbeat after which a lease is expired. The default is 120.
+        max_attempts : int, optional
+            Attempts of a job before it is moved to failed/. The default is 3.
+
+        """
+        self.root = root
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        for folder in FOLDERS:
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def path(self, folder, name):
+        return os.path.join(self.root, folder, name)
+
+    def submit(self, pipeline, video, out_dir, command=None):
+        """
+        Add a job, unless the same job is already queued or done
+
+        Parameters
+        ----------
+        pipeline : string
+            Key of COMMANDS, or any name if command is given
+        video : string
+            Input video, on a path that every node can read
+        out_dir : string
+            Output folder, on a path that every node can write
+        command : list of string, optional
+            Command with the placeholders of COMMANDS. The default is COMMANDS[pipeline].
+
+        Returns
+        -------
+        job : string or None
+            Job name, None if it already exists
+
+        """
+        job = job_id(pipeline, video)
+        if any(os.path.exists(self.path(folder, f"{job}.json")) for folder in ('jobs', 'done', 'failed')):
+            return None
+        write_json(self.path('jobs', f"{job}.json"),
+                   {'job': job, 'pipeline': pipeline, 'video': os.path.abspath(video), 'out_dir': os.path.abspath(out_dir),
+                    'command': command or COMMANDS[pipeline], 'attempts': 0, 'submitted': time.time()})
+        return job
+
+    def server_time(self):
+        """Current time of the file server, to compare with the modification times of the leases"""
+        clock = self.path('workers', f".clock.{socket.gethostname()}")
+        with open(clock, 'a'):
+            os.utime(clock, None)
+        return os.stat(clock).st_mtime
+
+    def claim(self, worker):
+        """
+        Claim the first job without lease
+
+        Returns
+        -------
+        job : dict or None
+            Job description with its lease token, None if every job is leased
+
+        """
+        for name in sorted(os.listdir(self.path('jobs', ''))):
+            if not name.endswith('.json'):
+                continue
+            job = name[:-len('.json')]
+            lease_path = self.path('leases', f"{job}.lease")
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            token = f"{worker}:{time.time():.6f}"
+            with os.fdopen(fd, 'w') as f:
+                f.write(token)
+            spec = read_json(self.path('jobs', name))
+            if spec is None:
+                # Finished by another worker between the listing and the claim
+                os.remove(lease_path)
+                continue
+            spec = self.count_expired(spec)
+            if spec is None:
+                os.remove(lease_path)
+                continue
+            spec['token'] = token
+            return spec
+        return None
+
+    def count_expired(self, spec):
+        """
+        Count the expired leases of a job as failed attempts. Only called by the worker holding its lease.
+
+        Returns
+        -------
+        spec : dict or None
+            Updated job description, None if the job failed max_attempts times and was moved to failed/
+
+        """
+        prefix = f"{spec['job']}.lease."
+        expired = [name for name in os.listdir(self.path('leases', ''))
+                   if name.startswith(prefix) and name.endswith('.expired')]
+        if not expired:
+            return spec
+        spec['attempts'] += len(expired)
+        spec['last_error'] = 'lease expired'
+        if spec['attempts'] >= self.max_attempts:
+            write_json(self.path('failed', f"{spec['job']}.json"), spec)
+            os.remove(self.path('jobs', f"{spec['job']}.json"))
+            spec = None
+        else:
+            write_json(self.path('jobs', f"{spec['job']}.json"), spec)
+        for name in expired:
+            os.remove(self.path('leases', name))
+        return spec
+
+    def holds(self, job):
+        """Whether the lease of a claimed job is still the one of its claim"""
+        try:
+            with open(self.path('leases', f"{job['job']}.lease")) as f:
+                return f.read() == job['token']
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self, job):
+        """Touch the lease of a running job. Returns False if the lease was lost."""
+        if not self.holds(job):
+            return False
+        try:
+            os.utime(self.path('leases', f"{job['job']}.lease"), None)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def reap(self):
+        """
+        Release the expired leases. Their attempts are counted by the next claim of their jobs (see count_expired),
+        so that the job files are only written under a lease.
+
+        Returns
+        -------
+        jobs : list of string
+            Jobs whose lease expired
+        """
+        now = self.server_time()
+        expired = []
+        for name in os.listdir(self.path('leases', '')):
+            if not name.endswith('.lease'):
+                continue
+            lease_path = self.path('leases', name)
+            try:
+                if now - os.stat(lease_path).st_mtime < self.lease_timeout:
+                    continue
+                # Only one worker renames the expired lease, the others get FileNotFoundError
+                os.rename(lease_path, f"{lease_path}.{socket.gethostname()}.{os.getpid()}.{time.time():.6f}.expired")
+            except FileNotFoundError:
+                continue
+            expired.append(name[:-len('.lease')])
+        return expired
+
+    def retry(self, job, reason, returncode=None):
+        """Count a failed attempt of a job, moving it to failed/ after max_attempts. The caller must hold the
+        lease of the job and release it afterwards."""
+        spec = read_json(self.path('jobs', f"{job}.json"))
+        if spec is None:
+            return
+        spec['attempts'] += 1
+        spec['last_error'] = reason if returncode is None else f"{reason} ({returncode})"
+        if spec['attempts'] >= self.max_attempts:
+            write_json(self.path('failed', f"{job}.json"), spec)
+            os.remove(self.path('jobs', f"{job}.json"))
+        else:
+            write_json(self.path('jobs', f"{job}.json"), spec)
+
+    def complete(self, job, record):
+        """Record a finished job and release it"""
+        write_json(self.path('done', f"{job['job']}.json"), dict(record, job=job['job'], attempts=job['attempts'] + 1))
+        os.remove(self.path('jobs', f"{job['job']}.json"))
+        if self.holds(job):
+            os.remove(self.path('leases', f"{job['job']}.lease"))
+
+    def release(self, job, reason, returncode=None):
+        """Count a failed attempt of a claimed job and release its lease"""
+        if self.holds(job):
+            self.retry(job['job'], reason, returncode)
+            os.remove(self.path('leases', f"{job['job']}.lease"))
+
+    def pending(self):
+        """Number of jobs not done nor failed (leased or not)"""
+        return sum(name.endswith('.json') for name in os.listdir(self.path('jobs', '')))
+
+    def status(self):
+        """Number of jobs per state and throughput of every worker"""
+        counts = {folder: sum(name.endswith(ext) for name in os.listdir(self.path(folder, '')))
+                  for folder, ext in (('jobs', '.json'), ('leases', '.lease'), ('done', '.json'), ('failed', '.json'))}
+        counts['running'] = counts.pop('leases')
+        counts['queued'] = counts.pop('jobs') - counts['running']
+        workers = [read_json(self.path('workers', name)) for name in sorted(os.listdir(self.path('workers', '')))
+                   if name.endswith('.json')]
+        return counts, [w for w in workers if w is not None]
+
+
+class Worker:
+    """Worker process that runs jobs from a queue until it is empty or stopped"""
+
+    def __init__(self, queue, name=None, heartbeat=10.0, poll=5.0, budget_path=None):
+        """
+        Parameters
+        ----------
+        queue : WorkQueue
+        name : string, optional
+            Worker name, unique across the nodes. The default is <host>-<pid>.
+        heartbeat : float, optional
+            Seconds between lease heartbeats, well below the lease timeout. The default is 10.
+        poll : float, optional
+            Seconds between claims when every job is leased. The default is 5.
+        budget_path : string, optional
+            Thread budget JSON applied to the jobs (see thread_budget.py). The default is None.
+
+        """
+        self.queue = queue
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat = heartbeat
+        self.poll = poll
+        self.budget_path = budget_path
+        self.stats = {'worker': self.name, 'host': socket.gethostname(), 'pid': os.getpid(), 'jobs': 0,
+                      'failed': 0, 'busy_seconds': 0.0, 'frames': 0, 'started': time.time()}
+
+    def save_stats(self):
+        stats = dict(self.stats, updated=time.time())
+        stats['fps'] = stats['frames'] / stats['busy_seconds'] if stats['busy_seconds'] else 0.0
+        write_json(self.queue.path('workers', f"{self.name}.json"), stats)
+
+    def command(self, job, staging):
+        values = {'python': sys.executable, 'repo': os.path.abspath(REPO_DIR),
+                  'openface': os.environ.get('OPENFACE_BIN', 'FeatureExtraction'),
+                  'video': job['video'], 'out_dir': staging, 'job': job['job']}
+        command = [part.format(**values) for part in job['command']]
+        env = dict(os.environ)
+        budget = load_budget(job['pipeline'], self.budget_path) if self.budget_path else {}
+        env.update(budget_env(budget))
+        if 'cpus' in budget:
+            command = ['taskset', '-c', ','.join(map(str, budget['cpus']))] + command
+        return command, env
+
+    def run_job(self, job):
+        """Run one claimed job, heartbeating its lease, and publish its outputs"""
+        staging = os.path.join(job['out_dir'], '.staging', f"{job['job']}.{self.name}.{job['attempts']}")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        command, env = self.command(job, staging)
+        print(f"[{self.name}] {job['job']}: attempt {job['attempts'] + 1}")
+
+        start = time.monotonic()
+        # Own session, so that the job and its children are killed together
+        process = subprocess.Popen(command, env=env, start_new_session=True, preexec_fn=die_with_parent(os.getpid()))
+        lost = False
+        try:
+            while True:
+                try:
+                    returncode = process.wait(timeout=self.heartbeat)
+                    break
+                except subprocess.TimeoutExpired:
+                    if not self.queue.heartbeat(job):
+                        # Another worker expired the lease, the job is not ours any more
+                        lost = True
+                        break
+        finally:
+            # Lease lost, or the worker is stopping (exception, SIGTERM, Ctrl+C)
+            if process.poll() is None:
+                kill_group(process)
+        seconds = time.monotonic() - start
+
+        if lost or not self.queue.holds(job):
+            print(f"[{self.name}] {job['job']}: lease lost, outputs discarded")
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        if returncode != 0 or not any(files for _, _, files in os.walk(staging)):
+            reason = 'exit code' if returncode != 0 else 'no outputs'
+            print(f"[{self.name}] {job['job']}: failed ({reason} {returncode})")
+            shutil.rmtree(staging, ignore_errors=True)
+            self.queue.release(job, reason, returncode)
+            self.stats['failed'] += 1
+            return
+
+        outputs = publish(staging, job['out_dir'])
+        frames = count_frames(job['video'])
+        self.queue.complete(job, {'worker': self.name, 'seconds': seconds, 'frames': frames, 'outputs': outputs,
+                                  'finished': time.time()})
+        self.stats['jobs'] += 1
+        self.stats['busy_seconds'] += seconds
+        self.stats['frames'] += frames
+        print(f"[{self.name}] {job['job']}: done in {seconds:.1f} s")
+
+    def run(self, max_jobs=None, exit_when_empty=False):
+        """
+        Claim and run jobs
+
+        Parameters
+        ----------
+        max_jobs : int, optional
+            Stop after this many jobs. The default is no limit.
+        exit_when_empty : bool, optional
+            Stop when no job is left (running jobs of other workers included, since their leases can still
+            expire). The default is False (wait for new jobs).
+
+        """
+        done = 0
+        self.save_stats()
+        while max_jobs is None or done < max_jobs:
+            self.queue.reap()
+            job = self.queue.claim(self.name)
+            if job is None:
+                if exit_when_empty and not self.queue.pending():
+                    break
+                time.sleep(self.poll)
+                continue
+            self.run_job(job)
+            self.save_stats()
+            done += 1
+
+
+def print_status(queue):
+    counts, workers = queue.status()
+    print(', '.join(f"{state}: {n}" for state, n in counts.items()))
+    if workers:
+        print(f"{'worker':>24} {'jobs':>5} {'failed':>6} {'busy_s':>9} {'frames':>9} {'fps':>7}")
+        for w in workers:
+            print(f"{w['worker']:>24} {w['jobs']:>5} {w['failed']:>6} {w['busy_seconds']:9.1f} {w['frames']:>9} "
+                  f"{w['fps']:7.1f}")
+        busy = sum(w['busy_seconds'] for w in workers)
+        frames = sum(w['frames'] for w in workers)
+        print(f"Total: {sum(w['jobs'] for w in workers)} jobs, {frames} frames, "
+              f"{frames / busy if busy else 0.0:.1f} fps per worker")
+
+
+def _lease_owner(queue, name):
+    """Worker of a lease file, None if it was released"""
+    try:
+        with open(queue.path('leases', name)) as f:
+            return f.read().rsplit(':', 1)[0]
+    except FileNotFoundError:
+        return None
+
+
+def selftest(workers=3, jobs=9, job_seconds=1.5):
+    """Run worker processes on a temporary queue, kill one in the middle of a job and check every job is done once"""
+    root = tempfile.mkdtemp(prefix='work_queue_')
+    queue = WorkQueue(os.path.join(root, 'queue'), lease_timeout=3.0)
+    out_dir = os.path.join(root, 'out')
+    # The job sleeps, then writes one output file named after the job
+    command = ['{python}', '-c',
+               "import sys, time; time.sleep(float(sys.argv[1])); open(sys.argv[2] + '/' + sys.argv[3] + '.txt', 'w').write(sys.argv[3])",
+               str(job_seconds), '{out_dir}', '{job}']
+    names = [queue.submit('test', os.path.join(root, f"video{k}.mp4"), out_dir, command) for k in range(jobs)]
+
+    script = os.path.abspath(__file__)
+    processes = [subprocess.Popen([sys.executable, script, 'work', '-queue', queue.root, '-name', f"worker{k}",
+                                   '-heartbeat', '0.5', '-poll', '0.5', '-lease', '3', '-exit_when_empty'])
+                 for k in range(workers)]
+    # Kill worker0 once it is running a job
+    while not any(_lease_owner(queue, name) == 'worker0' for name in os.listdir(queue.path('leases', ''))):
+        time.sleep(0.1)
+    time.sleep(job_seconds / 3)
+    processes[0].kill()
+    print("Killed worker0 in the middle of a job")
+    for process in processes[1:]:
+        process.wait(timeout=120)
+
+    done = [read_json(queue.path('done', f"{name}.json")) for name in names]
+    outputs = sorted(name for name in os.listdir(out_dir) if name != '.staging')
+    print_status(queue)
+    assert all(record is not None for record in done), "Some jobs are not done"
+    assert outputs == sorted(f"{name}.txt" for name in names), f"Unexpected outputs {outputs}"
+    assert any(record['attempts'] > 1 for record in done), "The job of the killed worker was not retried"
+    leftovers = [name for _, _, files in os.walk(os.path.join(out_dir, '.staging')) for name in files]
+    assert not leftovers, f"The job of the killed worker kept running and wrote {leftovers}"
+    print(f"Self-test passed: {jobs} jobs done once each by {workers} workers, queue in {root}")
+    shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared-directory work queue for the pose pipelines.")
+    parser.add_argument('action', choices=['submit', 'work', 'status', 'selftest'])
+    parser.add_argument('-queue', help="Queue directory on the shared file system")
+    parser.add_argument('-pipeline', choices=sorted(COMMANDS), help="Pipeline of the submitted videos")
+    parser.add_argument('-videos', nargs='+', default=[], help="Videos to submit")
+    parser.add_argument('-out_dir', help="Output folder of the submitted jobs")
+    parser.add_argument('-name', help="Worker name, unique across the nodes")
+    parser.add_argument('-budget', help="Thread budget JSON for the jobs (see thread_budget.py)")
+    parser.add_argument('-lease', type=float, default=120.0, help="Lease timeout in seconds")
+    parser.add_argument('-heartbeat', type=float, default=10.0, help="Seconds between heartbeats")
+    parser.add_argument('-poll', type=float, default=5.0, help="Seconds between claims when every job is leased")
+    parser.add_argument('-attempts', type=int, default=3, help="Attempts per job before it fails")
+    parser.add_argument('-max_jobs', type=int, help="Stop the worker after this many jobs")
+    parser.add_argument('-exit_when_empty', action='store_true', help="Stop the worker when no job is left")
+    parser.add_argument('-workers', type=int, default=3, help="Worker processes of the self-test")
+    parser.add_argument('-jobs', type=int, default=9, help="Jobs of the self-test")
+    args = parser.parse_args()
+
+    if args.action == 'selftest':
+        selftest(args.workers, args.jobs)
+        sys.exit(0)
+    if not args.queue:
+        parser.error("-queue is required")
+    queue = WorkQueue(args.queue, lease_timeout=args.lease, max_attempts=args.attempts)
+    if args.action == 'submit':
+        if not args.pipeline or not args.out_dir:
+            parser.error("submit needs -pipeline and -out_dir")
+        submitted = [job for job in (queue.submit(args.pipeline, video, args.out_dir) for video in args.videos) if job]
+        print(f"Submitted {len(submitted)} jobs ({len(args.videos) - len(submitted)} already queued or done)")
+    elif args.action == 'work':
+        # SIGTERM stops the worker like Ctrl+C, so that its running job is killed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        Worker(queue, args.name, args.heartbeat, args.poll, args.budget).run(args.max_jobs, args.exit_when_empty)
+    else:
+        print_status(queue)